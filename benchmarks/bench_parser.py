@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+'''
+Benchmarks loading and validating a large generated config, without any
+hosts involved. Writes one JSON object per measurement, in the format of
+run_benchmarks.py (so --compare works the same way).
+
+  benchmarks/bench_parser.py --blocks 100000 -o parser.jsonl
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from easy_deploy.util.parser import EasyDeployParser
+from run_benchmarks import compare
+
+# Block templates cycled through when generating a config
+BLOCKS = [
+    '- command: installFile\n'
+    '  localSource: file%(index)d.conf\n'
+    '  remoteSource: /etc/bench/file%(index)d.conf\n'
+    '  restarts: svc%(service)d\n',
+    '- command: installFile\n'
+    '  localSource: file%(index)d.conf\n'
+    '  remoteSource: /etc/bench/file%(index)d.conf\n'
+    '  owner: nobody\n'
+    "  mode: '0600'\n",
+    '- command: installDebianPackage\n'
+    '  source: /var/cache/bench/pkg%(index)d.deb\n'
+    '  id: pkg%(index)d\n',
+    '- command: removeDebianPackage\n'
+    '  source: old%(index)d\n'
+    '  after: pkg%(previous)d\n',
+]
+
+
+def write_config(path: str,
+                 blocks: int,
+                 ):
+    '''
+    Writes a config of `blocks` blocks.
+    '''
+    with open(path, 'w') as stream:
+        for index in range(blocks):
+            template = BLOCKS[index % len(BLOCKS)]
+            stream.write(template % {'index': index,
+                                     'previous': index - 1,
+                                     'service': index % 10,
+                                     })
+
+def measure(function,
+            ) -> (object, float, int):
+    '''
+    Runs a function twice: timed, then under tracemalloc (which slows
+    it down too much to time it at the same time).
+
+    Returns::(object, float, int)
+      Its result, seconds taken and peak bytes allocated
+    '''
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def retained_bytes(function,
+                   ) -> (object, int):
+    '''
+    Returns::(object, int)
+      The result of function and the bytes it still holds on to
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+def run(blocks: int,
+        ) -> list:
+    '''
+    Returns::list
+      Result dicts for loading, validating, building, building from the
+      on-disk cache and building again with the same parser
+    '''
+    workDir = tempfile.mkdtemp(prefix='easy_deploy-bench-')
+    try:
+        path = '%s/config.yml' % workDir
+        write_config(path, blocks)
+        with open(path, 'rb') as stream:
+            contents = stream.read()
+
+        parser = EasyDeployParser()
+        params = {'blocks': blocks, 'bytes': len(contents)}
+        results = []
+
+        def result(case, seconds, peak, **fields):
+            data = {'suite': 'parser',
+                    'case': 'parser[blocks=%d].%s' % (blocks, case),
+                    'params': params,
+                    'wall': round(seconds, 4),
+                    'peakBytes': peak,
+                    }
+            data.update(fields)
+            results.append(data)
+
+        config, seconds, peak = measure(lambda: parser._load(contents))
+        result('load', seconds, peak)
+
+        def validate():
+            errors = parser._parse(config)
+            return errors or parser._verify_dependencies(config)
+
+        errors, seconds, peak = measure(validate)
+        if errors:
+            raise RuntimeError('\n'.join(errors[:5]))
+        result('validate', seconds, peak)
+
+        runlist, seconds, peak = measure(
+            lambda: parser._build_with_optionals(config))
+        _, stepBytes = retained_bytes(
+            lambda: parser._build_with_optionals(config))
+        # What filling defaults into a copy of every block would hold
+        _, copyBytes = retained_bytes(lambda: [dict(step) for step in runlist])
+        result('build', seconds, peak,
+               retainedBytes=stepBytes,
+               filledCopyBytes=copyBytes)
+
+        cacheDir = '%s/cache' % workDir
+        EasyDeployParser(cacheDir).build(path)
+        _, seconds, peak = measure(
+            lambda: EasyDeployParser(cacheDir).build(path))
+        result('cached', seconds, peak)
+
+        warm = EasyDeployParser()
+        warm.build(path)
+        _, seconds, peak = measure(lambda: warm.build(path))
+        result('warm', seconds, peak)
+
+        return results
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark config parsing and '\
+                                        'validation')
+
+    parser.add_argument('-b', '--blocks',
+                        action='append',
+                        help='Number of config blocks (may be given more '\
+                             'than once, default: 100000)',
+                        type=int,
+                        )
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        help='Write results (JSON lines) to this file '\
+                             'instead of stdout',
+                        )
+
+    parser.add_argument('--compare',
+                        action='store',
+                        help='Results file of an earlier run to compare '\
+                             'wall times against',
+                        )
+
+    parser.add_argument('--threshold',
+                        action='store',
+                        default=0.2,
+                        help='Slowdown (fraction) reported as a regression '\
+                             '(default: 0.2)',
+                        type=float,
+                        )
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    results = []
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for blocks in args.blocks or [100000]:
+        for result in run(blocks):
+            results.append(result)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    if args.output:
+        output.close()
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('%d regression(s) over %d%%' % (len(regressions),
+                                                  args.threshold * 100),
+                  file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,587 @@
+'''
+Local stand-in for remote hosts, used by the benchmarks.
+
+The scripts in bin/ shadow ssh, rsync, dpkg, dpkg-query, dpkg-deb,
+service and systemctl when bin/ is put first on PATH. Each remote host is a directory,
+$FAKEHOST_ROOT/hosts/<host>. Remote commands run locally with every
+absolute path argument moved under the host's directory, and the host
+directory is stripped from their output again.
+
+Latency is injected with environment variables (seconds, default 0):
+  FAKEHOST_CONNECT_LATENCY  every new ssh connection (not multiplexed ones)
+  FAKEHOST_COMMAND_LATENCY  every remote command or transfer
+  FAKEHOST_RESTART_LATENCY  every service restart
+  FAKEHOST_BANDWIDTH        bytes/second for transfers (default unlimited)
+
+Hosts whose name starts with "down" refuse connections. The easy_deploy
+agent is run behind a relay (see run_agent) that moves the paths of its
+requests under the host's directory the same way.
+'''
+
+import hashlib
+import io
+import json
+import os
+import shlex
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+# ssh options that take an argument
+SSH_ARG_OPTIONS = set('BbcDEeFIiJLlmOoPpQRSWw')
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__)) + '/bin'
+
+# Header of the easy_deploy agent's frames (see remote_agent)
+AGENT_FRAME_HEADER = struct.Struct('>II')
+
+
+def env_float(name: str,
+              default: float=0.0,
+              ) -> float:
+    '''
+    Returns a float environment variable.
+    '''
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+def root_dir(
+             ) -> str:
+    '''
+    Returns the directory holding all fake hosts.
+    '''
+    return os.environ.get('FAKEHOST_ROOT', '/tmp/fakehost')
+
+def host_dir(host: str,
+             ) -> str:
+    '''
+    Returns (and creates) the directory standing in for a host.
+    '''
+    host = host.split('@')[-1]
+    path = '%s/hosts/%s' % (root_dir(), host)
+    os.makedirs('%s/tmp' % path, exist_ok=True)
+    return path
+
+def to_host_path(hostDir: str,
+                 path: str,
+                 ) -> str:
+    '''
+    Moves an absolute path under a host directory. Paths already under
+    another host's directory (passed on by a host relaying to another)
+    are moved over.
+    '''
+    if path.startswith(hostDir):
+        return path
+    hostsDir = '%s/hosts/' % root_dir()
+    if path.startswith(hostsDir):
+        _, _, path = path[len(hostsDir):].partition('/')
+        path = '/' + path
+    return hostDir + path
+
+def sleep(seconds: float,
+          ):
+    if seconds > 0:
+        time.sleep(seconds)
+
+def master_marker(controlPath: str,
+                  host: str,
+                  ) -> str:
+    '''
+    Returns the file marking an open master session (ssh expands %C to a
+    hash of the connection, so do the same).
+    '''
+    token = hashlib.sha1(host.encode('utf-8')).hexdigest()[:16]
+    return controlPath.replace('%C', token)
+
+def parse_ssh_args(args: list,
+                   ) -> (dict, list, list):
+    '''
+    Splits ssh arguments into options, flags and the destination plus
+    remote command.
+
+    Returns::(dict, list, list)
+      -o options, other options (letter, value), remaining args
+    '''
+    options = {}
+    flags = []
+    index = 0
+    while index < len(args) and args[index].startswith('-'):
+        arg = args[index]
+        letter = arg[1:2]
+        if letter in SSH_ARG_OPTIONS:
+            value = arg[2:] if len(arg) > 2 else args[index + 1]
+            index += 1 if len(arg) > 2 else 2
+            if letter == 'o':
+                key, _, optionValue = value.partition('=')
+                options[key] = optionValue
+            else:
+                flags.append((letter, value))
+        else:
+            flags.extend((flag, None) for flag in arg[1:])
+            index += 1
+    return options, flags, args[index:]
+
+def connect(host: str,
+            options: dict,
+            ) -> bool:
+    '''
+    Simulates connecting to a host: refused for "down" hosts, free over
+    an open master session, FAKEHOST_CONNECT_LATENCY otherwise.
+    '''
+    if host.split('@')[-1].startswith('down'):
+        sys.stderr.write('ssh: connect to host %s: Connection refused\n'
+                         % host)
+        return False
+    controlPath = options.get('ControlPath')
+    if not (controlPath and os.path.exists(master_marker(controlPath,
+                                                          host))):
+        sleep(env_float('FAKEHOST_CONNECT_LATENCY'))
+    return True
+
+def run_remote(host: str,
+               remoteCmd: str,
+               ) -> int:
+    '''
+    Runs a remote command locally against the host directory.
+    '''
+    hostDir = host_dir(host)
+    argv = [to_host_path(hostDir, arg) if arg.startswith('/') else arg
+            for arg in shlex.split(remoteCmd)]
+    env = dict(os.environ,
+               PATH='%s:%s' % (BIN_DIR, os.environ.get('PATH', '')),
+               FAKEHOST_HOST=host.split('@')[-1],
+               FAKEHOST_HOSTDIR=hostDir)
+    sleep(env_float('FAKEHOST_COMMAND_LATENCY'))
+    if argv[:2] == ['python3', '-c']:
+        return run_agent(hostDir, argv, env)
+    try:
+        process = subprocess.Popen(argv,
+                                   cwd=hostDir,
+                                   env=env,
+                                   stdout=subprocess.PIPE)
+    except OSError as e:
+        sys.stderr.write('%s\n' % e)
+        return 127
+
+    prefix = hostDir.encode('utf-8')
+    out = sys.stdout.buffer
+    for line in process.stdout:
+        out.write(line.replace(prefix, b''))
+        out.flush()
+    return process.wait()
+
+def read_exactly(stream,
+                 size: int,
+                 ) -> bytes:
+    '''
+    Returns the next `size` bytes of a stream, None at its end.
+    '''
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def read_frame(stream,
+               ) -> (dict, bytes):
+    '''
+    Reads an agent frame, None at the end of the stream.
+    '''
+    header = read_exactly(stream, AGENT_FRAME_HEADER.size)
+    if header is None:
+        return None
+    size, payloadSize = AGENT_FRAME_HEADER.unpack(header)
+    message = json.loads(read_exactly(stream, size).decode('utf-8'))
+    return message, read_exactly(stream, payloadSize) if payloadSize else b''
+
+def write_frame(stream,
+                message: dict,
+                payload: bytes,
+                ):
+    data = json.dumps(message).encode('utf-8')
+    stream.write(AGENT_FRAME_HEADER.pack(len(data), len(payload)))
+    stream.write(data)
+    stream.write(payload)
+    stream.flush()
+
+def run_agent(hostDir: str,
+              argv: list,
+              env: dict,
+              ) -> int:
+    '''
+    Runs the easy_deploy agent (argv) against a host directory, relaying
+    its frames: absolute paths of requests are moved under the host
+    directory, and the directory is stripped from output and errors.
+    '''
+    process = subprocess.Popen(argv,
+                               cwd=hostDir,
+                               env=env,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    requests, results = sys.stdin.buffer, sys.stdout.buffer
+
+    def relay_requests():
+        try:
+            # The bootstrap reads the agent's source, preceded by its length
+            line = requests.readline()
+            process.stdin.write(line)
+            if line.strip():
+                process.stdin.write(read_exactly(requests, int(line)) or b'')
+            process.stdin.flush()
+            while True:
+                frame = read_frame(requests)
+                if frame is None:
+                    break
+                message, payload = frame
+                for key in ('path', 'source'):
+                    if str(message.get(key, '')).startswith('/'):
+                        message[key] = to_host_path(hostDir, message[key])
+                if 'argv' in message:
+                    message['argv'] = [to_host_path(hostDir, arg)
+                                       if arg.startswith('/') else arg
+                                       for arg in message['argv']]
+                write_frame(process.stdin, message, payload)
+        except (BrokenPipeError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    threading.Thread(target=relay_requests, daemon=True).start()
+    prefix = hostDir.encode('utf-8')
+    while True:
+        frame = read_frame(process.stdout)
+        if frame is None:
+            break
+        message, payload = frame
+        if message.get('event') == 'output':
+            payload = payload.replace(prefix, b'')
+        if 'error' in message:
+            message['error'] = message['error'].replace(hostDir, '')
+        write_frame(results, message, payload)
+    return process.wait()
+
+def main_ssh(
+             ):
+    '''
+    ssh stand-in.
+    '''
+    options, flags, rest = parse_ssh_args(sys.argv[1:])
+    letters = dict(flags)
+    host = rest[0]
+    controlPath = options.get('ControlPath')
+
+    if 'G' in letters:
+        user, _, hostname = host.rpartition('@')
+        print('user %s\nhostname %s\nport 22' % (user or 'root', hostname))
+        sys.exit(0)
+
+    if 'O' in letters:
+        marker = master_marker(controlPath or '', host)
+        if letters['O'] == 'check':
+            sys.exit(0 if os.path.exists(marker) else 255)
+        if letters['O'] == 'exit' and os.path.exists(marker):
+            os.remove(marker)
+        sys.exit(0)
+
+    if options.get('ControlMaster') == 'yes':
+        if not connect(host, {}):
+            sys.exit(255)
+        open(master_marker(controlPath, host), 'w').close()
+        sys.exit(0)
+
+    if not connect(host, options):
+        sys.exit(255)
+
+    if len(rest) < 2:
+        sys.exit(0)
+    sys.exit(run_remote(host, ' '.join(rest[1:])))
+
+def split_location(location: str,
+                   ) -> (str, str):
+    '''
+    Splits an rsync location into (host, path), host is None if local.
+    '''
+    if ':' in location and not location.startswith('/'):
+        host, _, path = location.partition(':')
+        return host, path
+    return None, location
+
+def main_rsync(
+               ):
+    '''
+    rsync stand-in (local to remote and remote to remote copies). Of the
+    other options only --chmod=F<octal> and --bwlimit are applied.
+    '''
+    args = sys.argv[1:]
+    positional = []
+    filesFrom = None
+    transport = ''
+    fileMode = None
+    bandwidth = env_float('FAKEHOST_BANDWIDTH')
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg in ('-e', '--rsh'):
+            transport = args[index + 1]
+            index += 2
+            continue
+        if arg.startswith('--files-from='):
+            filesFrom = arg.split('=', 1)[1]
+        elif arg.startswith('--rsh='):
+            transport = arg.split('=', 1)[1]
+        elif arg.startswith('--chmod=F'):
+            fileMode = int(arg[len('--chmod=F'):], 8)
+        elif arg.startswith('--bwlimit='):
+            limit = float(arg.split('=', 1)[1]) * 1024
+            bandwidth = min(bandwidth, limit) if bandwidth else limit
+        elif not arg.startswith('-'):
+            positional.append(arg)
+        index += 1
+
+    sources, destination = positional[:-1], positional[-1]
+    destHost, destPath = split_location(destination)
+    if destHost:
+        options, _, _ = parse_ssh_args(shlex.split(transport)[1:])
+        if not connect(destHost, options):
+            sys.exit(255)
+        destPath = to_host_path(host_dir(destHost), destPath)
+    sleep(env_float('FAKEHOST_COMMAND_LATENCY'))
+
+    copies = []
+    for source in sources:
+        srcHost, srcPath = split_location(source)
+        if srcHost:
+            srcPath = to_host_path(host_dir(srcHost), srcPath)
+        if filesFrom is not None:
+            stream = sys.stdin if filesFrom == '-' else open(filesFrom)
+            for name in stream.read().splitlines():
+                if name:
+                    copies.append((os.path.join(srcPath, name),
+                                   os.path.join(destPath, name)))
+        elif os.path.isdir(srcPath):
+            for base, _, names in os.walk(srcPath):
+                for name in names:
+                    path = os.path.join(base, name)
+                    copies.append((path, os.path.join(
+                        destPath, os.path.relpath(path, srcPath))))
+        elif destPath.endswith('/') or os.path.isdir(destPath):
+            copies.append((srcPath, os.path.join(destPath,
+                                                 os.path.basename(srcPath))))
+        else:
+            copies.append((srcPath, destPath))
+
+    transferred = 0
+    for src, dst in copies:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            shutil.copy2(src, dst)
+            if fileMode is not None:
+                os.chmod(dst, fileMode)
+        except OSError as e:
+            sys.stderr.write('rsync: %s\n' % e)
+            sys.exit(23)
+        transferred += os.path.getsize(dst)
+
+    if bandwidth:
+        sleep(transferred / bandwidth)
+
+def write_deb(path: str,
+              package: str,
+              version: str,
+              payloadSize: int=0,
+              ):
+    '''
+    Writes a minimal .deb (ar archive with a control tarball).
+
+    Args:
+      path::str
+        Path of the .deb to write
+      package::str
+        Package name
+      version::str
+        Package version
+      payloadSize::int (Optional)
+        Bytes of (random) data payload, to make the .deb bigger
+    '''
+    control = ('Package: %s\nVersion: %s\nArchitecture: all\n'
+               'Maintainer: fakehost\nDescription: benchmark package\n'
+               % (package, version)).encode('utf-8')
+
+    def tarball(name: str, data: bytes) -> bytes:
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return buffer.getvalue()
+
+    members = [('debian-binary', b'2.0\n'),
+               ('control.tar.gz', tarball('./control', control)),
+               ('data.tar.gz', tarball('./payload', os.urandom(payloadSize))),
+               ]
+    with open(path, 'wb') as stream:
+        stream.write(b'!<arch>\n')
+        for name, data in members:
+            header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % (name, 0, 0, 0,
+                                                        '100644', len(data))
+            stream.write(header.encode('ascii'))
+            stream.write(data)
+            if len(data) % 2:
+                stream.write(b'\n')
+
+def read_deb_control(path: str,
+                     ) -> dict:
+    '''
+    Reads the control fields of a .deb.
+    '''
+    with open(path, 'rb') as stream:
+        if stream.read(8) != b'!<arch>\n':
+            raise ValueError('%s: not a debian archive' % path)
+        while True:
+            header = stream.read(60)
+            if len(header) < 60:
+                raise ValueError('%s: no control member' % path)
+            name = header[:16].decode('ascii').strip().rstrip('/')
+            size = int(header[48:58])
+            data = stream.read(size)
+            if size % 2:
+                stream.read(1)
+            if name.startswith('control.tar'):
+                break
+
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        member = next(m for m in tar.getmembers()
+                      if m.name.lstrip('./') == 'control')
+        text = tar.extractfile(member).read().decode('utf-8')
+
+    fields = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(':')
+        if value:
+            fields[key.strip()] = value.strip()
+    return fields
+
+def package_dir(
+                ) -> str:
+    '''
+    Returns the fake dpkg database of the current host.
+    '''
+    path = '%s/var/lib/fakedpkg' % os.environ['FAKEHOST_HOSTDIR']
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def main_dpkg(
+              ):
+    '''
+    dpkg stand-in (-i <deb>... and -r <package>...).
+    '''
+    action, targets = sys.argv[1], sys.argv[2:]
+    sleep(env_float('FAKEHOST_COMMAND_LATENCY') * len(targets))
+    rc = 0
+    for target in targets:
+        if action == '-i':
+            try:
+                fields = read_deb_control(target)
+            except (OSError, ValueError) as e:
+                sys.stderr.write('dpkg: error: %s\n' % e)
+                rc = 2
+                continue
+            with open('%s/%s' % (package_dir(), fields['Package']), 'w') as f:
+                f.write(fields['Version'])
+            print('Setting up %s (%s) ...' % (fields['Package'],
+                                              fields['Version']))
+        elif action == '-r':
+            state = '%s/%s' % (package_dir(), target)
+            if os.path.exists(state):
+                os.remove(state)
+                print('Removing %s ...' % target)
+    sys.exit(rc)
+
+def main_dpkg_query(
+                    ):
+    '''
+    dpkg-query stand-in (-W -f=<format> <package>...).
+    '''
+    args = sys.argv[1:]
+    fmt = '${Package}\\t${Version}\\n'
+    packages = []
+    for arg in args:
+        if arg.startswith('-f='):
+            fmt = arg[3:]
+        elif arg.startswith('--showformat='):
+            fmt = arg.split('=', 1)[1]
+        elif not arg.startswith('-'):
+            packages.append(arg)
+
+    if not packages:
+        packages = sorted(os.listdir(package_dir()))
+
+    rc = 0
+    for package in packages:
+        state = '%s/%s' % (package_dir(), package)
+        if not os.path.exists(state):
+            rc = 1
+            continue
+        with open(state) as f:
+            version = f.read()
+        sys.stdout.write(fmt.replace('${Package}', package)
+                            .replace('${Version}', version)
+                            .replace('${Status}', 'install ok installed')
+                            .replace('\\t', '\t')
+                            .replace('\\n', '\n'))
+    sys.exit(rc)
+
+def main_dpkg_deb(
+                  ):
+    '''
+    dpkg-deb stand-in (-f <deb> [field...]).
+    '''
+    args = sys.argv[1:]
+    if args[0] not in ('-f', '--field'):
+        sys.exit(2)
+    try:
+        fields = read_deb_control(args[1])
+    except (OSError, ValueError) as e:
+        sys.stderr.write('dpkg-deb: %s\n' % e)
+        sys.exit(2)
+    wanted = args[2:]
+    if len(wanted) == 1:
+        print(fields.get(wanted[0], ''))
+    else:
+        for key in wanted or fields:
+            print('%s: %s' % (key, fields.get(key, '')))
+
+def main_service(
+                 ):
+    '''
+    service stand-in, restarts take FAKEHOST_RESTART_LATENCY.
+    '''
+    sleep(env_float('FAKEHOST_RESTART_LATENCY'))
+    with open('%s/restarts.log' % os.environ['FAKEHOST_HOSTDIR'], 'a') as f:
+        f.write('%s %s\n' % (' '.join(sys.argv[1:]), time.time()))
+
+def main_systemctl(
+                   ):
+    '''
+    systemctl stand-in, `cat <unit>` succeeds for units that exist under
+    etc/systemd/system of the host, everything else is a no-op.
+    '''
+    args = [arg for arg in sys.argv[1:] if arg != '--']
+    if args[:1] != ['cat']:
+        sys.exit(0)
+    unitDir = '%s/etc/systemd/system' % os.environ['FAKEHOST_HOSTDIR']
+    for unit in args[1:]:
+        if not os.path.exists('%s/%s' % (unitDir, unit)):
+            sys.stderr.write('No files found for %s.\n' % unit)
+            sys.exit(1)
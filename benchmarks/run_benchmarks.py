@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+'''
+Benchmarks easy_deploy end to end against fake hosts (see fakehost/).
+
+Every case generates a config, its files and an inventory, runs the
+easy_deploy script with the fake ssh/rsync first on PATH and reads back
+the --report timings. One JSON object per case is written per line, so
+two result files can be compared with --compare.
+
+  benchmarks/run_benchmarks.py -o before.jsonl
+  benchmarks/run_benchmarks.py -o after.jsonl --compare before.jsonl
+'''
+
+import getpass
+import grp
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, '%s/fakehost' % BENCH_DIR)
+
+from fakehost import write_deb
+
+PHASES = ('connect', 'transfer', 'remoteExec')
+
+# name -> list of case parameters, each scaling one dimension
+SUITES = {
+    'steps': [dict(packages=count) for count in (1, 10, 50)],
+    'files': [dict(files=count) for count in (1, 50, 200)],
+    'filesize': [dict(files=1, fileSize=size)
+                 for size in (1024, 1024 ** 2, 32 * 1024 ** 2)],
+    'hosts': [dict(hosts=count, files=20) for count in (1, 10, 40)],
+    'transfer': [dict(files=100, extraArgs=['-t', mode])
+                 for mode in ('batch', 'per-file')],
+    'redeploy': [dict(files=100, runs=2)],
+    'distribution': [dict(hosts=10, files=20, fileSize=256 * 1024,
+                          extraArgs=['-dt', mode])
+                     for mode in ('direct', 'tree')],
+    'waves': [dict(hosts=10, files=20, extraArgs=['-w', size])
+              for size in ('1', '30%')],
+    'localdebs': [dict(hosts=count, localPackages=10, fileSize=1024 ** 2,
+                       runs=2)
+                  for count in (1, 10)],
+    'agent': [dict(files=50, packages=10, extraArgs=['-t', 'per-file'] + mode)
+              for mode in ([], ['-ag'])],
+    'largefile': [dict(files=1, fileSize=32 * 1024 ** 2,
+                       extraArgs=['-lf', threshold])
+                  for threshold in ('1', '64')],
+}
+
+# Defaults of every case parameter
+CASE_DEFAULTS = dict(hosts=1,
+                     files=0,
+                     fileSize=1024,
+                     packages=0,
+                     localPackages=0,
+                     restarts=1,
+                     runs=1,
+                     extraArgs=[],
+                     )
+
+
+def write_case(workDir: str,
+               case: dict,
+               ) -> (str, str):
+    '''
+    Writes the config, files, inventory and local and remote .debs for a
+    case.
+
+    Returns::(str, str)
+      Path of the config, path of the inventory
+    '''
+    owner = getpass.getuser()
+    group = grp.getgrgid(os.getgid()).gr_name
+    filesDir = '%s/files' % workDir
+    os.makedirs(filesDir)
+    os.makedirs('%s/log' % workDir)
+
+    hosts = ['host%03d' % index for index in range(case['hosts'])]
+    for host in hosts:
+        os.makedirs('%s/hosts/%s/etc/bench' % (workDir, host))
+        unitDir = '%s/hosts/%s/etc/systemd/system' % (workDir, host)
+        os.makedirs(unitDir)
+        for index in range(max(case['restarts'], 1)):
+            open('%s/svc%d.service' % (unitDir, index), 'w').close()
+
+    lines = []
+    for index in range(case['files']):
+        name = 'file%04d.conf' % index
+        with open('%s/%s' % (filesDir, name), 'wb') as stream:
+            stream.write(os.urandom(case['fileSize']))
+        lines += ['- command: installFile',
+                  '  localSource: %s' % name,
+                  '  remoteSource: /etc/bench/%s' % name,
+                  '  owner: %s' % owner,
+                  '  group: %s' % group,
+                  "  mode: '0644'",
+                  '  restarts: svc%d' % (index % max(case['restarts'], 1)),
+                  ]
+
+    for index in range(case['packages']):
+        deb = '/var/cache/bench/pkg%04d.deb' % index
+        for host in hosts:
+            path = '%s/hosts/%s%s' % (workDir, host, deb)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_deb(path, 'pkg%04d' % index, '1.0')
+        lines += ['- command: installDebianPackage',
+                  '  source: %s' % deb,
+                  ]
+
+    for index in range(case['localPackages']):
+        name = 'local%04d.deb' % index
+        write_deb('%s/%s' % (filesDir, name), 'local%04d' % index, '1.0',
+                  payloadSize=case['fileSize'])
+        lines += ['- command: installDebianPackage',
+                  '  source: %s' % name,
+                  ]
+
+    config = '%s/config.yml' % workDir
+    with open(config, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+
+    inventory = '%s/inventory' % workDir
+    with open(inventory, 'w') as stream:
+        stream.write('\n'.join(hosts) + '\n')
+
+    return config, inventory
+
+def run_case(suite: str,
+             case: dict,
+             latency: dict,
+             ) -> list:
+    '''
+    Runs one benchmark case.
+
+    Returns::list
+      One result dict per run of the case
+    '''
+    case = dict(CASE_DEFAULTS, **case)
+    workDir = tempfile.mkdtemp(prefix='easy_deploy-bench-')
+    try:
+        config, inventory = write_case(workDir, case)
+        env = dict(os.environ,
+                   PATH='%s/fakehost/bin:%s' % (BENCH_DIR,
+                                                os.environ.get('PATH', '')),
+                   PYTHONPATH=REPO_DIR,
+                   FAKEHOST_ROOT=workDir,
+                   FAKEHOST_CONNECT_LATENCY=str(latency['connect']),
+                   FAKEHOST_COMMAND_LATENCY=str(latency['command']),
+                   FAKEHOST_RESTART_LATENCY=str(latency['restart']),
+                   FAKEHOST_BANDWIDTH=str(latency['bandwidth']),
+                   )
+
+        results = []
+        for run in range(case['runs']):
+            report = '%s/report-%d.json' % (workDir, run)
+            cmd = [sys.executable, '%s/scripts/easy_deploy' % REPO_DIR,
+                   '-c', config,
+                   '-d', workDir,
+                   '-I', inventory,
+                   '-u', getpass.getuser(),
+                   '-ld', '%s/log' % workDir,
+                   '-r', report,
+                   '-rc', '%s/cache' % workDir,
+                   '-fc', '%s/facts' % workDir,
+                   ] + case['extraArgs']
+            start = time.monotonic()
+            process = subprocess.run(cmd, env=env)
+            wall = time.monotonic() - start
+            results.append(summarize(suite, case, run, wall,
+                                     process.returncode, report))
+        return results
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def summarize(suite: str,
+              case: dict,
+              run: int,
+              wall: float,
+              returncode: int,
+              reportFile: str,
+              ) -> dict:
+    '''
+    Builds the result of one run from its report.
+    '''
+    params = {key: value for key, value in case.items()
+              if key != 'runs'}
+    result = {'suite': suite,
+              'case': case_name(suite, params, run),
+              'params': params,
+              'run': run,
+              'success': returncode == 0,
+              'wall': round(wall, 4),
+              }
+    try:
+        with open(reportFile) as stream:
+            report = json.load(stream)
+    except (OSError, ValueError):
+        return result
+
+    for span in report['run']:
+        result[span['name']] = span['duration']
+
+    hosts = report['hosts'].values()
+    # Host spans (and their preflights and prepares) nest in the run's
+    # phases, whose totals hold theirs, so only the phases are summed
+    spans = report['run']
+    for phase in PHASES:
+        result[phase] = round(sum(span.get(phase, 0.0) for span in spans), 4)
+    result['bytes'] = sum(span.get('bytes', 0) for span in spans)
+    durations = sorted(host.get('duration', 0.0) for host in hosts)
+    if durations:
+        result['hostMax'] = durations[-1]
+        result['hostMedian'] = durations[len(durations) // 2]
+    return result
+
+def case_name(suite: str,
+              params: dict,
+              run: int,
+              ) -> str:
+    '''
+    Returns a stable name for a case, used to match runs in --compare.
+    '''
+    changed = ['%s=%s' % (key, ' '.join(value) if isinstance(value, list)
+                          else value)
+               for key, value in sorted(params.items())
+               if value != CASE_DEFAULTS[key]]
+    return '%s[%s]#%d' % (suite, ','.join(changed), run)
+
+def compare(results: list,
+            baselineFile: str,
+            threshold: float,
+            ) -> list:
+    '''
+    Compares wall times against a previous results file.
+
+    Returns::list
+      Lines describing each regression
+    '''
+    with open(baselineFile) as stream:
+        baseline = {result['case']: result
+                    for result in map(json.loads, stream) if result}
+
+    regressions = []
+    for result in results:
+        before = baseline.get(result['case'])
+        if not before:
+            continue
+        change = (result['wall'] - before['wall']) / max(before['wall'], 1e-6)
+        line = '%-50s %8.3fs -> %8.3fs (%+.1f%%)' % (result['case'],
+                                                    before['wall'],
+                                                    result['wall'],
+                                                    change * 100)
+        print(line, file=sys.stderr)
+        if change > threshold:
+            regressions.append(line)
+    return regressions
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark easy_deploy against '\
+                                        'local fake hosts')
+
+    parser.add_argument('-s', '--suite',
+                        action='append',
+                        choices=sorted(SUITES),
+                        help='Suite to run (may be given more than once, '\
+                             'default: all)',
+                        )
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        help='Write results (JSON lines) to this file '\
+                             'instead of stdout',
+                        )
+
+    parser.add_argument('--compare',
+                        action='store',
+                        help='Results file of an earlier run to compare '\
+                             'wall times against',
+                        )
+
+    parser.add_argument('--threshold',
+                        action='store',
+                        default=0.2,
+                        help='Slowdown (fraction) reported as a regression '\
+                             '(default: 0.2)',
+                        type=float,
+                        )
+
+    parser.add_argument('--connect-latency',
+                        action='store',
+                        default=0.05,
+                        help='Seconds per new ssh connection '\
+                             '(default: 0.05)',
+                        type=float,
+                        )
+
+    parser.add_argument('--command-latency',
+                        action='store',
+                        default=0.01,
+                        help='Seconds per remote command (default: 0.01)',
+                        type=float,
+                        )
+
+    parser.add_argument('--restart-latency',
+                        action='store',
+                        default=0.01,
+                        help='Seconds per service restart (default: 0.01)',
+                        type=float,
+                        )
+
+    parser.add_argument('--bandwidth',
+                        action='store',
+                        default=0,
+                        help='Transfer bytes per second (default: unlimited)',
+                        type=float,
+                        )
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    latency = {'connect': args.connect_latency,
+               'command': args.command_latency,
+               'restart': args.restart_latency,
+               'bandwidth': args.bandwidth,
+               }
+
+    results = []
+    output = open(args.output, 'w') if args.output else sys.stdout
+    for suite in args.suite or sorted(SUITES):
+        for case in SUITES[suite]:
+            for result in run_case(suite, case, latency):
+                results.append(result)
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+    if args.output:
+        output.close()
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('%d regression(s) over %d%%' % (len(regressions),
+                                                  args.threshold * 100),
+                  file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
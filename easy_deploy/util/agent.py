@@ -0,0 +1,289 @@
+'''
+Module used to do a host's remote work through an easy_deploy agent (see
+remote_agent): a small Python program started over one ssh session, to
+which requests are streamed as framed JSON messages, instead of starting
+a remote process (and paying an ssh round trip) for every action.
+'''
+
+import asyncio
+import contextvars
+import inspect
+import itertools
+import json
+import logging
+import shlex
+import struct
+
+from easy_deploy.util import remote_agent
+from easy_deploy.util.aio import aiter_chunks, kill_process_group
+from easy_deploy.util.constants import DEFAULT_SSH_CONNECT_TIMEOUT
+
+FRAME_HEADER = struct.Struct('>II')
+DATA_CHUNK_BYTES = 1 << 20
+
+# Run by the remote python3: reads the agent's source (preceded by its
+# length) from stdin and runs it, the rest of stdin are requests
+AGENT_BOOTSTRAP = 'import sys; '\
+                  'n = int(sys.stdin.buffer.readline()); '\
+                  'exec(compile(sys.stdin.buffer.read(n), '\
+                  '"easy_deploy-agent", "exec"), {"__name__": "__main__"})'
+
+_source = None
+
+class AgentError(Exception):
+    ''' Raised if the agent is not running or stopped answering '''
+
+def agent_source(
+                 ) -> bytes:
+    '''
+    Returns the source of the agent sent to remote hosts.
+    '''
+    global _source
+    if _source is None:
+        _source = inspect.getsource(remote_agent).encode('utf-8')
+    return _source
+
+
+class Agent:
+    def __init__(self,
+                 connection,
+                 ):
+        '''
+        Agent of one host. Requests may be made concurrently, from the
+        shared loop (see aio), and are run concurrently by the agent.
+
+        Args:
+          connection::Connection
+            Connection of the host, its master session carries the agent
+        '''
+        self.connection = connection
+        self.logger = logging.getLogger()
+        self.process = None
+        self._ids = itertools.count(1)
+        self._pending = {} # request id -> (future, onOutput, credits)
+        self._tasks = []
+        self._writeLock = None # asyncio.Lock, made on the loop
+
+    @property
+    def alive(self,
+              ) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def astart(self,
+                     ) -> bool:
+        '''
+        Starts the agent on the host and waits for it to answer.
+
+        Returns::bool
+          True if the agent is running
+        '''
+        self._writeLock = asyncio.Lock()
+        cmd = self.connection.ssh_command(
+            ' '.join(shlex.quote(arg)
+                     for arg in ['python3', '-c', AGENT_BOOTSTRAP]))
+        self.logger.debug('Starting agent on %s' % self.connection.hostname)
+        self.process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+        # The tasks outlive the job starting the agent, so they run in a
+        # context of their own rather than a copy of the job's (ie. its
+        # report span and host)
+        self._tasks = [contextvars.Context().run(asyncio.ensure_future, coro)
+                       for coro in (self._aread(), self._alog_stderr())]
+
+        source = agent_source()
+        try:
+            self.process.stdin.write(b'%d\n' % len(source) + source)
+            await self.process.stdin.drain()
+            reply = await self.arequest('ping',
+                                        timeout=DEFAULT_SSH_CONNECT_TIMEOUT + 10)
+        except (AgentError, ConnectionError) as e:
+            self.logger.debug('%s: Agent did not start: %s'
+                              % (self.connection.hostname, e))
+            await self.aclose()
+            return False
+
+        self.logger.debug('%s: Agent running (pid %s, Python %s)'
+                          % (self.connection.hostname,
+                             reply.get('pid'),
+                             reply.get('python')))
+        return True
+
+    async def aclose(self,
+                     ):
+        '''
+        Stops the agent: it exits once its stdin is closed.
+        '''
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            try:
+                self.process.stdin.close()
+                await asyncio.wait_for(self.process.wait(), 5)
+            except (asyncio.TimeoutError, ConnectionError):
+                kill_process_group(self.process)
+                await self.process.wait()
+        for task in self._tasks:
+            await task
+
+    async def arequest(self,
+                       op: str,
+                       fields: dict=None,
+                       data: (bytes, object)=None,
+                       onOutput=None,
+                       timeout: float=None,
+                       ) -> dict:
+        '''
+        Makes a request and waits for its result.
+
+        Args:
+          op::str
+            Operation to run (see the op_ methods of RemoteAgent)
+          fields::dict (Optional)
+            Arguments of the operation
+          data::bytes/iterable (Optional)
+            Data (or a sync or async iterable of chunks of it) streamed to
+            the request, ie. stdin of exec
+          onOutput::callable (Optional)
+            Called with (stream name, line bytes) of each output event
+          timeout::float (Optional)
+            Seconds to wait for the result (None for no limit)
+
+        Returns::dict
+          The result message (has "error" if the request failed)
+
+        Raises:
+          AgentError
+            If the agent died or did not answer in time
+        '''
+        if not self.alive:
+            raise AgentError('Agent on %s is not running'
+                             % self.connection.hostname)
+
+        requestId = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        # Data chunks the agent may still queue for the request
+        credits = asyncio.Semaphore(remote_agent.MAX_QUEUED_CHUNKS) \
+                  if data is not None else None
+        self._pending[requestId] = (future, onOutput, credits)
+        message = dict(fields or {}, id=requestId, op=op)
+        if data is not None:
+            message['data'] = True
+        try:
+            await self._asend(message)
+            if data is not None:
+                await self._asend_data(requestId, data)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise AgentError('Agent on %s did not answer %s in %ss'
+                             % (self.connection.hostname, op, timeout))
+        except ConnectionError as e:
+            raise AgentError('Agent on %s is gone: %s'
+                             % (self.connection.hostname, e))
+        finally:
+            self._pending.pop(requestId, None)
+
+    async def _asend(self,
+                     message: dict,
+                     payload: bytes=b'',
+                     ):
+        data = json.dumps(message).encode('utf-8')
+        async with self._writeLock:
+            self.process.stdin.write(FRAME_HEADER.pack(len(data),
+                                                       len(payload)))
+            self.process.stdin.write(data)
+            self.process.stdin.write(payload)
+            await self.process.stdin.drain()
+
+    async def _asend_data(self,
+                          requestId: int,
+                          data: (bytes, object),
+                          ):
+        '''
+        Streams a request's data as data frames, ending with an empty one
+        (or an abort, if producing the data failed). Each frame waits for
+        a credit from the agent, and the rest of the data is dropped if
+        the request ends before taking it all.
+        '''
+        message = {'id': requestId, 'op': 'data'}
+        future, _, credits = self._pending[requestId]
+
+        async def send(chunk: bytes) -> bool:
+            for offset in range(0, len(chunk), DATA_CHUNK_BYTES):
+                await credits.acquire()
+                if future.done():
+                    return False
+                await self._asend(message,
+                                  chunk[offset:offset + DATA_CHUNK_BYTES])
+            return True
+
+        try:
+            async for chunk in aiter_chunks(data):
+                if not await send(chunk):
+                    return
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception:
+            await self._asend(dict(message, abort=True))
+            raise
+        await self._asend(message)
+
+    async def _aread(self,
+                     ):
+        '''
+        Hands results and output events to the requests waiting for them,
+        until the agent exits. Requests still waiting then fail.
+        '''
+        stdout = self.process.stdout
+        try:
+            while True:
+                header = await stdout.readexactly(FRAME_HEADER.size)
+                size, payloadSize = FRAME_HEADER.unpack(header)
+                message = json.loads(await stdout.readexactly(size))
+                payload = await stdout.readexactly(payloadSize) \
+                          if payloadSize else b''
+
+                future, onOutput, credits = self._pending.get(
+                    message.get('id'), (None, None, None))
+                if future is None:
+                    continue
+                if message.get('event') == 'output':
+                    if onOutput:
+                        onOutput(message.get('stream'), payload)
+                elif message.get('event') == 'credit':
+                    credits.release()
+                elif not future.done():
+                    future.set_result(message)
+                    # Wakes a sender waiting for a credit, to drop its data
+                    if credits is not None:
+                        credits.release()
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                self.logger.error('%s: Garbled message from agent: %s'
+                                  % (self.connection.hostname, e))
+                kill_process_group(self.process)
+        finally:
+            await self.process.wait()
+            for future, _, credits in list(self._pending.values()):
+                if not future.done():
+                    future.set_exception(AgentError(
+                        'Agent on %s exited (%s)' % (self.connection.hostname,
+                                                     self.process.returncode)))
+                    if credits is not None:
+                        credits.release()
+
+    async def _alog_stderr(self,
+                           ):
+        '''
+        Logs what the agent (or the ssh carrying it) writes to stderr.
+        '''
+        while True:
+            line = await self.process.stderr.readline()
+            if not line:
+                return
+            self.logger.warning('%s [agent]: %s' % (
+                self.connection.hostname,
+                line.decode('utf-8', 'replace').rstrip('\n')))
@@ -0,0 +1,278 @@
+'''
+Module providing the asyncio engine all process execution runs on.
+
+A single event loop runs in a background thread for the life of the
+program. Async callers await the coroutines directly; synchronous callers
+(from any thread) hand their coroutine to that loop with run_sync and
+block only themselves while it runs.
+'''
+
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import signal
+import sys
+import threading
+
+from easy_deploy.util.output import LineSplitter
+
+READ_CHUNK_BYTES = 64 * 1024
+
+_loop = None
+_loopLock = threading.Lock()
+
+
+class ProcessTimeout(Exception):
+    ''' Raised when a process exceeds its timeout (it has been killed) '''
+
+
+def get_loop(
+             ) -> asyncio.AbstractEventLoop:
+    '''
+    Returns the shared event loop, starting it on first use.
+
+    Returns::asyncio.AbstractEventLoop
+      The running shared loop
+    '''
+    global _loop
+    with _loopLock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                _install_child_watcher(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run_loop,
+                                      name='easy_deploy-aio',
+                                      daemon=True)
+            thread.start()
+            started.wait()
+            _loop = loop
+    return _loop
+
+def run_sync(coro,
+             ):
+    '''
+    Runs a coroutine on the shared loop and waits for its result.
+
+    The coroutine runs in a copy of the caller's context, so context
+    variables (eg. the current report span) carry over to it.
+
+    Args:
+      coro::coroutine
+        Coroutine to run
+
+    Returns:
+      Result of the coroutine (its exception is re-raised)
+    '''
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running is loop:
+        # Blocking here would deadlock the loop
+        coro.close()
+        raise RuntimeError('run_sync called from the shared loop, '
+                           'await the coroutine instead')
+
+    result = concurrent.futures.Future()
+
+    def start():
+        task = loop.create_task(coro)
+
+        def done(task: asyncio.Task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+    return result.result()
+
+def _install_child_watcher(loop: asyncio.AbstractEventLoop,
+                           ):
+    '''
+    Uses pidfd based child watching on the shared loop where available.
+    Older Pythons otherwise default to a watcher that spends a thread per
+    process. (3.12+ picks pidfd by itself.)
+
+    Args:
+      loop::asyncio.AbstractEventLoop
+        The shared loop, all subprocesses are started on it
+    '''
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+    try:
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.set_child_watcher(watcher)
+    except (AttributeError, OSError, NotImplementedError):
+        pass
+
+def kill_process_group(process: asyncio.subprocess.Process,
+                       ):
+    '''
+    Kills a process started by run_process along with its children.
+
+    Args:
+      process::asyncio.subprocess.Process
+        Process to kill (a session leader)
+    '''
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def run_process(cmd: (str, list),
+                      shell: bool=False,
+                      stdinData: (bytes, object)=None,
+                      captureStdout: bool=False,
+                      captureStderr: bool=True,
+                      timeout: float=None,
+                      onStdoutLine=None,
+                      onStderrLine=None,
+                      ) -> (bytes, bytes, int):
+    '''
+    Runs a process to completion without blocking the loop.
+
+    The process gets its own process group, so on timeout or cancellation
+    it is killed together with anything it spawned (eg. ssh, sh -c).
+
+    Args:
+      cmd::str/list
+        Command to run (string if shell is True)
+      shell::bool (Optional)
+        Run the command through the shell
+      stdinData::bytes/iterable (Optional)
+        Data to feed to stdin, or an iterable of chunks of it that is
+        consumed as the process reads (stdin is /dev/null otherwise)
+      captureStdout::bool (Optional)
+        Capture stdout (it is discarded otherwise)
+      captureStderr::bool (Optional)
+        Capture stderr (it is discarded otherwise)
+      timeout::float (Optional)
+        Seconds to allow the process to run (None for no limit)
+      onStdoutLine::callable (Optional)
+        Called with each stdout line (bytes) as it arrives. The stream is
+        then not captured.
+      onStderrLine::callable (Optional)
+        Called with each stderr line (bytes) as it arrives. The stream is
+        then not captured.
+
+    Returns::(bytes, bytes, int)
+      stdout and stderr (empty unless captured) and the return code
+
+    Raises:
+      ProcessTimeout
+        If the timeout was exceeded
+    '''
+    def pipe_if(wanted: bool):
+        return asyncio.subprocess.PIPE if wanted else asyncio.subprocess.DEVNULL
+
+    kwargs = {
+        'stdin': pipe_if(stdinData is not None),
+        'stdout': pipe_if(captureStdout or onStdoutLine),
+        'stderr': pipe_if(captureStderr or onStderrLine),
+        'start_new_session': True,
+    }
+    if shell:
+        process = await asyncio.create_subprocess_shell(cmd, **kwargs)
+    else:
+        process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+
+    collected = {'stdout': [], 'stderr': []}
+    tasks = []
+    if stdinData is not None:
+        tasks.append(_feed(process.stdin, stdinData))
+    for name, onLine in (('stdout', onStdoutLine), ('stderr', onStderrLine)):
+        stream = getattr(process, name)
+        if stream is not None:
+            tasks.append(_pump(stream, onLine, collected[name]))
+    tasks.append(process.wait())
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except asyncio.TimeoutError:
+        kill_process_group(process)
+        await process.wait()
+        raise ProcessTimeout('Timeout exceeded for command "%s"' % (cmd,))
+    except asyncio.CancelledError:
+        kill_process_group(process)
+        await process.wait()
+        raise
+
+    return (b''.join(collected['stdout']),
+            b''.join(collected['stderr']),
+            process.returncode)
+
+async def aiter_chunks(data: (bytes, object),
+                       ):
+    '''
+    Yields the chunks of data: bytes, or a sync or async iterable of
+    chunks. Sync iterators (ie. files read as they are sent) are advanced
+    in a worker thread, so their disk reads never hold up the loop and
+    with it every other host's processes.
+    '''
+    if isinstance(data, bytes):
+        yield data
+    elif isinstance(data, (list, tuple)):
+        for chunk in data:
+            yield chunk
+    elif hasattr(data, '__aiter__'):
+        async for chunk in data:
+            yield chunk
+    else:
+        loop = asyncio.get_running_loop()
+        chunks = iter(data)
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+async def _feed(stream: asyncio.StreamWriter,
+                data: (bytes, object),
+                ):
+    '''
+    Writes data (bytes, or a sync or async iterable of chunks) to a
+    process's stdin and closes it. Chunks are only produced as the process
+    keeps up.
+    '''
+    try:
+        async for chunk in aiter_chunks(data):
+            stream.write(chunk)
+            await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+
+async def _pump(stream: asyncio.StreamReader,
+                onLine,
+                collected: list,
+                ):
+    '''
+    Reads a process stream until EOF, either passing it on line by line
+    (onLine) or collecting it.
+    '''
+    splitter = LineSplitter(onLine) if onLine else None
+    while True:
+        chunk = await stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        if splitter:
+            splitter.feed(chunk)
+        else:
+            collected.append(chunk)
+    if splitter:
+        splitter.close()
@@ -0,0 +1,126 @@
+'''
+Module used to keep artifacts (installFile sources and local .debs) in a
+content addressed store on remote hosts, so a file is sent to a host at
+most once however often it is deployed.
+'''
+
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+
+from easy_deploy.util.constants import DEFAULT_REMOTE_ARTIFACT_DIR
+from easy_deploy.util.debfile import is_local_deb
+
+# Extracts an archive of artifacts (named by sha256) from stdin into the
+# artifact dir ($1). Every artifact's checksum is verified in a private
+# dir first, so the store never holds a partial or corrupt artifact.
+REMOTE_ARTIFACT_RECEIVE_SCRIPT = '''
+mkdir -p -m 0700 -- "$1" || exit 1
+dir=$(mktemp -d "$1/.incoming-XXXXXX") || exit 1
+trap 'rm -rf -- "$dir"' EXIT
+tar -x --no-same-owner -f - -C "$dir" || exit 1
+for f in "$dir"/*; do
+  [ -f "$f" ] || continue
+  sum=$(sha256sum < "$f" | cut -d' ' -f1)
+  if [ "$sum" != "${f##*/}" ]; then
+    echo "checksum mismatch: ${f##*/}" >&2
+    exit 1
+  fi
+done
+for f in "$dir"/*; do
+  [ -f "$f" ] && mv -f -- "$f" "$1/"
+done
+exit 0
+'''
+
+MAX_CACHED_DIGESTS = 4096 # Files whose digest is kept, least recently used go
+
+# (path, size, mtime) -> sha256 hex digest
+_digests = OrderedDict()
+_digestLock = threading.Lock()
+
+def file_digest(path: str,
+                ) -> str:
+    '''
+    Returns the sha256 hex digest of a local file. Digests are kept until
+    the file changes (for the last MAX_CACHED_DIGESTS files used), so
+    every host's Runner shares them.
+    '''
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _digestLock:
+        digest = _digests.get(key)
+        if digest is not None:
+            _digests.move_to_end(key)
+            return digest
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    with _digestLock:
+        _digests[key] = digest
+        if len(_digests) > MAX_CACHED_DIGESTS:
+            _digests.popitem(last=False)
+    return digest
+
+def artifact_path(digest: str,
+                  ) -> str:
+    '''
+    Returns where an artifact is kept on remote hosts.
+    '''
+    return '%s/%s' % (DEFAULT_REMOTE_ARTIFACT_DIR, digest)
+
+def collect_artifacts(runlist: list,
+                      fileDir: str,
+                      ) -> dict:
+    '''
+    Args:
+      runlist::list(dict)
+        Built runlist to collect artifacts from
+      fileDir::str
+        Directory local sources are relative to
+
+    Returns::dict
+      sha256 -> local path of every installFile source and local .deb
+    '''
+    artifacts = {}
+    for step in runlist:
+        if step.get('command') == 'installFile':
+            localPath = '%s/%s' % (fileDir, step.get('localSource'))
+        elif is_local_deb(step):
+            localPath = '%s/%s' % (fileDir, step.get('source'))
+        else:
+            continue
+        artifacts[file_digest(localPath)] = localPath
+    return artifacts
+
+async def asend_artifacts(connection,
+                          artifacts: dict,
+                          step: str=None,
+                          ) -> bool:
+    '''
+    Sends artifacts from the local host into a host's artifact store, in
+    one transfer.
+
+    Args:
+      connection::Connection
+        Connection of the host
+      artifacts::dict
+        sha256 -> local path of each artifact to send
+      step::str (Optional)
+        Name of the step the transfer is for, used to tag its output
+
+    Returns::bool
+      True if every artifact arrived intact
+    '''
+    members = [(localPath, digest, 0o644, '', '')
+               for digest, localPath in sorted(artifacts.items())]
+    return await connection.astream_tar_to_remote_host(
+        members,
+        ['sh', '-c', REMOTE_ARTIFACT_RECEIVE_SCRIPT, 'sh',
+         DEFAULT_REMOTE_ARTIFACT_DIR],
+        step=step)
@@ -0,0 +1,106 @@
+'''
+Module used to submit deploy jobs to the deploy daemon (see
+daemon.DeployDaemon) and follow their progress. It only needs the
+standard library, so submitting a job starts quickly.
+
+Messages are JSON objects, one per line. The client sends a single
+request, {"op": "deploy", "options": {...}} holding the arguments of a
+Deployment, and reads events until "done":
+  queued  {"job": 1, "waitingFor": [...]}
+          The job waits for hosts another job is deploying to
+  log     {"level": "INFO", "levelno": 20, "host": ..., "step": ...,
+           "message": ...}
+          A record logged for the job
+  done    {"job": 1, "results": {host: true/false}}
+  error   {"message": ...}
+          The request was refused
+'''
+
+import json
+import os
+import socket
+
+class DaemonError(Exception):
+    ''' Raised if the daemon can not be reached or refused a job '''
+
+def send_message(stream,
+                 message: dict,
+                 ):
+    '''
+    Writes a message to a (binary) socket stream.
+    '''
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+
+def read_message(stream,
+                 ) -> dict:
+    '''
+    Reads a message from a (binary) socket stream.
+
+    Returns::dict
+      The message, None once the stream is closed
+
+    Raises:
+      DaemonError
+        If the line read is not a message
+    '''
+    line = stream.readline()
+    if not line:
+        return None
+    try:
+        message = json.loads(line)
+    except ValueError as e:
+        raise DaemonError('Malformed message: %s' % e)
+    if not isinstance(message, dict):
+        raise DaemonError('Malformed message: %r' % line)
+    return message
+
+def submit_job(socketPath: str,
+               options: dict,
+               onEvent=None,
+               ) -> dict:
+    '''
+    Submits a deploy job to the daemon and waits for it to finish.
+
+    Paths in options are used by the daemon as they are, so they should
+    be absolute.
+
+    Args:
+      socketPath::str
+        Socket the daemon listens on
+      options::dict
+        Arguments of the Deployment to run (see run.Deployment)
+      onEvent::function (Optional)
+        Called with every event of the job (see module docstring), ie. to
+        show its records
+
+    Returns::dict
+      Mapping of hostname to True/False based on success of its run
+
+    Raises:
+      DaemonError
+        If the daemon can not be reached, refuses the job or goes away
+        before the job is done
+    '''
+    path = os.path.expanduser(socketPath)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except OSError as e:
+            raise DaemonError('Unable to reach daemon at %s: %s' % (path, e))
+        with sock.makefile('rwb') as stream:
+            send_message(stream, {'op': 'deploy', 'options': options})
+            while True:
+                event = read_message(stream)
+                if event is None:
+                    raise DaemonError('Daemon closed the connection before '
+                                      'the job was done')
+                if event.get('event') == 'error':
+                    raise DaemonError(event.get('message'))
+                if onEvent:
+                    onEvent(event)
+                if event.get('event') == 'done':
+                    return event.get('results', {})
+    finally:
+        sock.close()
@@ -3,18 +3,102 @@ Module is used to run set defined commands for easy_deploy
 '''
 
 
-import grp
 import logging
 import os
-import pwd
-import shutil
-import sys
+import uuid
 
+from collections import Counter
 from time import time
 
+from easy_deploy.util.aio import run_sync
+from easy_deploy.util.artifacts import (artifact_path,
+                                        asend_artifacts,
+                                        file_digest,
+                                        )
 from easy_deploy.util.connection import Connection
-from easy_deploy.util.constants import (DEFAULT_BUILD_DIR,
-                                       DEFAULT_FILE_DIRNAME)
+from easy_deploy.util.constants import (COMPRESSED_SUFFIXES,
+                                       DEFAULT_COMPRESS_MIN_KB,
+                                       DEFAULT_FILE_DIRNAME,
+                                       DEFAULT_LARGE_FILE_MB,
+                                       DEFAULT_REMOTE_ARTIFACT_DIR,
+                                       DEFAULT_REMOTE_BUILD_DIR)
+from easy_deploy.util.debfile import deb_info, is_local_deb
+from easy_deploy.util.facts import (PACKAGE_CHANGED_FACTS,
+                                    REMOTE_FACTS_SCRIPT,
+                                    FactCache,
+                                    parse_facts,
+                                    )
+from easy_deploy.util.tarstream import iter_file
+
+DPKG_RESULT_MARKER = 'EASY_DEPLOY_DPKG'
+INSTALLED_MARKER = 'EASY_DEPLOY_INSTALLED'
+
+# Installs all .debs given, then reports per .deb if its version is installed
+REMOTE_DPKG_INSTALL_SCRIPT = '''
+dpkg -i "$@"
+rc=$?
+for deb in "$@"; do
+  pkg=$(dpkg-deb -f "$deb" Package 2>/dev/null)
+  ver=$(dpkg-deb -f "$deb" Version 2>/dev/null)
+  st=$(dpkg-query -W -f='${Status} ${Version}' "$pkg" 2>/dev/null)
+  if [ -n "$pkg" ] && [ "$st" = "install ok installed $ver" ]; then
+    printf '%%s\\tok\\t%%s\\n' %(marker)s "$deb"
+  else
+    printf '%%s\\tfail\\t%%s\\n' %(marker)s "$deb"
+  fi
+done
+exit $rc
+''' % {'marker': DPKG_RESULT_MARKER}
+
+# Removes all packages given, then reports per package if it is gone
+REMOTE_DPKG_REMOVE_SCRIPT = '''
+dpkg -r "$@"
+rc=$?
+for pkg in "$@"; do
+  st=$(dpkg-query -W -f='${Status}' "$pkg" 2>/dev/null)
+  case "$st" in
+    ""|*" not-installed"|*" config-files")
+      printf '%%s\\tok\\t%%s\\n' %(marker)s "$pkg" ;;
+    *)
+      printf '%%s\\tfail\\t%%s\\n' %(marker)s "$pkg" ;;
+  esac
+done
+exit $rc
+''' % {'marker': DPKG_RESULT_MARKER}
+
+# Problem reported by preflight for each kind of check that fails
+PREFLIGHT_PROBLEMS = {'deb': 'package file missing',
+                      'group': 'unknown group',
+                      'service': 'unknown service',
+                      'user': 'unknown user',
+                      }
+
+# Extracts a single file archive from stdin next to its target ($1) and
+# renames it into place, so the target is never left half written
+REMOTE_TAR_INSTALL_SCRIPT = '''
+target=$1
+dir=$(mktemp -d "${target%/*}/.easy_deploy-XXXXXX") || exit 1
+tar -x -p --same-owner -f - -C "$dir" && mv -f -- "$dir/file" "$target"
+rc=$?
+rm -rf -- "$dir"
+exit $rc
+'''
+
+# Extracts an archive from stdin into a new private staging dir ($1)
+REMOTE_TAR_STAGE_SCRIPT = '''
+mkdir -p -m 0700 -- "$1" && tar -x --no-same-owner -f - -C "$1"
+'''
+
+# Installs staged files in place, given as owner, group, mode, staged copy
+# and target path for each file. Reports each file installed, stopping at
+# the first that fails.
+REMOTE_STAGED_INSTALL_SCRIPT = '''
+while [ $# -ge 5 ]; do
+  install -o "$1" -g "$2" -m "$3" "$4" "$5" || exit 1
+  printf '%%s\\t%%s\\n' %(marker)s "$5"
+  shift 5
+done
+''' % {'marker': INSTALLED_MARKER}
 
 
 class Runner:
@@ -23,6 +107,10 @@ class Runner:
                  hostname: str,
                  identity: str,
                  username: str,
+                 connection: Connection=None,
+                 largeFileBytes: int=DEFAULT_LARGE_FILE_MB * 1024 * 1024,
+                 compress: str='auto',
+                 facts: FactCache=None,
                  ):
         '''
         Args:
@@ -34,43 +122,625 @@ class Runner:
             Path of identity file for authenticating with host
           username::str
             Username to authenticate as
+          connection::Connection (Optional)
+            Connection to send all remote work through. One is created
+            from hostname/identity/username if not given.
+          largeFileBytes::int (Optional)
+            Files at least this big are sent resumably and by delta
+            against the existing remote file instead of as archives
+          compress::str (Optional)
+            Compression of large files on the wire. Available: (auto,
+            always, never). auto compresses files big enough to gain from
+            it that are not compressed already.
+          facts::FactCache (Optional)
+            Facts of the host known from earlier runs, and kept up to date
+            with what this run changes. Facts are kept for this run only
+            if not given.
         '''
         self.baseDir = baseDir
         self.fileDir = '%s/%s' % (baseDir, DEFAULT_FILE_DIRNAME)
         self.identity = identity
         self.hostname = hostname
         self.username = username
-        self.connection = Connection(hostname=hostname,
-                                     identityFile=identity,
-                                     username=username,
-                                     )
+        self.connection = connection or Connection(hostname=hostname,
+                                                   identityFile=identity,
+                                                   username=username,
+                                                   )
+        self.largeFileBytes = largeFileBytes
+        self.compress = compress
+        self.facts = facts or FactCache()
         self.logger = logging.getLogger()
-        self.build_dir_path = '%s/%s' % (DEFAULT_BUILD_DIR,
-                                         str(time()).split('.')[0])
-        self._create_build_dir()
+        self.remote_stage_dir_path = None
+        self.staged = {} # remoteSource -> localSource of shipped files
+        self.remoteState = None # remoteSource -> (sha256, mode, owner, group)
+        self.packageState = None # package -> installed version
+        self.storedArtifacts = set() # sha256s in the remote artifact dir
+
+    def gather_facts(self,
+                     runlist: list,
+                     files: bool=True,
+                     checks: bool=False,
+                     ) -> bool:
+        '''
+        Gathers the facts (see facts) the runlist needs in a single remote
+        call, asking the host only for those the fact cache does not hold,
+        and sets the known state of files, packages and artifacts from
+        them.
+
+        Args:
+          runlist::list(dict)
+            Built runlist to collect facts for
+          files::bool (Optional)
+            Gather the state of installFile targets (see is_unchanged)
+          checks::bool (Optional)
+            Also gather the facts preflight checks against
+
+        Returns::bool
+          True if the facts were gathered, False if the remote call failed
+          (no file or package is then treated as current)
+        '''
+        keys = self._fact_keys(runlist, files, checks)
+        known = self.facts.lookup(keys)
+        missing = [key for key in keys if key not in known]
+        if missing:
+            args = []
+            for key in missing:
+                args += key.split(':', 1)
+            cmd = ['sh', '-c', REMOTE_FACTS_SCRIPT, 'sh',
+                   DEFAULT_REMOTE_ARTIFACT_DIR] + args
+            output, returncode = self.connection.run_remote_cmd(
+                cmd,
+                suppressOutput=False,
+                timeout=60 + len(missing),
+                step='gather facts')
+
+            if returncode != 0:
+                err = 'Unable to gather facts from %s' % self.hostname
+                self.logger.warning(err)
+                self.remoteState = None
+                self.packageState = None
+                return False
+
+            gathered = parse_facts(output, missing)
+            self.facts.update(gathered)
+            known.update(gathered)
+
+        msg = '%s: %d facts cached, %d gathered' % (self.hostname,
+                                                   len(keys) - len(missing),
+                                                   len(missing))
+        self.logger.debug(msg)
+
+        def facts_of(kind: str) -> dict:
+            prefix = '%s:' % kind
+            return {key[len(prefix):]: value for key, value in known.items()
+                    if key.startswith(prefix) and value is not None}
+
+        if files:
+            self.remoteState = {path: tuple(state)
+                                for path, state in facts_of('file').items()}
+        self.packageState = facts_of('package')
+        self.storedArtifacts.update(digest for digest, stored
+                                    in facts_of('artifact').items() if stored)
+        return True
+
+    def _fact_keys(self,
+                   runlist: list,
+                   files: bool,
+                   checks: bool,
+                   ) -> list:
+        '''
+        Returns the keys of the facts the runlist needs, see gather_facts.
+        '''
+        keys = []
+        for step in runlist:
+            command = step.get('command')
+            if command == 'installFile':
+                remotePath = step.get('remoteSource')
+                if files:
+                    keys.append('file:%s' % remotePath)
+                if checks:
+                    keys += ['dir:%s' % (os.path.dirname(remotePath) or '/'),
+                             'dir:%s' % DEFAULT_REMOTE_BUILD_DIR,
+                             'user:%s' % step.get('owner'),
+                             'group:%s' % step.get('group'),
+                             ]
+            elif is_local_deb(step):
+                info = self._deb_info(step)
+                keys += ['package:%s' % info.package,
+                         'artifact:%s' % info.sha256,
+                         ]
+            elif checks and command == 'installDebianPackage':
+                keys.append('path:%s' % step.get('source'))
+            if checks:
+                keys += ['service:%s' % service
+                         for service in self._restarts(step)]
+        return list(dict.fromkeys(keys))
+
+    def _restarts(self,
+                  config: dict,
+                  ) -> list:
+        '''
+        Returns the services a step restarts.
+        '''
+        restarts = config.get('restarts', [])
+        if type(restarts) is not list:
+            restarts = [restarts]
+        return restarts
+
+    def record_artifacts(self,
+                         digests: list,
+                         ):
+        '''
+        Records that the remote artifact dir holds artifacts (by sha256),
+        ie. once they were distributed to the host.
+        '''
+        self.storedArtifacts.update(digests)
+        self.facts.update({'artifact:%s' % digest: True
+                           for digest in digests})
+
+    def _forget_artifact(self,
+                         digest: str,
+                         ):
+        '''
+        Stops relying on an artifact the remote artifact dir failed to
+        provide.
+        '''
+        self.storedArtifacts.discard(digest)
+        self.facts.invalidate(['artifact:%s' % digest])
+
+    def is_package_current(self,
+                           config: dict,
+                           ) -> bool:
+        '''
+        Checks if an installDebianPackage step would leave the host as is.
+
+        Args:
+          config::dict
+            installDebianPackage step to check
+
+        Returns::bool
+          True if the step installs a local .deb whose version is already
+          installed
+        '''
+        if self.packageState is None or not is_local_deb(config):
+            return False
+        info = self._deb_info(config)
+        return self.packageState.get(info.package) == info.version
+
+    def _deb_info(self,
+                  config: dict,
+                  ):
+        '''
+        Returns the DebInfo of an installDebianPackage step's local .deb.
+        '''
+        return deb_info(self._local_path(config.get('source')))
 
-    def __del__(self,
-                ):
-        self._delete_build_dir()
+    async def _asend_artifacts(self,
+                               artifacts: dict,
+                               step: str,
+                               ) -> bool:
+        '''
+        Sends the artifacts the remote artifact dir does not hold yet, in
+        one transfer.
+
+        Args:
+          artifacts::dict
+            sha256 -> local path of each artifact needed
+          step::str
+            Name of the step the transfer is for, used to tag its output
+
+        Returns::bool
+          True if every artifact is in the remote artifact dir
+        '''
+        missing = {digest: localPath
+                   for digest, localPath in artifacts.items()
+                   if digest not in self.storedArtifacts}
+        if not missing:
+            return True
+
+        success = await asend_artifacts(self.connection, missing, step=step)
+        if success:
+            self.record_artifacts(missing)
+        return success
+
+    def push_packages(self,
+                      configs: list,
+                      ) -> bool:
+        '''
+        Sends the local .debs of installDebianPackage steps to the remote
+        artifact dir ahead of installing them, in one transfer. Failures
+        are only logged: the install sends them again.
+
+        Args:
+          configs::list(dict)
+            installDebianPackage steps of local .debs
+
+        Returns::bool
+          True if every .deb is in the remote artifact dir
+        '''
+        debs = {self._deb_info(config).sha256:
+                self._local_path(config.get('source')) for config in configs}
+        success = run_sync(self._asend_artifacts(
+            debs, 'push %d packages' % len(debs)))
+        if not success:
+            err = 'Unable to send %d packages to %s ahead of installing '\
+                  'them' % (len(debs), self.hostname)
+            self.logger.warning(err)
+        return success
+
+    def preflight(self,
+                  runlist: list,
+                  staging: bool=True,
+                  files: bool=False,
+                  ) -> list:
+        '''
+        Checks that the host can run the runlist, against facts gathered
+        in one remote call (see gather_facts): installFile target dirs
+        exist, are writable and have room for their files, owners/groups
+        exist, services in `restarts` are known and .debs to install are
+        present.
+
+        Args:
+          runlist::list(dict)
+            Built runlist to collect checks from
+          staging::bool (Optional)
+            Also check the remote staging dir has room for all files
+          files::bool (Optional)
+            Also gather the state of installFile targets in the same call
+
+        Returns::list
+          Problems found, empty list if none
+        '''
+        if not self.gather_facts(runlist, files=files, checks=True):
+            return ['Preflight probe failed']
+        facts = self.facts.lookup(self._fact_keys(runlist,
+                                                  files=False,
+                                                  checks=True))
+
+        dirs = {}
+        stagedSize = 0
+        checks = set()
+        for step in runlist:
+            command = step.get('command')
+            if command == 'installFile':
+                size = os.path.getsize(
+                    self._local_path(step.get('localSource')))
+                target = os.path.dirname(step.get('remoteSource')) or '/'
+                dirs[target] = dirs.get(target, 0) + size
+                if size < self.largeFileBytes:
+                    stagedSize += size
+                checks.add(('user', step.get('owner')))
+                checks.add(('group', step.get('group')))
+            elif command == 'installDebianPackage' \
+                 and not is_local_deb(step):
+                checks.add(('deb', step.get('source')))
+            checks.update(('service', service)
+                          for service in self._restarts(step))
+
+        def space_problem(kind: str, target: str, size: int) -> str:
+            state = facts.get('dir:%s' % target, [True, None])
+            if state is None:
+                return '%s %s: directory missing' % (kind, target)
+            writable, free = state
+            if kind == 'dir' and not writable:
+                return '%s %s: directory not writable' % (kind, target)
+            need = -(-size // 1024)
+            if free is not None and free < need:
+                return '%s %s: needs %dKB, %dKB free' % (kind, target,
+                                                         need, free)
+            return None
+
+        problems = [space_problem('dir', target, size)
+                    for target, size in sorted(dirs.items())]
+        if staging and stagedSize:
+            problems.append(space_problem('space',
+                                          DEFAULT_REMOTE_BUILD_DIR,
+                                          stagedSize))
+        for kind, target in sorted(checks, key=str):
+            key = '%s:%s' % ('path' if kind == 'deb' else kind, target)
+            if facts.get(key) is False:
+                problems.append('%s %s: %s' % (kind,
+                                               target,
+                                               PREFLIGHT_PROBLEMS[kind]))
+        return [problem for problem in problems if problem]
+
+    def is_unchanged(self,
+                     config: dict,
+                     ) -> bool:
+        '''
+        Checks if an installFile step would leave the remote file as is.
+
+        Args:
+          config::dict
+            installFile step to check
+
+        Returns::bool
+          True if content, mode, owner and group already match
+        '''
+        if self.remoteState is None:
+            return False
+        current = self.remoteState.get(config.get('remoteSource'))
+        return current is not None and current == self._desired_state(config)
+
+    def _desired_state(self,
+                       config: dict,
+                       ) -> tuple:
+        '''
+        Returns the (sha256, mode, owner, group) an installFile step
+        leaves its remote file in.
+        '''
+        return (self._local_hash(config.get('localSource')),
+                int(config.get('mode', '0644'), 8),
+                config.get('owner', ''),
+                config.get('group', ''))
+
+    def _local_hash(self,
+                    localName: str,
+                    ) -> str:
+        '''
+        Returns (cached) sha256 hex digest of a file in the file dir.
+        '''
+        return file_digest(self._local_path(localName))
+
+    def _local_path(self,
+                    localName: str,
+                    ) -> str:
+        return '%s/%s' % (self.fileDir, localName)
+
+    def is_large(self,
+                 config: dict,
+                 ) -> bool:
+        '''
+        Checks if an installFile step's file is sent by send_file rather
+        than as an archive.
+        '''
+        localPath = self._local_path(config.get('localSource'))
+        return os.path.getsize(localPath) >= self.largeFileBytes
+
+    def _should_compress(self,
+                         localPath: str,
+                         ) -> bool:
+        '''
+        Decides if a file is compressed on the wire (see compress).
+        '''
+        if self.compress in ('always', 'never'):
+            return self.compress == 'always'
+        return os.path.getsize(localPath) >= DEFAULT_COMPRESS_MIN_KB * 1024 \
+            and not localPath.lower().endswith(COMPRESSED_SUFFIXES)
 
-    def _create_build_dir(self,
+    def _record_installed(self,
+                          config: dict,
                           ):
         '''
-        Creates the temporary build dir for building files
+        Updates the known remote state after a file was installed so
+        later steps (and runs) targeting the same path compare against it.
+        '''
+        remotePath = config.get('remoteSource')
+        state = self._desired_state(config)
+        if self.remoteState is not None:
+            self.remoteState[remotePath] = state
+        self.facts.update({'file:%s' % remotePath: list(state)})
+        self.facts.invalidate(['dir:%s' % (os.path.dirname(remotePath)
+                                           or '/')])
+
+    def stage_files(self,
+                    runlist: list,
+                    ) -> bool:
+        '''
+        Ships the files of every installFile step in one bulk transfer.
+
+        The files are streamed straight from the file dir, as one tar
+        archive mirroring their remote layout, into a private remote
+        staging dir. The steps are then finalized (put in place with
+        their owner, group and mode) when the runlist reaches them,
+        adjacent ones by a single remote command (see
+        install_staged_files), so step ordering is unchanged. Steps whose
+        remoteSource is targeted more than once, and large files, are
+        left to the per-file path, and files the remote artifact dir
+        holds are skipped.
+
+        Args:
+          runlist::list(dict)
+            Built runlist to stage installFile steps from
+
+        Returns::bool
+          True if the files were shipped, False if the bulk transfer
+          failed (all steps then fall back to the per-file path)
+        '''
+        steps = [step for step in runlist
+                 if step.get('command') == 'installFile'
+                 and not self.is_unchanged(step)
+                 and not self.is_large(step)
+                 and self._local_hash(step.get('localSource'))
+                     not in self.storedArtifacts]
+        targets = Counter(step.get('remoteSource') for step in steps)
+        stageable = {}
+        for step in steps:
+            remotePath = step.get('remoteSource')
+            if targets[remotePath] == 1:
+                stageable[remotePath] = step.get('localSource')
+
+        if not stageable:
+            return True
+
+        members = [(self._local_path(localName),
+                    remotePath.lstrip('/'),
+                    0o600, '', '')
+                   for remotePath, localName in stageable.items()]
+
+        remoteStageDir = '%s/easy_deploy-stage-%s' % (DEFAULT_REMOTE_BUILD_DIR,
+                                                      uuid.uuid4().hex)
+        startTime = time()
+        success = self.connection.stream_tar_to_remote_host(
+            members,
+            ['sh', '-c', REMOTE_TAR_STAGE_SCRIPT, 'sh', remoteStageDir],
+            step='bulk transfer')
+
+        if not success:
+            err = 'Bulk transfer of %d files to %s failed, falling back '\
+                  'to per-file transfers' % (len(members), self.hostname)
+            self.logger.warning(err)
+            self.connection.run_remote_cmd(['rm', '-rf', remoteStageDir])
+            return False
+
+        msg = 'Shipped %d files to %s in %.2fs' % (len(members),
+                                                   self.hostname,
+                                                   time() - startTime)
+        self.logger.info(msg)
+        self.remote_stage_dir_path = remoteStageDir
+        self.staged = stageable
+        return True
+
+    def is_staged(self,
+                  config: dict,
+                  ) -> bool:
+        '''
+        Checks if an installFile step's file was shipped by stage_files.
+        '''
+        return self.staged.get(config.get('remoteSource')) == \
+               config.get('localSource')
+
+    def install_staged_files(self,
+                             configs: list,
+                             ) -> list:
+        '''
+        Puts files shipped by stage_files in place, with their owner,
+        group and mode, in a single remote command. Files are installed
+        in order, stopping at the first that fails.
+
+        Args:
+          configs::list(dict)
+            installFile steps whose files were staged (see is_staged)
+
+        Returns::list(bool)
+          True/False status of success for each config, in order
+        '''
+        args = []
+        for config in configs:
+            remotePath = config.get('remoteSource')
+            args += [config.get('owner', ''),
+                     config.get('group', ''),
+                     config.get('mode', '0644'),
+                     '%s/%s' % (self.remote_stage_dir_path,
+                                remotePath.lstrip('/')),
+                     remotePath,
+                     ]
+        output, _ = self.connection.run_remote_cmd(
+            ['sh', '-c', REMOTE_STAGED_INSTALL_SCRIPT, 'sh'] + args,
+            suppressOutput=False,
+            timeout=30 + len(configs),
+            step='installFile %d staged files' % len(configs))
+
+        installed = set()
+        for line in output.splitlines():
+            marker, _, remotePath = line.partition('\t')
+            if marker == INSTALLED_MARKER:
+                installed.add(remotePath)
+
+        results = []
+        for config in configs:
+            remotePath = config.get('remoteSource')
+            filename = remotePath.split('/')[-1]
+            if remotePath in installed:
+                msg = 'Successfully installed file: %s' % filename
+                self.logger.info(msg)
+                self._record_installed(config)
+                results.append(True)
+                continue
+            # Files after the one that failed were not tried
+            if all(results):
+                err = 'Unable to install file: %s' % filename
+                self.logger.error(err)
+            self.facts.invalidate(['file:%s' % remotePath])
+            results.append(False)
+        return results
+
+    def cleanup_staged_files(self,
+                             ):
+        '''
+        Removes the remote staging dir left by stage_files.
         '''
-        try:
-            os.makedirs(self.build_dir_path)
-        except OSError:
-            err = 'Unable to make build dir. Exiting.'
+        if self.remote_stage_dir_path:
+            self.connection.run_remote_cmd(['rm', '-rf',
+                                            self.remote_stage_dir_path])
+            self.remote_stage_dir_path = None
+            self.staged = {}
+
+    def _install_remote_copy(self,
+                             config: dict,
+                             sourcePath: str,
+                             ) -> bool:
+        '''
+        Puts a copy of a file already on the remote host in place.
+
+        Args:
+          config::dict
+            installFile step whose file was shipped by stage_files, or is
+            in the remote artifact dir
+          sourcePath::str
+            Remote path of the copy
+
+        Returns::bool
+          True if successfully installed file, False if not
+        '''
+        fileRemotePath = config.get('remoteSource')
+        filename = fileRemotePath.split('/')[-1]
+        success = self._agent_install(config, source=sourcePath)
+        if success is None:
+            cmd = ['install',
+                   '-o', config.get('owner', ''),
+                   '-g', config.get('group', ''),
+                   '-m', config.get('mode', '0644'),
+                   sourcePath,
+                   fileRemotePath,
+                   ]
+            _, returncode = self.connection.run_remote_cmd(
+                cmd,
+                step='installFile %s' % fileRemotePath)
+            success = returncode == 0
+
+        if not success:
+            err = 'Unable to install file: %s' % filename
             self.logger.error(err)
-            sys.exit(-1)            
+            self.facts.invalidate(['file:%s' % fileRemotePath])
+            return False
 
-    def _delete_build_dir(self,
-                          ):
+        msg = 'Successfully installed file: %s' % filename
+        self.logger.info(msg)
+        self._record_installed(config)
+        return True
+
+    def _agent_install(self,
+                       config: dict,
+                       source: str=None,
+                       localPath: str=None,
+                       ) -> bool:
         '''
-        Deletes the build directory
+        Has the agent install an installFile step's file, from a copy on
+        the remote host (source) or sent from a local file (localPath).
+
+        Returns::bool
+          True/False of success, None if not in agent mode
         '''
-        shutil.rmtree(self.build_dir_path)
+        remotePath = config.get('remoteSource')
+        size = os.path.getsize(localPath) if localPath else 0
+        fields = {'path': remotePath,
+                  'mode': config.get('mode', '0644'),
+                  'owner': config.get('owner', ''),
+                  'group': config.get('group', ''),
+                  }
+        if source:
+            fields['source'] = source
+        result = self.connection.agent_request(
+            'install',
+            fields,
+            data=iter_file(localPath) if localPath else None,
+            size=size,
+            step='installFile %s' % remotePath,
+            timeout=self.connection.transfer_timeout(size))
+        if result is None:
+            return None
+        return 'error' not in result
 
     def debianPackage(self,
                       config: dict,
@@ -88,24 +758,104 @@ class Runner:
         Returns::bool
           True/False status of success
         '''
+        return self.debianPackages([config], action)[0]
+
+    def debianPackages(self,
+                       configs: list,
+                       action: str,
+                       ) -> list:
+        '''
+        Installs/Removes several debian packages in a single dpkg
+        transaction. See adebianPackages.
+        '''
+        return run_sync(self.adebianPackages(configs, action))
+
+    async def adebianPackages(self,
+                              configs: list,
+                              action: str,
+                              ) -> list:
+        '''
+        Installs/Removes several debian packages on the remote host in a
+        single dpkg transaction.
+
+        The package state is checked afterwards so success is reported
+        per package even if dpkg fails part way.
+
+        Local .debs (see is_local_deb) are first sent to the remote
+        artifact dir, unless an identical .deb is already there, and
+        installed from it.
+
+        Args:
+          configs::list(dict)
+            Configurations specifying each package source
+          action::str
+            Action to perform. Available: (install, remove)
+
+        Returns::list(bool)
+          True/False status of success for each config, in order
+        '''
         if action == 'install':
-            flag = 'i'
+            script = REMOTE_DPKG_INSTALL_SCRIPT
         elif action == 'remove':
-            flag = 'r'
+            script = REMOTE_DPKG_REMOVE_SCRIPT
         else:
             err = 'debianPackage: %s action specified, allowed actions '\
                   'are (install, remove)' % (action)
             self.logger.error(err)
-            return False
+            return [False] * len(configs)
 
-        package = config.get('source')
-        cmd = 'ssh -i %s %s@%s "dpkg -%s %s"' % (self.identity,
-                                                 self.username,
-                                                 self.hostname,
-                                                 flag,
-                                                 package)
-        returnCode = os.system(cmd)
-        return returnCode == 0
+        local = [config for config in configs if is_local_deb(config)] \
+                if action == 'install' else []
+        localIds = {id(config) for config in local}
+        debs = {self._deb_info(config).sha256:
+                self._local_path(config.get('source')) for config in local}
+        if debs and not await self._asend_artifacts(
+                debs, 'push %d packages' % len(debs)):
+            err = 'Unable to send %d packages to %s' % (len(local),
+                                                       self.hostname)
+            self.logger.error(err)
+            return [False] * len(configs)
+
+        packages = [artifact_path(self._deb_info(config).sha256)
+                    if id(config) in localIds
+                    else config.get('source') for config in configs]
+        cmd = ['sh', '-c', script, 'sh'] + packages
+        succeeded = set()
+
+        def on_line(line: str):
+            fields = line.split('\t')
+            if len(fields) == 3 and fields[0] == DPKG_RESULT_MARKER \
+               and fields[1] == 'ok':
+                succeeded.add(fields[2])
+
+        await self.connection.arun_remote_cmd(
+            cmd,
+            timeout=None,
+            step='%s %d packages' % (action, len(packages)),
+            onStdoutLine=on_line)
+        # Maintainer scripts may change anything, even when dpkg failed
+        self.facts.invalidate(kinds=PACKAGE_CHANGED_FACTS)
+
+        results = []
+        for config, package in zip(configs, packages):
+            success = package in succeeded
+            if not success:
+                err = 'Unable to %s package: %s' % (action,
+                                                    config.get('source'))
+                self.logger.error(err)
+                if id(config) in localIds:
+                    self._forget_artifact(self._deb_info(config).sha256)
+            elif id(config) in localIds:
+                info = self._deb_info(config)
+                if self.packageState is not None:
+                    self.packageState[info.package] = info.version
+                self.facts.update({'package:%s' % info.package: info.version})
+            elif action == 'remove':
+                if self.packageState is not None:
+                    self.packageState.pop(package, None)
+                self.facts.update({'package:%s' % package: None})
+            results.append(success)
+        return results
 
     def installFile(self,
                     config: dict,
@@ -113,6 +863,15 @@ class Runner:
         '''
         Install a file onto the remote host.
 
+        The file is streamed straight from the file dir and its owner,
+        group and mode are applied on the remote host as it is unpacked
+        (owner and group are names on the remote host). In agent mode the
+        agent writes the file itself, without tar. Large files are
+        sent with Connection.send_file instead, which resumes interrupted
+        transfers and only sends what differs from the current remote
+        file. Files already shipped by stage_files, or held by the remote
+        artifact dir (see Distributor), are copied into place remotely.
+
         Args:
           config::dict
             Dictionary containing the following keys:
@@ -125,68 +884,51 @@ class Runner:
         Returns::bool
           True if successfully installed file, False if not
         '''
-        def get_uid(user: str) -> int:
-            '''
-            Returns UID (if found) for the associated user.
-            '''
-            uid = 0
-            try:
-                uid = pwd.getpwnam(user).pw_uid
-            except KeyError:
-                err = 'Error with %s: User "%s" not found' % (config, user)
-                self.logger.error(err)
-                sys.exit(-1)
-            return uid
-
-        def get_gid(group: str) -> int:
-            '''
-            Returns GUID (if found) for the associated user.
-            '''
-            gid = 0
-            try:
-                gid = grp.getgrnam(group).gr_gid
-            except KeyError:
-                err = 'Error with %s: Group "%s" not found' % (config, group)
-                self.logger.error(err)
-                sys.exit(-1)
-            return gid
+        remotePath = config.get('remoteSource')
+        if self.is_staged(config):
+            return self._install_remote_copy(
+                config,
+                '%s/%s' % (self.remote_stage_dir_path, remotePath.lstrip('/')))
+        digest = self._local_hash(config.get('localSource'))
+        if digest in self.storedArtifacts:
+            success = self._install_remote_copy(config, artifact_path(digest))
+            if not success:
+                self._forget_artifact(digest)
+            return success
 
-        ownerName = config.get('owner', '')
-        groupName = config.get('group', '')
-        mode = config.get('mode', '0644')
-        fileLocalname = config.get('localSource')
-        fileRemotePath = config.get('remoteSource')
-        fileLocalPath = '%s/%s' % (self.fileDir, fileLocalname)
-
-        ownerUid = get_uid(ownerName)
-        groupUid = get_gid(groupName)
-        modeOct = mode[0] + 'o' + mode[1:]
-        filename = fileRemotePath.split('/')[-1]
-
-        # Build remote directory
-        fileRemoteDirList = fileRemotePath.split('/')
-        fileRemoteDir = '/'.join(fileRemoteDirList[:len(fileRemoteDirList)-1])
-        
-        baseFileLoc = '%s/%s' % (self.build_dir_path, filename)
-
-        # Copy file to build dir
-        shutil.copyfile(fileLocalPath, baseFileLoc)
-
-        # Change permissions, owner, group
-        os.chown(baseFileLoc, ownerUid, groupUid)
-        os.chmod(baseFileLoc, int(modeOct, 8))
-
-        # Copy to remote host
-        success = self.connection.copy_file_to_remote_host(baseFileLoc,
-                                                           fileRemoteDir)
+        filename = remotePath.split('/')[-1]
+        localPath = self._local_path(config.get('localSource'))
+        if self.is_large(config):
+            success = self.connection.send_file(
+                localPath,
+                remotePath,
+                config.get('mode', '0644'),
+                config.get('owner', ''),
+                config.get('group', ''),
+                compress=self._should_compress(localPath),
+                step='installFile %s' % remotePath)
+        else:
+            success = self._agent_install(config, localPath=localPath)
+        if success is None:
+            member = (localPath,
+                      'file',
+                      int(config.get('mode', '0644'), 8),
+                      config.get('owner', ''),
+                      config.get('group', ''))
+            success = self.connection.stream_tar_to_remote_host(
+                [member],
+                ['sh', '-c', REMOTE_TAR_INSTALL_SCRIPT, 'sh', remotePath],
+                step='installFile %s' % remotePath)
 
         if not success:
             err = 'Unable to install file: %s' % filename
             self.logger.error(err)
+            self.facts.invalidate(['file:%s' % remotePath])
             return False
-            
+
         msg = 'Successfully installed file: %s' % filename
         self.logger.info(msg)
+        self._record_installed(config)
 
         return True
 
@@ -196,9 +938,16 @@ class Runner:
         '''
         Restart a service on the remote host.
         '''
-        cmd = 'ssh -i %s %s@%s "service %s restart"' % (self.identity,
-                                                        self.username,
-                                                        self.hostname,
-                                                        service)
-        returncode = os.system(cmd)
+        return run_sync(self.arestart_service(service))
+
+    async def arestart_service(self,
+                               service: str,
+                               ) -> bool:
+        '''
+        Restart a service on the remote host.
+        '''
+        _, returncode = await self.connection.arun_remote_cmd(
+            ['service', service, 'restart'],
+            timeout=None,
+            step='restart %s' % service)
         return returncode == 0
@@ -2,7 +2,14 @@
 This file specifies all requirements for each easy_deploy config command
 '''
 
+# Bump when the meaning of a compiled runlist changes without COMMANDS
+# changing, so cached runlists (see runlist_cache) are rebuilt
+SCHEMA_VERSION = 3
+
 COMMANDS = {
+    'flushRestarts': {
+        'mandatory': [],
+    },
     'installDebianPackage': {
         'mandatory': ['source'],
     },
@@ -19,4 +26,4 @@ COMMANDS = {
     },
 }
 
-UNIVERSAL_OPTIONS = ['command', 'restarts']
+UNIVERSAL_OPTIONS = ['after', 'command', 'id', 'restarts']
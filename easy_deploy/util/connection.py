@@ -2,23 +2,57 @@
 Module for handling all connections with remote hosts.
 '''
 
+import asyncio
+import atexit
 import logging
-import subprocess
+import os
+import shlex
+import shutil
+import tempfile
+import threading
 
 from functools import wraps
+from time import perf_counter, time
+
+from easy_deploy.util.agent import Agent, AgentError
+from easy_deploy.util.aio import (aiter_chunks,
+                                  ProcessTimeout,
+                                  run_process,
+                                  run_sync,
+                                  )
+from easy_deploy.util.output import RingBuffer
+from easy_deploy.util.report import record_phase
+from easy_deploy.util.tarstream import iter_tar, TarStreamError
+from easy_deploy.util.constants import (DEFAULT_BANDWIDTH_LIMIT_KB,
+                                        DEFAULT_OUTPUT_BUFFER_KB,
+                                        DEFAULT_SSH_CONNECT_TIMEOUT,
+                                        DEFAULT_SSH_CONTROL_PERSIST,
+                                        DEFAULT_SSH_KEEPALIVE_COUNT,
+                                        DEFAULT_SSH_KEEPALIVE_INTERVAL,
+                                        DEFAULT_TRANSFER_MIN_RATE_KB,
+                                        DEFAULT_TRANSFER_RETRIES,
+                                        DEFAULT_TRANSFER_STALL_TIMEOUT,
+                                        RSYNC_PARTIAL_DIR,
+                                        )
 
 
 def singleton(classkey: str):
     '''
     Singleton Decorator
+
+    One instance is kept per unique set of constructor arguments, so
+    each host gets its own instance.
     '''
     def _singleton(cls):
         @wraps(cls)
         def wrapper(*args, **kwargs):
-            if classkey not in wrapper.instances:
-                wrapper.instances[classkey] = cls(*args, **kwargs)
-            return wrapper.instances.get(classkey)
+            key = (classkey, args, tuple(sorted(kwargs.items())))
+            with wrapper.lock:
+                if key not in wrapper.instances:
+                    wrapper.instances[key] = cls(*args, **kwargs)
+                return wrapper.instances.get(key)
         wrapper.instances = {}
+        wrapper.lock = threading.Lock()
         return wrapper
     return _singleton
 
@@ -28,8 +62,27 @@ class Connection:
                  hostname: str,
                  identityFile: str,
                  username: str,
+                 controlPersist: int=DEFAULT_SSH_CONTROL_PERSIST,
+                 keepAliveInterval: int=DEFAULT_SSH_KEEPALIVE_INTERVAL,
+                 outputBufferSize: int=DEFAULT_OUTPUT_BUFFER_KB * 1024,
+                 bandwidthLimitKb: int=DEFAULT_BANDWIDTH_LIMIT_KB,
+                 agent: bool=False,
                  ):
         '''
+        Every command and transfer for the host is multiplexed over a
+        single persistent ssh master session (ControlMaster). The master
+        is started on first use, kept alive with ssh keep-alives, expires
+        after `controlPersist` idle seconds and is torn down at exit.
+
+        In agent mode, remote commands and archive transfers go to an
+        agent (see agent.Agent) started once over the master session,
+        rather than each starting its own ssh session and remote process.
+        If the agent can not be started (ie. the host has no python3)
+        the connection falls back to plain ssh.
+
+        All work is done by the async methods (a-prefixed) on the shared
+        asyncio loop. The synchronous methods are thin wrappers.
+
         Args:
           hostname::str
             Host identifier for connection
@@ -37,17 +90,393 @@ class Connection:
             Path of identity file to use for authentication with host
           username::str
             Username to login as
+          controlPersist::int (Optional)
+            Seconds the master session is kept open while idle
+          keepAliveInterval::int (Optional)
+            Seconds between keep-alive probes on the master session
+          outputBufferSize::int (Optional)
+            Bytes of each command's most recent output kept for error
+            reports
+          bandwidthLimitKb::int (Optional)
+            KB/s each transfer to the host is capped at, 0 for no cap
+          agent::bool (Optional)
+            Run remote work through an agent on the host
         '''
         self.hostname = hostname
         self.identity = identityFile
         self.username = username
+        self.controlPersist = controlPersist
+        self.keepAliveInterval = keepAliveInterval
+        self.outputBufferSize = outputBufferSize
+        self.bandwidthLimitKb = bandwidthLimitKb
+        self.useAgent = agent
         self.logger = logging.getLogger()
+        self._controlDir = None
+        self._masterLock = None # asyncio.Lock, made on the loop when needed
+        self._masterExpires = 0
+        self._agent = None
+        self._agentLock = None # asyncio.Lock, made on the loop when needed
+
+    @property
+    def destination(self,
+                    ) -> str:
+        '''
+        user@host destination string for ssh/rsync.
+        '''
+        return '%s@%s' % (self.username, self.hostname)
+
+    @property
+    def control_path(self,
+                     ) -> str:
+        '''
+        Path of the control socket of the master session.
+
+        %C is expanded by ssh to a hash of the connection parameters which
+        keeps the path short enough for a unix socket.
+        '''
+        if not self._controlDir:
+            self._controlDir = tempfile.mkdtemp(prefix='easy_deploy-ssh-')
+            atexit.register(self.close)
+        return '%s/%%C' % self._controlDir
+
+    def ssh_options(self,
+                    forwardAgent: bool=False,
+                    ) -> list:
+        '''
+        Returns ssh options needed to reuse the master session.
+
+        Args:
+          forwardAgent::bool (Optional)
+            Forward the local ssh agent, so the remote command can ssh on
+            to other hosts
+
+        Returns::list
+          List of ssh arguments (excluding the destination)
+        '''
+        options = ['-o', 'ControlMaster=no',
+                   '-o', 'ControlPath=%s' % self.control_path,
+                   ]
+        if forwardAgent:
+            options += ['-o', 'ForwardAgent=yes']
+        if self.identity:
+            options += ['-i', self.identity]
+        return options
+
+    def ssh_command(self,
+                    remoteCmd: str=None,
+                    forwardAgent: bool=False,
+                    ) -> list:
+        '''
+        Builds an ssh command line that runs over the master session.
+
+        Args:
+          remoteCmd::str (Optional)
+            Command for the remote shell to run
+          forwardAgent::bool (Optional)
+            Forward the local ssh agent (see ssh_options)
+
+        Returns::list
+          Argument list for subprocess
+        '''
+        cmd = ['ssh'] + self.ssh_options(forwardAgent) + [self.destination]
+        if remoteCmd is not None:
+            cmd.append(remoteCmd)
+        return cmd
+
+    def ssh_transport(self,
+                      ) -> str:
+        '''
+        Returns the ssh command as a single string, as used by rsync -e.
+        '''
+        return ' '.join(shlex.quote(arg)
+                        for arg in ['ssh'] + self.ssh_options())
+
+    def transfer_timeout(self,
+                         size: int,
+                         ) -> float:
+        '''
+        Returns seconds to allow for a transfer of `size` bytes, assuming
+        the link (or the bandwidth cap, if lower) is at least
+        DEFAULT_TRANSFER_MIN_RATE_KB fast.
+        '''
+        rateKb = DEFAULT_TRANSFER_MIN_RATE_KB
+        if self.bandwidthLimitKb:
+            rateKb = min(rateKb, self.bandwidthLimitKb)
+        return 60 + size / (rateKb * 1024)
+
+    def rsync_options(self,
+                      ) -> list:
+        '''
+        Returns rsync options shared by all transfers to the host: the
+        ssh transport and the bandwidth cap, if any.
+        '''
+        options = ['-e', self.ssh_transport()]
+        if self.bandwidthLimitKb:
+            options.append('--bwlimit=%d' % self.bandwidthLimitKb)
+        return options
+
+    def open(self,
+             ) -> bool:
+        '''
+        Makes sure the master session for the host is running.
+        See aopen.
+        '''
+        return run_sync(self.aopen())
+
+    async def aopen(self,
+                    ) -> bool:
+        '''
+        Makes sure the master session for the host is running.
+
+        ssh resets the idle timer each time the master is used, so a check
+        is only made once the master could have expired.
+
+        Returns::bool
+          True/False if the master session is usable
+        '''
+        if time() < self._masterExpires:
+            return True
+
+        if self._masterLock is None:
+            self._masterLock = asyncio.Lock()
+
+        startTime = perf_counter()
+        try:
+            return await self._aopen_locked()
+        finally:
+            record_phase('connect', perf_counter() - startTime)
+
+    async def _aopen_locked(self,
+                            ) -> bool:
+        '''
+        Checks for (and if needed starts) the master session under the
+        master lock. See aopen.
+        '''
+        async with self._masterLock:
+            if time() < self._masterExpires:
+                return True
+
+            checkCmd = ['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                        '-O', 'check', self.destination]
+            _, returncode = await self._arun(checkCmd,
+                                             timeout=5,
+                                             logErrors=False)
+
+            if returncode != 0:
+                self.logger.debug('Opening master session to %s'
+                                  % self.hostname)
+                # The master forks into the background, so it must not
+                # inherit our pipes or the call would block until it exits.
+                # Its errors are written to a log file instead (-E).
+                masterLog = '%s/master.log' % self._controlDir
+                masterCmd = ['ssh',
+                             '-E', masterLog,
+                             '-o', 'ControlMaster=yes',
+                             '-o', 'ControlPath=%s' % self.control_path,
+                             '-o', 'ControlPersist=%d' % self.controlPersist,
+                             '-o', 'ServerAliveInterval=%d'
+                                   % self.keepAliveInterval,
+                             '-o', 'ServerAliveCountMax=%d'
+                                   % DEFAULT_SSH_KEEPALIVE_COUNT,
+                             '-o', 'ConnectTimeout=%d'
+                                   % DEFAULT_SSH_CONNECT_TIMEOUT,
+                             '-N', '-f',
+                             ]
+                if self.identity:
+                    masterCmd += ['-i', self.identity]
+                masterCmd.append(self.destination)
+
+                _, returncode = await self._arun(
+                    masterCmd,
+                    timeout=DEFAULT_SSH_CONNECT_TIMEOUT + 5,
+                    captureStderr=False,
+                    logErrors=False)
+
+                if returncode != 0:
+                    err = 'Unable to open master session to %s' % self.hostname
+                    try:
+                        with open(masterLog, 'r') as stream:
+                            err += ': %s' % stream.read().strip()
+                    except OSError:
+                        pass
+                    self.logger.error(err)
+                    self._masterExpires = 0
+                    return False
+
+            self._touch()
+            return True
+
+    def close(self,
+              ):
+        '''
+        Tears down the master session and its control directory.
+        '''
+        run_sync(self.aclose())
+
+    async def aclose(self,
+                     ):
+        '''
+        Tears down the master session and its control directory.
+        '''
+        if self._agent is not None:
+            await self._agent.aclose()
+            self._agent = None
+        if not self._controlDir:
+            return
+        exitCmd = ['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                   '-O', 'exit', self.destination]
+        await self._arun(exitCmd, timeout=5, logErrors=False)
+        shutil.rmtree(self._controlDir, ignore_errors=True)
+        self._controlDir = None
+        self._masterExpires = 0
+        # Registered again along with the next control directory
+        atexit.unregister(self.close)
+
+    def _touch(self,
+               ):
+        '''
+        Records use of the master session, pushing out its idle expiry.
+        '''
+        # Leave a margin so the master is never used as it expires
+        self._masterExpires = time() + max(self.controlPersist - 5, 0)
+
+    async def aagent(self,
+                     ) -> Agent:
+        '''
+        Returns the running agent of the host, starting it if needed.
+
+        Returns::Agent
+          The agent, None if not in agent mode or it can not be started
+          (agent mode is then turned off)
+        '''
+        if not self.useAgent:
+            return None
+        if self._agent is not None and self._agent.alive:
+            return self._agent
+
+        if self._agentLock is None:
+            self._agentLock = asyncio.Lock()
+        async with self._agentLock:
+            if self._agent is not None and self._agent.alive:
+                return self._agent
+            if not self.useAgent or not await self.aopen():
+                return None
+
+            agent = Agent(self)
+            if not await agent.astart():
+                err = '%s: Unable to start agent, running commands over '\
+                      'plain ssh' % self.hostname
+                self.logger.warning(err)
+                self.useAgent = False
+                return None
+            self._agent = agent
+            return agent
+
+    def agent_request(self,
+                      op: str,
+                      fields: dict,
+                      data: (bytes, object)=None,
+                      size: int=0,
+                      step: str=None,
+                      timeout: float=60,
+                      ) -> dict:
+        '''
+        Make an agent request. See aagent_request.
+        '''
+        return run_sync(self.aagent_request(op,
+                                            fields,
+                                            data=data,
+                                            size=size,
+                                            step=step,
+                                            timeout=timeout))
+
+    async def aagent_request(self,
+                             op: str,
+                             fields: dict,
+                             data: (bytes, object)=None,
+                             size: int=0,
+                             step: str=None,
+                             timeout: float=60,
+                             ) -> dict:
+        '''
+        Makes a request of the host's agent (see RemoteAgent for the ops).
+        Failures are logged.
+
+        Args:
+          op::str
+            Operation to run
+          fields::dict
+            Arguments of the operation
+          data::bytes/iterable (Optional)
+            Data (or chunks of data) to stream to the request, paced to
+            the bandwidth cap
+          size::int (Optional)
+            Bytes of data, recorded as transferred
+          step::str (Optional)
+            Name of the step the request is for, used to tag its errors
+          timeout::float (Optional)
+            Seconds to wait for the result (None for no limit)
+
+        Returns::dict
+          The result (has "error" if the request failed), None if not in
+          agent mode, so the caller does the work without the agent
+        '''
+        agent = await self.aagent()
+        if agent is None:
+            return None
+
+        tag = self.hostname if not step else '%s [%s]' % (self.hostname, step)
+        startTime = perf_counter()
+        try:
+            result = await agent.arequest(
+                op,
+                fields,
+                data=self._paced(data) if data is not None else None,
+                timeout=timeout)
+        except AgentError as e:
+            result = {'error': str(e)}
+        record_phase('remoteExec' if data is None else 'transfer',
+                     perf_counter() - startTime,
+                     size)
+        self._touch()
+
+        if 'error' in result:
+            self.logger.error('%s: %s' % (tag, result['error']))
+        return result
+
+    async def _paced(self,
+                     data: (bytes, object),
+                     ):
+        '''
+        Yields data (bytes or an iterable of chunks) no faster than the
+        bandwidth cap allows, if there is one.
+        '''
+        rate = self.bandwidthLimitKb * 1024
+        startTime = perf_counter()
+        sent = 0
+        async for chunk in aiter_chunks(data):
+            yield chunk
+            sent += len(chunk)
+            if rate:
+                delay = sent / rate - (perf_counter() - startTime)
+                if delay > 0:
+                    await asyncio.sleep(delay)
 
     def copy_file_to_remote_host(self,
                                  localSource: str,
                                  remoteSource: str,
                                  ) -> bool:
         '''
+        Copy a local file to a remote location. See acopy_file_to_remote_host.
+        '''
+        return run_sync(self.acopy_file_to_remote_host(localSource,
+                                                       remoteSource))
+
+    async def acopy_file_to_remote_host(self,
+                                        localSource: str,
+                                        remoteSource: str,
+                                        ) -> bool:
+        '''
         Copy a local file to a remote location
 
         Args:
@@ -59,14 +488,178 @@ class Connection:
         Returns::bool
           True/False of copy success
         '''
-        cmd = 'rsync -p -e "ssh -i %s" %s %s@%s:%s/' % (self.identity,
-                                                        localSource,
-                                                        self.username,
-                                                        self.hostname,
-                                                        remoteSource)
-        _, returncode = self.run_cmd(cmd,
-                                    shell=True,
-                                    timeout=60)
+        opened = await self.aopen()
+        size = os.path.getsize(localSource)
+        cmd = ['rsync', '-p'] + self.rsync_options() + [
+               localSource,
+               '%s:%s/' % (self.destination, remoteSource),
+               ]
+        startTime = perf_counter()
+        _, returncode = await self.arun_cmd(cmd,
+                                            timeout=self.transfer_timeout(size))
+        record_phase('transfer', perf_counter() - startTime, size)
+        if opened:
+            self._touch()
+        return returncode == 0
+
+    def stream_tar_to_remote_host(self,
+                                  members: list,
+                                  remoteCmd: list,
+                                  step: str=None,
+                                  ) -> bool:
+        '''
+        Stream local files as a tar archive into a remote command.
+        See astream_tar_to_remote_host.
+        '''
+        return run_sync(self.astream_tar_to_remote_host(members,
+                                                        remoteCmd,
+                                                        step=step))
+
+    async def astream_tar_to_remote_host(self,
+                                         members: list,
+                                         remoteCmd: list,
+                                         step: str=None,
+                                         ) -> bool:
+        '''
+        Stream local files as a tar archive into a remote command (that
+        extracts it), straight from where they are, without local copies.
+
+        Args:
+          members::list(tuple)
+            (localPath, name, mode, owner, group) of each file (see
+            tarstream.iter_tar)
+          remoteCmd::list
+            Remote command reading the archive from stdin
+          step::str (Optional)
+            Name of the step the transfer is for, used to tag its output
+
+        Returns::bool
+          True/False of transfer (and remote command) success
+        '''
+        failures = []
+        size = sum(os.path.getsize(member[0]) for member in members
+                   if os.path.exists(member[0]))
+
+        def chunks():
+            try:
+                yield from iter_tar(members)
+            except (OSError, TarStreamError) as e:
+                # Ending the archive early makes the remote tar fail
+                failures.append(e)
+
+        opened = await self.aopen()
+        agent = await self.aagent()
+        startTime = perf_counter()
+        if agent is not None:
+            _, returncode = await self._arun_agent(
+                agent,
+                remoteCmd,
+                stdinData=self._paced(chunks()),
+                timeout=self.transfer_timeout(size) + len(members),
+                step=step)
+        else:
+            cmd = self.ssh_command(' '.join(shlex.quote(arg)
+                                            for arg in remoteCmd))
+            _, returncode = await self.arun_cmd(
+                cmd,
+                stdinData=self._paced(chunks()) if self.bandwidthLimitKb
+                          else chunks(),
+                timeout=self.transfer_timeout(size) + len(members),
+                step=step)
+        record_phase('transfer', perf_counter() - startTime, size)
+        if opened:
+            self._touch()
+
+        for failure in failures:
+            self.logger.error('%s: Unable to send files: %s'
+                              % (self.hostname, failure))
+        return returncode == 0 and not failures
+
+    def send_file(self,
+                  localPath: str,
+                  remotePath: str,
+                  mode: str,
+                  owner: str,
+                  group: str,
+                  compress: bool=False,
+                  step: str=None,
+                  ) -> bool:
+        '''
+        Send a (large) file resumably. See asend_file.
+        '''
+        return run_sync(self.asend_file(localPath,
+                                        remotePath,
+                                        mode,
+                                        owner,
+                                        group,
+                                        compress=compress,
+                                        step=step))
+
+    async def asend_file(self,
+                         localPath: str,
+                         remotePath: str,
+                         mode: str,
+                         owner: str,
+                         group: str,
+                         compress: bool=False,
+                         step: str=None,
+                         ) -> bool:
+        '''
+        Send a (large) file to its remote path with rsync.
+
+        Only the differences to an existing remote file are sent. An
+        interrupted transfer leaves its partial file next to the target
+        and is resumed from it, up to DEFAULT_TRANSFER_RETRIES attempts.
+        Mode, owner and group are applied by the receiving rsync.
+
+        Args:
+          localPath::str
+            Path of the local file
+          remotePath::str
+            Path the file is installed at on the remote host
+          mode::str
+            Octal mode string of the installed file
+          owner::str
+            Owner (name on the remote host) of the installed file
+          group::str
+            Group (name on the remote host) of the installed file
+          compress::bool (Optional)
+            Compress the file on the wire
+          step::str (Optional)
+            Name of the step the transfer is for, used to tag its output
+
+        Returns::bool
+          True/False of transfer success
+        '''
+        opened = await self.aopen()
+        size = os.path.getsize(localPath)
+        cmd = ['rsync',
+               '--partial',
+               '--partial-dir=%s' % RSYNC_PARTIAL_DIR,
+               '--timeout=%d' % DEFAULT_TRANSFER_STALL_TIMEOUT,
+               '--perms', '--chmod=F%s' % mode,
+               '--owner', '--group', '--chown=%s:%s' % (owner, group),
+               ] + self.rsync_options()
+        if compress:
+            cmd.append('--compress')
+        cmd += [localPath, '%s:%s' % (self.destination, remotePath)]
+
+        startTime = perf_counter()
+        for attempt in range(1, DEFAULT_TRANSFER_RETRIES + 1):
+            _, returncode = await self.arun_cmd(
+                cmd,
+                timeout=self.transfer_timeout(size),
+                step=step)
+            if returncode == 0:
+                break
+            if attempt < DEFAULT_TRANSFER_RETRIES:
+                msg = '%s: Transfer of %s interrupted, resuming (%d/%d)' % (
+                    self.hostname, remotePath, attempt + 1,
+                    DEFAULT_TRANSFER_RETRIES)
+                self.logger.warning(msg)
+        record_phase('transfer', perf_counter() - startTime, size)
+        if opened:
+            self._touch()
         return returncode == 0
 
     def verify_connection(self,
@@ -74,10 +667,16 @@ class Connection:
         '''
         Verifies that a connection can be established with the host.
         '''
-        #cmd = 'ssh -i %s %s@%s "ls"' % (self.identity,
-        #                                self.username,
-        #                                self.hostname)
-        _, returncode = self.run_remote_cmd("ls", splitCmd=True, timeout=5)
+        return run_sync(self.averify_connection())
+
+    async def averify_connection(self,
+                                 ) -> bool:
+        '''
+        Verifies that a connection can be established with the host.
+        '''
+        if not await self.aopen():
+            return False
+        _, returncode = await self.arun_remote_cmd('true', timeout=5)
         return returncode == 0
 
     def run_cmd(self,
@@ -85,44 +684,122 @@ class Connection:
                 shell: bool=False,
                 suppressOutput: bool=True,
                 timeout: int=30,
+                step: str=None,
                 ) -> (str, int):
         '''
+        Run a command with a timeout. See arun_cmd.
+        '''
+        return run_sync(self.arun_cmd(cmd,
+                                      shell=shell,
+                                      suppressOutput=suppressOutput,
+                                      timeout=timeout,
+                                      step=step))
+
+    async def arun_cmd(self,
+                       cmd: (str, list),
+                       shell: bool=False,
+                       suppressOutput: bool=True,
+                       timeout: int=30,
+                       stdinData: (bytes, object)=None,
+                       step: str=None,
+                       onStdoutLine=None,
+                       ) -> (str, int):
+        '''
         Run a command with a timeout.
 
+        Output is streamed into the logger line by line as it arrives,
+        tagged with the host and step: stdout at DEBUG, stderr at WARNING.
+        Only the last `outputBufferSize` bytes are kept, and they are
+        logged if the command fails.
+
         Args:
           cmd::str
             Command to be run
           shell:bool
             Specify whether or not to use a shell during the call
           suppressOutput::bool
-            Specify whether or not to print output to stdout
+            If False, stdout is captured and returned instead of streamed
           timeout::int
             Time in seconds to allow cmd to run
+          stdinData::bytes/iterable (Optional)
+            Data (or chunks of data) to send to the command's stdin
+          step::str (Optional)
+            Name of the step the command is for, used to tag its output
+          onStdoutLine::callable (Optional)
+            Also called with each streamed stdout line (str)
 
         Returns::(str, int)
           String of the output (if enabled, else empty string)
           Int of the return code
         '''
-        stdout = subprocess.DEVNULL if suppressOutput else subprocess.STDOUT
-
         self.logger.debug('Running Command: %s' % cmd)
+        return await self._arun(cmd,
+                                shell=shell,
+                                suppressOutput=suppressOutput,
+                                timeout=timeout,
+                                stdinData=stdinData,
+                                step=step,
+                                onStdoutLine=onStdoutLine)
+
+    async def _arun(self,
+                    cmd: (str, list),
+                    shell: bool=False,
+                    suppressOutput: bool=True,
+                    timeout: int=30,
+                    stdinData: bytes=None,
+                    step: str=None,
+                    onStdoutLine=None,
+                    captureStderr: bool=True,
+                    logErrors: bool=True,
+                    ) -> (str, int):
+        '''
+        Runs a command, see arun_cmd.
+
+        Args:
+          captureStderr::bool (Optional)
+            Read stderr, must be False for commands that leave a
+            background process holding it (ie. ssh -f)
+          logErrors::bool (Optional)
+            Log output and timeouts as warnings/errors (disabled for
+            probes, whose output is logged at DEBUG)
+        '''
+        tag = self.hostname if not step else '%s [%s]' % (self.hostname, step)
+        tail = RingBuffer(self.outputBufferSize)
+        stderrLevel = logging.WARNING if logErrors else logging.DEBUG
+
+        def on_stdout(line: bytes):
+            tail.append(line)
+            text = line.decode('utf-8', 'replace').rstrip('\n')
+            self.logger.debug('%s: %s', tag, text)
+            if onStdoutLine:
+                onStdoutLine(text)
+
+        def on_stderr(line: bytes):
+            tail.append(line)
+            text = line.decode('utf-8', 'replace').rstrip('\n')
+            self.logger.log(stderrLevel, '%s: %s', tag, text)
+
         try:
-            response = subprocess.run(cmd,
-                                      shell=shell,
-                                      stdout=stdout,
-                                      stderr=subprocess.PIPE,
-                                      timeout=timeout)
-        except subprocess.TimeoutExpired as e:
-            err = 'Timeout exceeded for command "%s"' % cmd
-            self.logger.error(err)
+            stdout, _, returncode = await run_process(
+                cmd,
+                shell=shell,
+                stdinData=stdinData,
+                captureStdout=not suppressOutput,
+                timeout=timeout,
+                onStdoutLine=on_stdout if suppressOutput else None,
+                onStderrLine=on_stderr if captureStderr else None)
+        except ProcessTimeout as e:
+            if logErrors:
+                self.logger.error('%s: %s' % (tag, e))
             output = ''
             returncode = -1
         else:
-            output = '' if suppressOutput else response.stdout.decode('utf-8')
-            returncode = response.returncode
+            output = '' if suppressOutput else stdout.decode('utf-8')
 
-            if response.stderr:
-                self.logger.error(response.stderr.decode('utf-8'))
+        if returncode != 0 and logErrors and tail.size:
+            err = '%s: Command failed (%d), last output:\n%s' % (
+                tag, returncode, tail.getvalue())
+            self.logger.error(err)
 
         return output, returncode
 
@@ -132,33 +809,203 @@ class Connection:
                        splitCmd: bool=False,
                        suppressOutput: bool=True,
                        timeout: int=30,
+                       step: str=None,
                        ) -> (str, int):
         '''
-        Run a command on the remote host.
+        Run a command on the remote host. See arun_remote_cmd.
+        '''
+        return run_sync(self.arun_remote_cmd(cmd,
+                                             shell=shell,
+                                             splitCmd=splitCmd,
+                                             suppressOutput=suppressOutput,
+                                             timeout=timeout,
+                                             step=step))
+
+    async def arun_remote_cmd(self,
+                              cmd: (str, list),
+                              shell: bool=False,
+                              splitCmd: bool=False,
+                              suppressOutput: bool=True,
+                              timeout: int=30,
+                              stdinData: bytes=None,
+                              step: str=None,
+                              onStdoutLine=None,
+                              forwardAgent: bool=False,
+                              ) -> (str, int):
+        '''
+        Run a command on the remote host over the master session.
 
         Args:
           cmd::str
-            Command to be run
+            Command to be run by the remote shell. A list is quoted
+            argument by argument.
           shell:bool
-            Specify whether or not to use a shell during the call
+            Run a list cmd as a shell command line: its items are joined
+            with spaces rather than quoted, so the remote shell expands
+            them
           splitCmd::bool
-            Specify to split command before running or not
+            Split a str cmd on whitespace into arguments, which are then
+            quoted (see cmd). Ignored if shell is set.
           suppressOutput::bool
-            Specify whether or not to print output to stdout
+            If False, stdout is captured and returned instead of streamed
           timeout::int
             Time in seconds to allow cmd to run
+          stdinData::bytes (Optional)
+            Data to send to the remote command's stdin
+          step::str (Optional)
+            Name of the step the command is for, used to tag its output
+          onStdoutLine::callable (Optional)
+            Also called with each streamed stdout line (str)
+          forwardAgent::bool (Optional)
+            Forward the local ssh agent (see ssh_options). The command
+            then gets its own ssh session, even in agent mode.
         '''
-        if type(cmd) is list:
+        if shell and type(cmd) is list:
             cmd = ' '.join(cmd)
+        elif splitCmd and not shell and type(cmd) is str:
+            cmd = cmd.split()
+
+        agent = None if forwardAgent else await self.aagent()
+        if agent is not None:
+            startTime = perf_counter()
+            output, returncode = await self._arun_agent(
+                agent,
+                cmd if type(cmd) is list else ['sh', '-c', cmd],
+                suppressOutput=suppressOutput,
+                timeout=timeout,
+                stdinData=stdinData,
+                step=step,
+                onStdoutLine=onStdoutLine)
+            record_phase('remoteExec',
+                         perf_counter() - startTime,
+                         len(stdinData or b''))
+            return output, returncode
 
-        fullCmd = 'ssh -i %s %s@%s "%s"' % (self.identity,
-                                            self.username,
-                                            self.hostname,
-                                            cmd)
-        if splitCmd:
-            fullCmd = fullCmd.split()
-
-        return self.run_cmd(fullCmd,
-                            shell=shell,
-                            suppressOutput=suppressOutput,
-                            timeout=timeout)
+        if type(cmd) is list:
+            cmd = ' '.join(shlex.quote(arg) for arg in cmd)
+
+        opened = await self.aopen()
+        startTime = perf_counter()
+        sshCmd = self.ssh_command(cmd, forwardAgent=forwardAgent)
+        output, returncode = await self.arun_cmd(sshCmd,
+                                                 suppressOutput=suppressOutput,
+                                                 timeout=timeout,
+                                                 stdinData=stdinData,
+                                                 step=step,
+                                                 onStdoutLine=onStdoutLine)
+        record_phase('remoteExec',
+                     perf_counter() - startTime,
+                     len(stdinData or b''))
+        if opened:
+            self._touch()
+        return output, returncode
+
+    async def _arun_agent(self,
+                          agent: Agent,
+                          argv: list,
+                          suppressOutput: bool=True,
+                          timeout: float=30,
+                          stdinData: (bytes, object)=None,
+                          step: str=None,
+                          onStdoutLine=None,
+                          ) -> (str, int):
+        '''
+        Runs a command through the agent (no remote shell, the arguments
+        are passed as they are). Output is handled as by arun_cmd.
+
+        Returns::(str, int)
+          String of the output (if enabled, else empty string)
+          Int of the return code, -1 if it timed out or the agent died
+        '''
+        self.logger.debug('Running Command (agent): %s' % argv)
+        tag = self.hostname if not step else '%s [%s]' % (self.hostname, step)
+        tail = RingBuffer(self.outputBufferSize)
+        stdout = []
+
+        def on_output(stream: str, line: bytes):
+            tail.append(line)
+            text = line.decode('utf-8', 'replace').rstrip('\n')
+            if stream == 'stderr':
+                self.logger.warning('%s: %s', tag, text)
+            elif not suppressOutput:
+                stdout.append(line)
+            else:
+                self.logger.debug('%s: %s', tag, text)
+                if onStdoutLine:
+                    onStdoutLine(text)
+
+        try:
+            # The agent kills the command on timeout, the margin is for
+            # its answer to arrive
+            result = await agent.arequest(
+                'exec',
+                {'argv': argv, 'timeout': timeout},
+                data=stdinData,
+                onOutput=on_output,
+                timeout=None if timeout is None else timeout + 30)
+        except AgentError as e:
+            result = {'error': str(e), 'returncode': -1}
+        self._touch()
+
+        returncode = result.get('returncode', 127)
+        if 'error' in result:
+            self.logger.error('%s: %s' % (tag, result['error']))
+        elif result.get('timedOut'):
+            self.logger.error('%s: Timeout exceeded for command "%s"'
+                              % (tag, argv))
+            returncode = -1
+        elif returncode != 0 and tail.size:
+            err = '%s: Command failed (%d), last output:\n%s' % (
+                tag, returncode, tail.getvalue())
+            self.logger.error(err)
+
+        return b''.join(stdout).decode('utf-8'), returncode
+
+
+def ssh_port(hostname: str,
+             username: str,
+             ) -> int:
+    '''
+    Returns the port ssh connects to for a host, as set up in the ssh
+    configuration (see ssh -G). Nothing is sent over the network.
+
+    Returns::int
+      The port, None if ssh could not tell
+    '''
+    try:
+        stdout, _, returncode = run_sync(run_process(
+            ['ssh', '-G', '%s@%s' % (username, hostname)],
+            captureStdout=True,
+            timeout=10))
+    except (OSError, ProcessTimeout):
+        return None
+    if returncode != 0:
+        return None
+    for line in stdout.decode('utf-8', 'replace').splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'port' and value.strip().isdigit():
+            return int(value)
+    return None
+
+def close_connections(hostnames: set,
+                      ) -> int:
+    '''
+    Tears down the connections (master sessions and agents) made to the
+    given hosts and forgets them, as a long running process does with
+    hosts it has not deployed to for a while. Connections are made again
+    on next use.
+
+    Args:
+      hostnames::set
+        Hosts to close the connections of
+
+    Returns::int
+      Number of connections closed
+    '''
+    with Connection.lock:
+        keys = [key for key, connection in Connection.instances.items()
+                if connection.hostname in hostnames]
+        connections = [Connection.instances.pop(key) for key in keys]
+    for connection in connections:
+        connection.close()
+    return len(connections)
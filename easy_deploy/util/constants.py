@@ -2,8 +2,40 @@
 Constants file for easy_deploy. Defaults live here.
 '''
 
-DEFAULT_BUILD_DIR = '/tmp'
+# Files with these suffixes are not worth compressing on the wire
+COMPRESSED_SUFFIXES = ('.7z', '.bz2', '.deb', '.gz', '.jar', '.jpeg', '.jpg',
+                       '.lz4', '.mp4', '.png', '.rpm', '.tgz', '.txz', '.whl',
+                       '.xz', '.zip', '.zst')
+DEFAULT_BANDWIDTH_LIMIT_KB = 0 # Per-host transfer cap in KB/s, 0 for none
+DEFAULT_COMPRESS_MIN_KB = 64 # Smaller files are sent uncompressed
+DEFAULT_CONCURRENCY = 10 # Number of hosts deployed to at once
+DEFAULT_DAEMON_IDLE_TIMEOUT = 900 # Seconds a host's connection is kept warm
+DEFAULT_DAEMON_SOCKET = '~/.cache/easy_deploy/daemon.sock' # Jobs sent here
+DEFAULT_DISTRIBUTION_FANOUT = 4 # Hosts each host relays artifacts to
+DEFAULT_DISTRIBUTION_SEEDS = 2 # Hosts artifacts are uploaded to directly
+DEFAULT_FACT_CACHE_DIR = '~/.cache/easy_deploy/facts' # Facts about hosts
+DEFAULT_FACT_TTL = 0 # Seconds facts of earlier runs are trusted for
 DEFAULT_FILE_DIRNAME = 'files'
+DEFAULT_JOURNAL_DIR = '~/.cache/easy_deploy/journals' # Completed steps
+DEFAULT_LARGE_FILE_MB = 32 # Files this big are sent resumably, by delta
+DEFAULT_LOG_BACKUPS = 3 # Rotated host logs kept
 DEFAULT_LOG_BASE_NAME = 'easy_deploy_run' # epoch run-time appended to name
 DEFAULT_LOG_DIR = '/var/log/easy_deploy'
 DEFAULT_LOG_FORMAT = '%(asctime)s | %(name)s | %(levelname)s | %(message)s'
+DEFAULT_LOG_MAX_MB = 10 # Size host logs are rotated at
+DEFAULT_OUTPUT_BUFFER_KB = 64 # Tail of command output kept for error reports
+DEFAULT_REMOTE_ARTIFACT_DIR = '/var/cache/easy_deploy/artifacts' # By sha256
+DEFAULT_REMOTE_BUILD_DIR = '/tmp' # Staging area on remote hosts
+DEFAULT_RUNLIST_CACHE_DIR = '~/.cache/easy_deploy/runlists' # Compiled configs
+DEFAULT_SSH_CONNECT_TIMEOUT = 10 # Seconds to establish a master session
+DEFAULT_SSH_CONTROL_PERSIST = 60 # Idle seconds before a master session exits
+DEFAULT_SSH_KEEPALIVE_COUNT = 3 # Missed keep-alives before disconnecting
+DEFAULT_SSH_KEEPALIVE_INTERVAL = 15 # Seconds between keep-alive probes
+DEFAULT_SSH_MAX_SESSIONS = 10 # sshd's default MaxSessions per connection
+DEFAULT_STEP_PARALLELISM = 4 # Independent steps run at once per host
+DEFAULT_TRANSFER_MIN_RATE_KB = 256 # Slowest link assumed for transfer timeouts
+DEFAULT_TRANSFER_RETRIES = 3 # Attempts for a resumable transfer
+DEFAULT_TRANSFER_STALL_TIMEOUT = 60 # Seconds without progress before retrying
+INVENTORY_COMMENT_CHAR = '#'
+MAX_LINE_BYTES = 64 * 1024 # Longer output lines are split
+RSYNC_PARTIAL_DIR = '.easy_deploy-partial' # Kept beside a target to resume it
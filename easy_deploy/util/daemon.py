@@ -0,0 +1,417 @@
+'''
+Module used to run deployments from a long running daemon.
+
+The daemon takes deploy jobs on a local unix socket (see client for the
+protocol). Between jobs it keeps what each easy_deploy process would
+otherwise build again: its modules, the parsed configs (see
+EasyDeployParser) and the ssh master sessions and agents of the hosts
+(see Connection). A host's connections are only torn down once it has
+had no job for `idleTimeout` seconds.
+
+Jobs run at once unless they share hosts: a job waits until no other
+job is deploying to any of its hosts, then holds all of them until it
+is done. The records logged for a job are streamed back to the client
+that submitted it.
+'''
+
+import contextvars
+import inspect
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+
+from time import time
+
+from easy_deploy.util.client import (DaemonError,
+                                     read_message,
+                                     send_message,
+                                     )
+from easy_deploy.util.connection import close_connections
+from easy_deploy.util.constants import (DEFAULT_DAEMON_IDLE_TIMEOUT,
+                                        DEFAULT_RUNLIST_CACHE_DIR,
+                                        )
+from easy_deploy.util.logs import ContextFilter
+from easy_deploy.util.parser import EasyDeployConfigError, EasyDeployParser
+from easy_deploy.util.run import Deployment
+
+REAP_INTERVAL = 30 # Seconds between checks for idle hosts
+
+# Deployment arguments a job may set, the daemon sets the rest
+JOB_OPTIONS = frozenset(inspect.signature(Deployment).parameters) - \
+              {'controlPersist', 'parser'}
+
+_currentJob = contextvars.ContextVar('easy_deploy_job', default=None)
+
+
+class Job:
+    def __init__(self,
+                 number: int,
+                 options: dict,
+                 ):
+        '''
+        A deploy job and the events to send to its client.
+
+        Args:
+          number::int
+            Number of the job, counting up from 1
+          options::dict
+            Arguments of the job's Deployment
+        '''
+        self.number = number
+        self.options = options
+        self.hosts = frozenset(options['remoteHosts'])
+        self.events = queue.SimpleQueue()
+
+
+class JobLogHandler(logging.Handler):
+    ''' Sends the records logged for a job to its client '''
+
+    def __init__(self,
+                 ):
+        super().__init__()
+        self.addFilter(ContextFilter())
+        self.setFormatter(logging.Formatter())
+
+    def emit(self,
+             record: logging.LogRecord,
+             ):
+        job = _currentJob.get()
+        if job is None:
+            return
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+        if record.exc_text:
+            message += '\n' + record.exc_text
+        job.events.put({'event': 'log',
+                        'level': record.levelname,
+                        'levelno': record.levelno,
+                        'host': record.host,
+                        'step': record.step,
+                        'message': message,
+                        })
+
+
+class _JobRequestHandler(socketserver.StreamRequestHandler):
+    ''' Serves a single client of the daemon '''
+
+    def handle(self,
+               ):
+        try:
+            request = read_message(self.rfile)
+        except DaemonError as e:
+            self.server.refuse(self.wfile, str(e))
+            return
+        if request is None:
+            return
+        if request.get('op') != 'deploy':
+            self.server.refuse(self.wfile,
+                               'Unknown op: %r' % request.get('op'))
+            return
+        self.server.deploy(request.get('options'), self.wfile)
+
+
+class DeployDaemon(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self,
+                 socketPath: str,
+                 idleTimeout: int=DEFAULT_DAEMON_IDLE_TIMEOUT,
+                 ):
+        '''
+        Listens for deploy jobs on a unix socket, only usable by the user
+        running the daemon. See serve.
+
+        Args:
+          socketPath::str
+            Path of the socket, its directory is created. A stale socket
+            left by a daemon that died is replaced.
+          idleTimeout::int (Optional)
+            Seconds a host's connections are kept open after its last job
+        '''
+        self.logger = logging.getLogger()
+        self.socketPath = os.path.expanduser(socketPath)
+        self.idleTimeout = idleTimeout
+        self.parsers = {} # runlist cache dir -> EasyDeployParser
+        self.busyHosts = set()
+        self.lastUsed = {} # host -> time its last job was done
+        self.jobs = {} # number -> Thread running the job
+        self.jobCount = 0
+        self.bound = False
+        self.logHandler = JobLogHandler()
+        # Guards parsers, busyHosts, lastUsed, jobs and jobCount
+        self._hostsFree = threading.Condition()
+        self._stopped = threading.Event()
+        super().__init__(self.socketPath, _JobRequestHandler)
+
+    def server_bind(self,
+                    ):
+        directory = os.path.dirname(self.socketPath) or '.'
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.path.exists(self.socketPath):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socketPath)
+            except OSError:
+                os.unlink(self.socketPath)
+            else:
+                raise DaemonError('A daemon is already listening on %s'
+                                  % self.socketPath)
+            finally:
+                probe.close()
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+            self.bound = True
+        finally:
+            os.umask(umask)
+
+    def serve(self,
+              ):
+        '''
+        Serves jobs until SIGTERM or SIGINT, then waits for the running
+        jobs to finish and closes every connection.
+        '''
+        def stop(signum, frame):
+            # shutdown waits for the serving loop, which runs in this thread
+            threading.Thread(target=self.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        logging.getLogger().addHandler(self.logHandler)
+        reaper = threading.Thread(target=self._reap,
+                                  name='easy_deploy-reaper',
+                                  daemon=True)
+        reaper.start()
+        self.logger.info('Listening for jobs on %s' % self.socketPath)
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+            with self._hostsFree:
+                # Jobs still being requested are refused from now on
+                self._stopped.set()
+                jobs = list(self.jobs.values())
+            if jobs:
+                self.logger.info('Waiting for %d running jobs' % len(jobs))
+            for thread in jobs:
+                thread.join()
+            reaper.join()
+            with self._hostsFree:
+                hosts = set(self.lastUsed)
+                self.lastUsed.clear()
+            close_connections(hosts)
+            logging.getLogger().removeHandler(self.logHandler)
+            self.logger.info('Daemon stopped')
+
+    def server_close(self,
+                     ):
+        super().server_close()
+        # Not if binding failed, the socket may be another daemon's
+        if self.bound:
+            self.bound = False
+            try:
+                os.unlink(self.socketPath)
+            except FileNotFoundError:
+                pass
+
+    def refuse(self,
+               stream,
+               reason: str,
+               ):
+        '''
+        Tells a client its request was refused.
+        '''
+        self.logger.warning('Refused request: %s' % reason)
+        try:
+            send_message(stream, {'event': 'error', 'message': reason})
+        except OSError:
+            pass
+
+    def deploy(self,
+               options: dict,
+               stream,
+               ):
+        '''
+        Runs a job in a thread of its own and sends its events to the
+        client until it is done. If the client goes away the job still
+        runs to the end.
+
+        Args:
+          options::dict
+            Arguments of the job's Deployment (see JOB_OPTIONS)
+          stream::file
+            Stream of the client's socket
+        '''
+        err = self._check_options(options)
+        if err:
+            self.refuse(stream, err)
+            return
+
+        with self._hostsFree:
+            if self._stopped.is_set():
+                job = None
+            else:
+                self.jobCount += 1
+                job = Job(self.jobCount, options)
+                thread = threading.Thread(target=self._run_job,
+                                          args=(job,),
+                                          name='easy_deploy-job-%d'
+                                               % job.number,
+                                          daemon=True)
+                self.jobs[job.number] = thread
+                thread.start()
+        if job is None:
+            self.refuse(stream, 'The daemon is stopping')
+            return
+
+        connected = True
+        while True:
+            event = job.events.get()
+            if connected:
+                try:
+                    send_message(stream, event)
+                except OSError:
+                    connected = False
+                    self.logger.warning('Job %d: client went away, the job '
+                                        'carries on' % job.number)
+            if event['event'] == 'done':
+                return
+
+    def _check_options(self,
+                       options: dict,
+                       ) -> str:
+        '''
+        Returns::str
+          Why the options of a job are unusable, None if they are fine
+        '''
+        if not isinstance(options, dict):
+            return 'Job options must be a mapping'
+        unknown = sorted(set(options) - JOB_OPTIONS)
+        if unknown:
+            return 'Unknown job options: %s' % ', '.join(unknown)
+        hosts = options.get('remoteHosts')
+        if not isinstance(hosts, list) or not hosts or \
+           not all(isinstance(host, str) for host in hosts):
+            return 'Job options must list remoteHosts'
+        return None
+
+    def _run_job(self,
+                 job: Job,
+                 ):
+        '''
+        Runs a job once none of its hosts are busy with another job.
+        '''
+        _currentJob.set(job)
+        results = None
+        try:
+            self._claim_hosts(job)
+            try:
+                options = dict(job.options)
+                cacheDir = options.get('runlistCacheDir',
+                                       DEFAULT_RUNLIST_CACHE_DIR)
+                self.logger.info('Job %d: deploying %s to %d hosts'
+                                 % (job.number,
+                                    options.get('instructionFile'),
+                                    len(job.hosts)))
+                deployment = Deployment(controlPersist=self.idleTimeout,
+                                        parser=self._parser(cacheDir),
+                                        **options)
+                results = deployment.run()
+            finally:
+                self._release_hosts(job)
+        except EasyDeployConfigError as e:
+            self.logger.error('Job %d: unable to build runlist:\n%s'
+                              % (job.number, e))
+        except Exception:
+            self.logger.exception('Job %d failed' % job.number)
+        finally:
+            if results is None:
+                results = {host: False for host in job.options['remoteHosts']}
+            failed = sum(not success for success in results.values())
+            self.logger.info('Job %d: done, %d/%d hosts failed'
+                             % (job.number, failed, len(results)))
+            with self._hostsFree:
+                self.jobs.pop(job.number, None)
+            job.events.put({'event': 'done',
+                            'job': job.number,
+                            'results': results,
+                            })
+
+    def _parser(self,
+                cacheDir: str,
+                ) -> EasyDeployParser:
+        '''
+        Returns the parser shared by jobs caching in cacheDir, None for
+        jobs that do not cache (they get a parser of their own).
+        '''
+        if not cacheDir:
+            return None
+        with self._hostsFree:
+            if cacheDir not in self.parsers:
+                self.parsers[cacheDir] = EasyDeployParser(cacheDir)
+            return self.parsers[cacheDir]
+
+    def _claim_hosts(self,
+                     job: Job,
+                     ):
+        '''
+        Waits until no other job deploys to any of the job's hosts, then
+        marks them all busy at once, so jobs never hold some hosts while
+        waiting for others.
+        '''
+        with self._hostsFree:
+            busy = job.hosts & self.busyHosts
+            if busy:
+                job.events.put({'event': 'queued',
+                                'job': job.number,
+                                'waitingFor': sorted(busy),
+                                })
+                self.logger.info('Job %d: waiting for hosts busy with other '
+                                 'jobs: %s' % (job.number,
+                                               ', '.join(sorted(busy))))
+            self._hostsFree.wait_for(lambda: not job.hosts & self.busyHosts)
+            self.busyHosts |= job.hosts
+
+    def _release_hosts(self,
+                       job: Job,
+                       ):
+        '''
+        Frees the hosts of a job for other jobs.
+        '''
+        now = time()
+        with self._hostsFree:
+            self.busyHosts -= job.hosts
+            self.lastUsed.update(dict.fromkeys(job.hosts, now))
+            self._hostsFree.notify_all()
+
+    def _reap(self,
+              ):
+        '''
+        Closes the connections of hosts without a job for `idleTimeout`
+        seconds, until the daemon stops.
+        '''
+        while not self._stopped.wait(min(REAP_INTERVAL, self.idleTimeout)):
+            now = time()
+            with self._hostsFree:
+                idle = {host for host, lastUsed in self.lastUsed.items()
+                        if host not in self.busyHosts and
+                        now - lastUsed >= self.idleTimeout}
+                # Held busy while closing, so no job starts on them
+                self.busyHosts |= idle
+            if not idle:
+                continue
+            try:
+                closed = close_connections(idle)
+                self.logger.debug('Closed %d connections to %d idle hosts'
+                                  % (closed, len(idle)))
+            finally:
+                with self._hostsFree:
+                    self.busyHosts -= idle
+                    for host in idle:
+                        self.lastUsed.pop(host, None)
+                    self._hostsFree.notify_all()
@@ -0,0 +1,145 @@
+'''
+Module used to read local debian packages (.deb files) without dpkg, so
+their name and version are known before anything is sent to a host.
+'''
+
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+
+from collections import namedtuple, OrderedDict
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_BYTES = 60
+MAX_CACHED_INFOS = 1024 # .debs whose info is kept, least recently used go
+
+DebInfo = namedtuple('DebInfo', ['package', 'version', 'sha256', 'size'])
+
+# (path, size, mtime) -> DebInfo, shared by every host's Runner
+_infoCache = OrderedDict()
+_infoLock = threading.Lock()
+
+class DebFileError(Exception):
+    ''' Raised if a .deb can not be read '''
+
+def is_local_deb(step: dict,
+                 ) -> bool:
+    '''
+    Checks if an installDebianPackage step installs a local .deb (a
+    source relative to the file dir) rather than one already on the host
+    (an absolute path).
+    '''
+    return step.get('command') == 'installDebianPackage' \
+        and not step.get('source', '').startswith('/')
+
+def read_control(path: str,
+                 ) -> dict:
+    '''
+    Reads the control fields of a .deb.
+
+    The control tarball is read in Python for gzip, xz, bzip2 and
+    uncompressed packages. Other compressions (zstd) need dpkg-deb on
+    the local host.
+
+    Args:
+      path::str
+        Path of the .deb
+
+    Returns::dict
+      Control fields (Package, Version, ...)
+
+    Raises:
+      DebFileError
+        If the file is not a .deb or its control file can not be read
+    '''
+    with open(path, 'rb') as stream:
+        if stream.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebFileError('%s: Not a debian package' % path)
+        while True:
+            header = stream.read(AR_HEADER_BYTES)
+            if len(header) < AR_HEADER_BYTES:
+                raise DebFileError('%s: No control member' % path)
+            name = header[:16].decode('ascii', 'replace').strip().rstrip('/')
+            try:
+                size = int(header[48:58])
+            except ValueError:
+                raise DebFileError('%s: Corrupt archive header' % path)
+            if name.startswith('control.tar'):
+                data = stream.read(size)
+                break
+            stream.seek(size + size % 2, os.SEEK_CUR)
+
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            member = next(m for m in tar.getmembers()
+                          if m.name.lstrip('./') == 'control')
+            text = tar.extractfile(member).read().decode('utf-8')
+    except (tarfile.TarError, StopIteration, UnicodeDecodeError):
+        text = _dpkg_deb_control(path)
+
+    fields = {}
+    for line in text.splitlines():
+        if line[:1].isspace():
+            continue
+        key, _, value = line.partition(':')
+        if value:
+            fields[key.strip()] = value.strip()
+    return fields
+
+def _dpkg_deb_control(path: str,
+                      ) -> str:
+    '''
+    Returns the control file of a .deb as read by the local dpkg-deb.
+    '''
+    if not shutil.which('dpkg-deb'):
+        raise DebFileError('%s: Unsupported control compression (install '
+                           'dpkg-deb to read it)' % path)
+    try:
+        return subprocess.run(['dpkg-deb', '--field', path],
+                              capture_output=True,
+                              check=True,
+                              ).stdout.decode('utf-8')
+    except (subprocess.CalledProcessError, UnicodeDecodeError) as e:
+        raise DebFileError('%s: Unable to read control: %s' % (path, e))
+
+def deb_info(path: str,
+             ) -> DebInfo:
+    '''
+    Returns package name, version, sha256 and size of a .deb. Results
+    are kept until the file changes (for the last MAX_CACHED_INFOS files
+    used), so every host reads it once.
+
+    Raises:
+      DebFileError
+        If the file is not a .deb or has no Package/Version
+    '''
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _infoLock:
+        info = _infoCache.get(key)
+        if info is not None:
+            _infoCache.move_to_end(key)
+            return info
+
+    fields = read_control(path)
+    if not fields.get('Package') or not fields.get('Version'):
+        raise DebFileError('%s: Missing Package or Version field' % path)
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1 << 20), b''):
+            digest.update(chunk)
+
+    info = DebInfo(fields['Package'],
+                   fields['Version'],
+                   digest.hexdigest(),
+                   stat.st_size)
+    with _infoLock:
+        _infoCache[key] = info
+        if len(_infoCache) > MAX_CACHED_INFOS:
+            _infoCache.popitem(last=False)
+    return info
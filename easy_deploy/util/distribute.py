@@ -0,0 +1,235 @@
+'''
+Module used to spread artifacts across the fleet in a tree: they are sent
+over the local uplink to a few seed hosts only, which relay them host to
+host. Every hop verifies the artifacts' checksums.
+
+Relaying needs every host to ssh to the hosts it relays to, as the
+deploying user, with its own ssh configuration: host keys are checked
+against its known_hosts as it is set up to, and it authenticates with its
+own keys, or with the local ssh agent if forwarding is turned on. A
+forwarded agent can be used by anyone with root on a relaying host for
+as long as the relay runs, so only forward to hosts trusted as much as
+the local one. A relay that fails falls back to sending from here.
+'''
+
+import asyncio
+import logging
+import os
+import shlex
+
+from easy_deploy.util.aio import run_sync
+from easy_deploy.util.artifacts import (asend_artifacts,
+                                        REMOTE_ARTIFACT_RECEIVE_SCRIPT,
+                                        )
+from easy_deploy.util.constants import (DEFAULT_CONCURRENCY,
+                                        DEFAULT_DISTRIBUTION_FANOUT,
+                                        DEFAULT_DISTRIBUTION_SEEDS,
+                                        DEFAULT_REMOTE_ARTIFACT_DIR,
+                                        DEFAULT_SSH_CONNECT_TIMEOUT,
+                                        )
+
+# Prints each of the given sha256s held intact by the artifact dir ($1).
+# Corrupt artifacts are removed, so they are sent again.
+REMOTE_ARTIFACT_STATE_SCRIPT = '''
+store=$1
+shift
+for sha in "$@"; do
+  if [ -f "$store/$sha" ]; then
+    if [ "$(sha256sum < "$store/$sha" | cut -d' ' -f1)" = "$sha" ]; then
+      echo "$sha"
+    else
+      rm -f -- "$store/$sha"
+    fi
+  fi
+done
+exit 0
+'''
+
+# Streams artifacts of the artifact dir ($1) to another host ($2) over
+# ssh, where the receive command ($3) unpacks and verifies them. Host key
+# checking is left to the relaying host's ssh configuration.
+REMOTE_ARTIFACT_RELAY_SCRIPT = '''
+store=$1 destination=$2 receive=$3
+shift 3
+cd -- "$store" || exit 1
+tar -c -f - "$@" | ssh -o BatchMode=yes -o ConnectTimeout=%(timeout)d \\
+  "$destination" "$receive"
+''' % {'timeout': DEFAULT_SSH_CONNECT_TIMEOUT}
+
+def plan_tree(hosts: list,
+              seeds: int,
+              fanout: int,
+              ) -> dict:
+    '''
+    Arranges hosts in a forest: the first `seeds` hosts are roots, every
+    other host gets a parent earlier in the list, and no host has more
+    than `fanout` children. Earlier hosts are nearer the roots.
+
+    Returns::dict
+      host -> list of its children, every host included
+    '''
+    seeds = max(1, seeds)
+    fanout = max(1, fanout)
+    children = {host: [] for host in hosts}
+    for index in range(seeds, len(hosts)):
+        children[hosts[(index - seeds) // fanout]].append(hosts[index])
+    return children
+
+
+class Distributor:
+    def __init__(self,
+                 connections: dict,
+                 artifacts: dict,
+                 seeds: int=DEFAULT_DISTRIBUTION_SEEDS,
+                 fanout: int=DEFAULT_DISTRIBUTION_FANOUT,
+                 concurrency: int=DEFAULT_CONCURRENCY,
+                 forwardAgent: bool=False,
+                 ):
+        '''
+        Args:
+          connections::dict
+            host -> Connection of every host to distribute to, in order
+          artifacts::dict
+            sha256 -> local path of each artifact (see collect_artifacts)
+          seeds::int (Optional)
+            Number of hosts artifacts are sent to from the local host
+          fanout::int (Optional)
+            Number of hosts each host relays artifacts to
+          concurrency::int (Optional)
+            Most hosts worked on at once (checked, sent to or relaying)
+          forwardAgent::bool (Optional)
+            Forward the local ssh agent to relaying hosts, so they can
+            ssh on without keys of their own (see the module docstring)
+        '''
+        self.logger = logging.getLogger()
+        self.connections = connections
+        self.artifacts = artifacts
+        self.seeds = seeds
+        self.fanout = fanout
+        self.concurrency = max(1, concurrency)
+        self.forwardAgent = forwardAgent
+        self.stored = {}
+        self._slots = None # asyncio.Semaphore, made on the loop
+
+    def run(self,
+            ) -> dict:
+        '''
+        Distribute the artifacts. See arun.
+        '''
+        return run_sync(self.arun())
+
+    async def arun(self,
+                   ) -> dict:
+        '''
+        Puts every artifact into the remote artifact dir of every host.
+
+        Hosts already holding every artifact are put nearest the roots of
+        the tree, so they relay without being sent anything. A host that
+        can not be relayed to (e.g. it does not accept ssh from its
+        parent) is sent its artifacts from the local host instead, as are
+        the children of a host that did not get them.
+
+        Returns::dict
+          host -> set of sha256s its artifact dir holds
+        '''
+        hosts = list(self.connections)
+        if not self.artifacts or not hosts:
+            return {host: set() for host in hosts}
+
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+        held = await asyncio.gather(*(self._aheld(host) for host in hosts))
+        self.stored = dict(zip(hosts, held))
+        hosts.sort(key=lambda host: len(self.stored[host]) <
+                                    len(self.artifacts))
+        children = plan_tree(hosts, self.seeds, self.fanout)
+        await asyncio.gather(*(self._adeliver(host, None, children)
+                               for host in hosts[:max(1, self.seeds)]))
+        return self.stored
+
+    async def _aheld(self,
+                     host: str,
+                     ) -> set:
+        '''
+        Returns the artifacts a host's artifact dir already holds.
+        '''
+        cmd = ['sh', '-c', REMOTE_ARTIFACT_STATE_SCRIPT, 'sh',
+               DEFAULT_REMOTE_ARTIFACT_DIR] + sorted(self.artifacts)
+        async with self._slots:
+            output, returncode = await self.connections[host].arun_remote_cmd(
+                cmd,
+                suppressOutput=False,
+                timeout=60 + len(self.artifacts),
+                step='fetch artifact state')
+        if returncode != 0:
+            return set()
+        return set(output.split()) & self.artifacts.keys()
+
+    async def _adeliver(self,
+                        host: str,
+                        parent: str,
+                        children: dict,
+                        ):
+        '''
+        Gets the missing artifacts to a host, from its parent or the local
+        host, then on to the host's children.
+        '''
+        missing = {digest: localPath
+                   for digest, localPath in self.artifacts.items()
+                   if digest not in self.stored[host]}
+        success = True
+        source = parent
+        # The slot is given up before moving on to the children, so they
+        # never wait on their parent's slot
+        async with self._slots:
+            if missing and parent is not None:
+                success = await self._arelay(parent, host, missing)
+                if not success:
+                    msg = '%s: Relay from %s failed, sending artifacts '\
+                          'directly' % (host, parent)
+                    self.logger.warning(msg)
+                    source = None
+            if missing and source is None:
+                success = await asend_artifacts(self.connections[host],
+                                                missing,
+                                                step='distribute')
+        if success:
+            self.stored[host].update(missing)
+            if missing:
+                msg = '%s: Received %d artifacts from %s' % (
+                    host, len(missing), source or 'the local host')
+                self.logger.info(msg)
+        else:
+            err = '%s: Unable to distribute artifacts' % host
+            self.logger.error(err)
+
+        await asyncio.gather(*(self._adeliver(child,
+                                              host if success else None,
+                                              children)
+                               for child in children[host]))
+
+    async def _arelay(self,
+                      parent: str,
+                      host: str,
+                      artifacts: dict,
+                      ) -> bool:
+        '''
+        Has parent stream artifacts from its artifact dir straight to host,
+        with its own ssh credentials or the forwarded local ssh agent.
+        '''
+        connection = self.connections[parent]
+        receive = ' '.join(shlex.quote(arg) for arg in
+                           ['sh', '-c', REMOTE_ARTIFACT_RECEIVE_SCRIPT, 'sh',
+                            DEFAULT_REMOTE_ARTIFACT_DIR])
+        destination = self.connections[host].destination
+        cmd = ['sh', '-c', REMOTE_ARTIFACT_RELAY_SCRIPT, 'sh',
+               DEFAULT_REMOTE_ARTIFACT_DIR, destination, receive,
+               ] + sorted(artifacts)
+        size = sum(os.path.getsize(localPath)
+                   for localPath in artifacts.values())
+        _, returncode = await connection.arun_remote_cmd(
+            cmd,
+            timeout=connection.transfer_timeout(size),
+            step='relay to %s' % host,
+            forwardAgent=self.forwardAgent)
+        return returncode == 0
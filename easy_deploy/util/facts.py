@@ -0,0 +1,259 @@
+'''
+Module used to gather facts about a host (file states, installed packages,
+stored artifacts, directories, services, users and groups) in one remote
+call, and to remember them between runs.
+
+A fact is keyed "<kind>:<target>", ie. "file:/etc/app.conf" or
+"package:nginx". Its value is None if the target does not exist:
+  file      [sha256, mode, owner, group]
+  package   installed version
+  artifact  True if the artifact dir holds it intact
+  dir       [writable, KB free]
+  service, user, group, path
+            True/False
+'''
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from time import time
+from urllib.parse import quote
+
+FACT_MARKER = 'EASY_DEPLOY_FACT'
+
+# Kinds of facts installing or removing packages may change
+PACKAGE_CHANGED_FACTS = ('dir', 'file', 'group', 'package', 'service', 'user')
+
+# Given the artifact dir ($1) and "<kind> <target>" argument pairs, prints
+# "<marker>\t<kind>\t<target>\t<value>" for each, value "-" if the target
+# does not exist. Packages are queried at once, and only installed ones
+# reported. Corrupt artifacts are removed.
+REMOTE_FACTS_SCRIPT = '''
+store=$1 packages=
+shift
+fact() { printf '%%s\\t%%s\\t%%s\\t%%s\\n' %(marker)s "$1" "$2" "$3"; }
+flag() { if "$@" >/dev/null 2>&1; then echo 1; else echo 0; fi; }
+while [ $# -ge 2 ]; do
+  kind=$1 target=$2
+  shift 2
+  case "$kind" in
+    file)
+      if [ -f "$target" ]; then
+        fact file "$target" "$(sha256sum < "$target" | cut -d' ' -f1):$(stat -c '%%a:%%U:%%G' -- "$target")"
+      else
+        fact file "$target" -
+      fi ;;
+    package) packages="$packages $target" ;;
+    artifact)
+      if [ -f "$store/$target" ] &&
+         [ "$(sha256sum < "$store/$target" | cut -d' ' -f1)" = "$target" ]; then
+        fact artifact "$target" 1
+      else
+        rm -f -- "$store/$target"
+        fact artifact "$target" 0
+      fi ;;
+    dir)
+      if [ -d "$target" ]; then
+        free=$(df -Pk -- "$target" 2>/dev/null | awk 'NR==2 {print $4}')
+        fact dir "$target" "$(flag test -w "$target"):$free"
+      else
+        fact dir "$target" -
+      fi ;;
+    service)
+      if { command -v systemctl >/dev/null 2>&1 &&
+           systemctl cat -- "$target.service" >/dev/null 2>&1; } ||
+         [ -x "/etc/init.d/$target" ]; then
+        fact service "$target" 1
+      else
+        fact service "$target" 0
+      fi ;;
+    user) fact user "$target" "$(flag getent passwd "$target")" ;;
+    group) fact group "$target" "$(flag getent group "$target")" ;;
+    path) fact path "$target" "$(flag test -f "$target")" ;;
+  esac
+done
+if [ -n "$packages" ]; then
+  tab=$(printf '\\t')
+  dpkg-query -W -f='${Package}\\t${Status}\\t${Version}\\n' $packages 2>/dev/null |
+  while IFS=$tab read -r pkg st ver; do
+    if [ "$st" = "install ok installed" ]; then
+      fact package "$pkg" "$ver"
+    fi
+  done
+fi
+exit 0
+''' % {'marker': FACT_MARKER}
+
+def parse_facts(output: str,
+                keys: list,
+                ) -> dict:
+    '''
+    Reads the output of REMOTE_FACTS_SCRIPT.
+
+    Args:
+      output::str
+        Output of the script
+      keys::list
+        Keys of the facts the script was asked for
+
+    Returns::dict
+      Fact key -> value (see module docstring)
+    '''
+    facts = {key: None for key in keys if key.startswith('package:')}
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) != 4 or fields[0] != FACT_MARKER:
+            continue
+        _, kind, target, value = fields
+        if value == '-':
+            facts['%s:%s' % (kind, target)] = None
+        elif kind == 'file':
+            try:
+                digest, mode, owner, group = value.split(':')
+                facts['file:%s' % target] = [digest, int(mode, 8),
+                                             owner, group]
+            except ValueError:
+                continue
+        elif kind == 'package':
+            facts['package:%s' % target] = value
+        elif kind == 'dir':
+            writable, _, free = value.partition(':')
+            facts['dir:%s' % target] = [writable == '1',
+                                        int(free) if free.isdigit() else None]
+        else:
+            facts['%s:%s' % (kind, target)] = value == '1'
+    return facts
+
+def fact_cache_path(cacheDir: str,
+                    remoteHost: str,
+                    username: str,
+                    port: int=None,
+                    ) -> str:
+    '''
+    Returns the path of the fact cache in cacheDir of a host as logged in
+    to by username on port, as facts (ie. writable dirs) differ by user
+    and a port may lead to another machine (ie. a container).
+    '''
+    endpoint = '%s@%s' % (username, remoteHost)
+    if port:
+        endpoint += ':%d' % port
+    return '%s/%s.json' % (os.path.expanduser(cacheDir),
+                           quote(endpoint, safe='@.-_:'))
+
+
+class FactCache:
+    def __init__(self,
+                 path: str=None,
+                 ttl: float=0,
+                 ):
+        '''
+        Facts of one host. Facts gathered (or set) during this run are
+        always used, facts of earlier runs only while younger than `ttl`.
+
+        Args:
+          path::str (Optional)
+            File facts are kept in between runs, None to keep them in
+            memory only
+          ttl::float (Optional)
+            Seconds facts of earlier runs are trusted for
+        '''
+        self.logger = logging.getLogger()
+        self.path = path
+        self.ttl = ttl
+        self.started = time()
+        self.facts = {} # key -> (time, value)
+        self._lock = threading.Lock()
+        if path and ttl > 0:
+            self._load()
+
+    def _load(self,
+              ):
+        try:
+            with open(self.path, 'r') as stream:
+                facts = json.load(stream)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.debug('Ignoring unreadable fact cache %s: %s'
+                              % (self.path, e))
+            return
+        if not isinstance(facts, dict):
+            return
+        # Expired facts are dropped, so they are not saved again
+        self.facts = {key: tuple(entry) for key, entry in facts.items()
+                      if isinstance(entry, list) and len(entry) == 2
+                      and self.started - entry[0] <= self.ttl}
+
+    def lookup(self,
+               keys: list,
+               ) -> dict:
+        '''
+        Returns::dict
+          Key -> value of the keys with a fact that is still trusted
+        '''
+        now = time()
+        known = {}
+        with self._lock:
+            for key in keys:
+                entry = self.facts.get(key)
+                if entry is not None and (entry[0] >= self.started or
+                                          now - entry[0] <= self.ttl):
+                    known[key] = entry[1]
+        return known
+
+    def update(self,
+               facts: dict,
+               ):
+        '''
+        Records facts, as gathered or as changed by easy_deploy.
+        '''
+        now = time()
+        with self._lock:
+            for key, value in facts.items():
+                self.facts[key] = (now, value)
+
+    def invalidate(self,
+                   keys: list=(),
+                   kinds: list=(),
+                   ):
+        '''
+        Forgets facts that may no longer hold: the given keys, and every
+        fact of the given kinds (ie. "file").
+        '''
+        prefixes = tuple('%s:' % kind for kind in kinds)
+        with self._lock:
+            for key in keys:
+                self.facts.pop(key, None)
+            if prefixes:
+                for key in [key for key in self.facts
+                            if key.startswith(prefixes)]:
+                    del self.facts[key]
+
+    def save(self,
+             ):
+        '''
+        Writes the facts to the cache file, atomically. Failures are only
+        logged.
+        '''
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps({key: list(entry)
+                               for key, entry in self.facts.items()})
+        cacheDir = os.path.dirname(self.path)
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+            fd, tmpPath = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as stream:
+                    stream.write(data)
+                os.replace(tmpPath, self.path)
+            except BaseException:
+                os.unlink(tmpPath)
+                raise
+        except OSError as e:
+            self.logger.warning('Unable to cache facts in %s: %s'
+                                % (cacheDir, e))
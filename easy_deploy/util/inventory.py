@@ -0,0 +1,93 @@
+'''
+Module used to build the list of hosts an easy_deploy run targets.
+'''
+
+import math
+
+from easy_deploy.util.constants import INVENTORY_COMMENT_CHAR
+
+class InventoryException(Exception):
+    ''' Base Exception for inventory handling '''
+
+class InventoryEmptyError(InventoryException):
+    ''' Raised if no hosts were specified for a run '''
+
+def load_inventory(filename: str,
+                   ) -> list:
+    '''
+    Load hosts from an inventory file.
+
+    The inventory file lists one host per line. Blank lines and anything
+    after a '#' are ignored.
+
+    Args:
+      filename::str
+        Path of the inventory file
+
+    Returns::list
+      List of hostnames in file order
+    '''
+    hosts = []
+    with open(filename, 'r') as stream:
+        for line in stream:
+            host = line.split(INVENTORY_COMMENT_CHAR, 1)[0].strip()
+            if host:
+                hosts.append(host)
+    return hosts
+
+def build_inventory(hosts: list=None,
+                    inventoryFile: str=None,
+                    ) -> list:
+    '''
+    Combine hosts given directly with hosts from an inventory file.
+
+    Duplicates are dropped, keeping the first occurrence.
+
+    Args:
+      hosts::list (Optional)
+        Hostnames given directly (ie. repeated --host)
+      inventoryFile::str (Optional)
+        Path of an inventory file to read hosts from
+
+    Returns::list
+      Ordered list of unique hostnames
+
+    Raises:
+      InventoryEmptyError
+        If no hosts were found
+    '''
+    allHosts = list(hosts or [])
+    if inventoryFile:
+        allHosts += load_inventory(inventoryFile)
+
+    inventory = []
+    seen = set()
+    for host in allHosts:
+        if host not in seen:
+            seen.add(host)
+            inventory.append(host)
+
+    if not inventory:
+        raise InventoryEmptyError('No hosts specified')
+
+    return inventory
+
+def resolve_count(value: str,
+                  total: int,
+                  ) -> int:
+    '''
+    Resolves a host count given as a number ("5") or as a percentage of
+    `total` ("20%", rounded up).
+
+    Raises:
+      ValueError
+        If value is neither, or negative
+    '''
+    value = str(value).strip()
+    if value.endswith('%'):
+        count = math.ceil(total * float(value[:-1]) / 100)
+    else:
+        count = int(value)
+    if count < 0:
+        raise ValueError('Negative host count: %s' % value)
+    return count
@@ -0,0 +1,212 @@
+'''
+Module used to keep a journal of the steps completed on each host, so a
+failed deployment can be resumed from where it stopped instead of being
+run again from the first step.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from urllib.parse import quote
+
+from easy_deploy.util.artifacts import file_digest
+from easy_deploy.util.debfile import is_local_deb
+
+def step_keys(runlist: list,
+              fileDir: str,
+              ) -> dict:
+    '''
+    Keys every step by its content: its options and the sha256 of the
+    local file it installs, if any. Identical steps are told apart by how
+    often they occurred before.
+
+    Args:
+      runlist::list(dict)
+        Built and verified runlist
+      fileDir::str
+        Directory local sources are relative to
+
+    Returns::dict
+      id(step) -> key of every step of the runlist
+    '''
+    keys = {}
+    seen = {}
+    for step in runlist:
+        if step.get('command') == 'installFile':
+            digest = file_digest('%s/%s' % (fileDir, step.get('localSource')))
+        elif is_local_deb(step):
+            digest = file_digest('%s/%s' % (fileDir, step.get('source')))
+        else:
+            digest = None
+        key = hashlib.sha256(json.dumps([dict(step), digest],
+                                        sort_keys=True,
+                                        default=str,
+                                        ).encode('utf-8')).hexdigest()
+        seen[key] = seen.get(key, 0) + 1
+        keys[id(step)] = '%s-%d' % (key, seen[key])
+    return keys
+
+def journal_path(journalDir: str,
+                 remoteHost: str,
+                 ) -> str:
+    '''
+    Returns the path of a host's journal in journalDir.
+    '''
+    return '%s/%s.jsonl' % (os.path.expanduser(journalDir),
+                            quote(remoteHost, safe='@.-_:'))
+
+
+class Journal:
+    def __init__(self,
+                 path: str,
+                 resume: bool=False,
+                 ):
+        '''
+        Journal of one host, one JSON object per line. Each entry is
+        flushed to disk before the run goes on, so the journal survives a
+        crash of the local host.
+
+        Args:
+          path::str
+            File the journal is kept in
+          resume::bool (Optional)
+            Carry on the journal of an earlier run (True), or start a new
+            one on the first entry (False)
+        '''
+        self.logger = logging.getLogger()
+        self.path = path
+        self.resume = resume
+        self.completed = set()
+        self.pendingRestarts = [] # Services queued but not restarted yet
+        self._stream = None
+        self._failed = False
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+
+    def _load(self,
+              ):
+        '''
+        Reads the entries of an earlier run. A last line cut short by a
+        crash is ignored.
+        '''
+        try:
+            with open(self.path, 'r') as stream:
+                lines = stream.readlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.logger.warning('Unable to read journal %s: %s'
+                                % (self.path, e))
+            return
+
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'key' in entry:
+                self.completed.add(entry['key'])
+            for service in entry.get('restarts', []):
+                if service not in self.pendingRestarts:
+                    self.pendingRestarts.append(service)
+            for service in entry.get('restarted', []):
+                if service in self.pendingRestarts:
+                    self.pendingRestarts.remove(service)
+
+    def is_completed(self,
+                     key: str,
+                     ) -> bool:
+        '''
+        Checks if a step (by step_keys key) was completed by an earlier run.
+        '''
+        return key in self.completed
+
+    def record_step(self,
+                    key: str,
+                    step: dict,
+                    index: int=None,
+                    ):
+        '''
+        Records that a step was completed.
+
+        Args:
+          key::str
+            Key of the step (see step_keys)
+          step::dict
+            The step, its command and target are recorded to be read by
+            people
+          index::int (Optional)
+            Position of the step in the runlist
+        '''
+        self._write({'key': key,
+                     'index': index,
+                     'command': step.get('command'),
+                     'target': step.get('remoteSource') or step.get('source'),
+                     'time': round(time.time(), 3),
+                     })
+
+    def record_restarts(self,
+                        services: list,
+                        ):
+        '''
+        Records that services were queued for a restart, so a resumed run
+        restarts them even though the steps that queued them are skipped.
+        '''
+        self._write({'restarts': list(services)})
+
+    def record_restarted(self,
+                         services: list,
+                         ):
+        '''
+        Records that queued services were restarted.
+        '''
+        if services:
+            self._write({'restarted': list(services)})
+
+    def _write(self,
+               entry: dict,
+               ):
+        '''
+        Appends an entry and waits for it to reach the disk. Failures are
+        logged once, the run goes on without a journal.
+        '''
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._failed:
+                return
+            try:
+                if self._stream is None:
+                    os.makedirs(os.path.dirname(self.path) or '.',
+                                exist_ok=True)
+                    self._stream = open(self.path,
+                                        'a' if self.resume else 'w')
+                self._stream.write(line)
+                self._stream.flush()
+                os.fsync(self._stream.fileno())
+            except OSError as e:
+                self._failed = True
+                self.logger.warning('Unable to write journal %s: %s'
+                                    % (self.path, e))
+
+    def close(self,
+              ):
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+
+    def remove(self,
+               ):
+        '''
+        Closes and deletes the journal, once there is nothing to resume.
+        '''
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
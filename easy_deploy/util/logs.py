@@ -0,0 +1,206 @@
+'''
+Module used to set up logging so it never holds up the hosts being
+deployed to: records are put on a queue by whichever thread logs them and
+written out by a single thread (see start_logging).
+'''
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from urllib.parse import quote
+
+from easy_deploy.util.constants import (DEFAULT_LOG_BACKUPS,
+                                        DEFAULT_LOG_FORMAT,
+                                        DEFAULT_LOG_MAX_MB,
+                                        )
+from easy_deploy.util.report import current_context
+
+MAX_OPEN_HOST_LOGS = 64 # Host log files kept open at once
+
+_plainFormatter = logging.Formatter()
+
+
+class ContextFilter(logging.Filter):
+    '''
+    Tags records with the host and step they were logged for. Records
+    already tagged (ie. relayed from the daemon) are left as they are.
+    '''
+
+    def filter(self,
+               record: logging.LogRecord,
+               ) -> bool:
+        if not hasattr(record, 'host'):
+            record.host, record.step = current_context()
+        return True
+
+
+class RecordQueueHandler(QueueHandler):
+    ''' Puts records on a queue, leaving their formatting to the writer '''
+
+    def prepare(self,
+                record: logging.LogRecord,
+                ) -> logging.LogRecord:
+        '''
+        Readies a record to be sent across threads: its arguments are
+        merged into the message and its traceback rendered, as neither
+        may be safe to use later. Unlike QueueHandler the message is not
+        formatted and the record not copied, as this is the root logger's
+        only handler.
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _plainFormatter.formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats records as JSON objects, one per line '''
+
+    def format(self,
+               record: logging.LogRecord,
+               ) -> str:
+        data = {'time': round(record.created, 6),
+                'level': record.levelname,
+                'logger': record.name,
+                'host': getattr(record, 'host', None),
+                'step': getattr(record, 'step', None),
+                'message': record.getMessage(),
+                }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class HostFileHandler(logging.Handler):
+    def __init__(self,
+                 pathPrefix: str,
+                 maxBytes: int=DEFAULT_LOG_MAX_MB * 1024 * 1024,
+                 backupCount: int=DEFAULT_LOG_BACKUPS,
+                 ):
+        '''
+        Writes the records of each host to a file of its own,
+        {pathPrefix}-{host}.log, rotated by size. Records not logged for
+        a host are left out.
+
+        Args:
+          pathPrefix::str
+            Path host names are appended to
+          maxBytes::int (Optional)
+            Size a host's file is rotated at
+          backupCount::int (Optional)
+            Rotated files kept per host
+        '''
+        super().__init__()
+        self.pathPrefix = pathPrefix
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.handlers = OrderedDict() # host -> RotatingFileHandler
+
+    def emit(self,
+             record: logging.LogRecord,
+             ):
+        host = getattr(record, 'host', None)
+        if host is None:
+            return
+        handler = self.handlers.pop(host, None)
+        if handler is None:
+            handler = RotatingFileHandler(
+                '%s-%s.log' % (self.pathPrefix, quote(host, safe='@.-_:')),
+                maxBytes=self.maxBytes,
+                backupCount=self.backupCount,
+                delay=True)
+            handler.setFormatter(self.formatter)
+        self.handlers[host] = handler
+        # Hosts logged to least recently have their file closed, so
+        # hundreds of hosts do not hold hundreds of files open
+        if len(self.handlers) > MAX_OPEN_HOST_LOGS:
+            _, oldest = self.handlers.popitem(last=False)
+            oldest.close()
+        handler.emit(record)
+
+    def close(self,
+              ):
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers.clear()
+        super().close()
+
+
+def start_logging(logFile: str,
+                  level: int=logging.INFO,
+                  printLog: bool=False,
+                  jsonLines: bool=False,
+                  hostLogPrefix: str=None,
+                  maxBytes: int=DEFAULT_LOG_MAX_MB * 1024 * 1024,
+                  backupCount: int=DEFAULT_LOG_BACKUPS,
+                  ) -> QueueListener:
+    '''
+    Routes every record of the root logger through a queue to a single
+    writer thread, which is stopped (and the queue flushed) on exit.
+
+    Args:
+      logFile::str
+        File every record is written to, its directory is created
+      level::int (Optional)
+        Level of the root logger
+      printLog::bool (Optional)
+        Also print records to stdout
+      jsonLines::bool (Optional)
+        Write files as JSON lines with host and step fields, instead of
+        text (stdout stays text)
+      hostLogPrefix::str (Optional)
+        Also write each host's records to a file of its own, see
+        HostFileHandler
+      maxBytes::int (Optional)
+        Size host files are rotated at
+      backupCount::int (Optional)
+        Rotated files kept per host
+
+    Returns::QueueListener
+      The running writer
+    '''
+    os.makedirs(os.path.dirname(logFile) or '.', exist_ok=True)
+    textFormatter = logging.Formatter(DEFAULT_LOG_FORMAT)
+    fileFormatter = JsonFormatter() if jsonLines else textFormatter
+
+    handlers = [logging.FileHandler(logFile)]
+    handlers[0].setFormatter(fileFormatter)
+    if hostLogPrefix:
+        os.makedirs(os.path.dirname(hostLogPrefix) or '.', exist_ok=True)
+        handlers.append(HostFileHandler(hostLogPrefix,
+                                        maxBytes=maxBytes,
+                                        backupCount=backupCount))
+        handlers[-1].setFormatter(fileFormatter)
+    if printLog:
+        handlers.append(logging.StreamHandler(sys.stdout))
+        handlers[-1].setFormatter(textFormatter)
+
+    records = queue.SimpleQueue()
+    queueHandler = RecordQueueHandler(records)
+    queueHandler.addFilter(ContextFilter())
+    listener = QueueListener(records, *handlers)
+
+    rootLogger = logging.getLogger()
+    rootLogger.addHandler(queueHandler)
+    rootLogger.setLevel(level)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        for handler in handlers:
+            handler.close()
+
+    atexit.register(stop)
+    return listener
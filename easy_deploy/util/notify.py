@@ -0,0 +1,115 @@
+'''
+Module used to collect service restarts requested by steps and run them
+once, after the steps that requested them.
+'''
+
+import asyncio
+import logging
+import threading
+
+from easy_deploy.util.aio import run_sync
+from easy_deploy.util.constants import DEFAULT_SSH_MAX_SESSIONS
+from easy_deploy.util.report import RunReport
+
+
+class RestartNotifier:
+    def __init__(self,
+                 runner,
+                 hostname: str,
+                 report: RunReport=None,
+                 journal=None,
+                 ):
+        '''
+        Args:
+          runner::Runner
+            Runner used to restart services on the host
+          hostname::str
+            Name of host the restarts are for (used for logging)
+          report::RunReport (Optional)
+            Report to time each restart in
+          journal::Journal (Optional)
+            Journal to record queued and finished restarts in
+        '''
+        self.runner = runner
+        self.hostname = hostname
+        self.report = report or RunReport()
+        self.journal = journal
+        self.logger = logging.getLogger()
+        self.pending = [] # Services in order of first notification
+        self._lock = threading.Lock()
+
+    def notify(self,
+               services: (str, list),
+               ):
+        '''
+        Queue a restart of one or more services.
+
+        A service already queued is not queued again.
+
+        Args:
+          services::str/list
+            Service name or list of service names to restart
+        '''
+        if type(services) is not list:
+            services = [services]
+
+        with self._lock:
+            for service in services:
+                if service not in self.pending:
+                    self.pending.append(service)
+
+        if self.journal is not None:
+            self.journal.record_restarts(services)
+
+    def flush(self,
+              ) -> bool:
+        '''
+        Restart every queued service once. Different services are
+        restarted concurrently.
+
+        Returns::bool
+          True if all services restarted, False if any failed
+        '''
+        with self._lock:
+            services, self.pending = self.pending, []
+        if not services:
+            return True
+
+        msg = '%s: Restarting %s' % (self.hostname, ', '.join(services))
+        self.logger.info(msg)
+
+        results = run_sync(self._restart_all(services))
+        if self.journal is not None:
+            self.journal.record_restarted([service for service, success
+                                           in zip(services, results)
+                                           if success])
+
+        for service, success in zip(services, results):
+            if not success:
+                err = '%s: Unable to restart service "%s"' % (self.hostname,
+                                                              service)
+                self.logger.error(err)
+
+        return all(results)
+
+    async def _restart_all(self,
+                           services: list,
+                           ) -> list:
+        '''
+        Restart services concurrently, at most DEFAULT_SSH_MAX_SESSIONS at
+        a time so they fit on the host's master session.
+
+        Returns::list(bool)
+          True/False status of success for each service, in order
+        '''
+        semaphore = asyncio.Semaphore(DEFAULT_SSH_MAX_SESSIONS)
+
+        async def restart(service: str) -> bool:
+            async with semaphore:
+                with self.report.span('restart', service) as span:
+                    success = await self.runner.arestart_service(service)
+                    span.fields['success'] = success
+                return success
+
+        return await asyncio.gather(*[restart(service)
+                                      for service in services])
@@ -2,6 +2,9 @@
 Module used to interact with easy_deploy requirements.
 '''
 
+from collections.abc import Mapping
+from types import MappingProxyType
+
 from easy_deploy.util.config_requirements_def import (COMMANDS,
                                                       UNIVERSAL_OPTIONS)
 
@@ -11,6 +14,90 @@ class OptionMenuException(Exception):
 class CommandNotFoundError(OptionMenuException):
     ''' Raised if a command name is not found in requirements '''
 
+class CommandSchema:
+    ''' Immutable, precompiled requirements of one command '''
+
+    __slots__ = ('name', 'mandatory', 'mandatoryOrder', 'allowed', 'defaults')
+
+    def __init__(self,
+                 name: str,
+                 entry: dict,
+                 ):
+        '''
+        Args:
+          name::str
+            Command name
+          entry::dict
+            Command definition from COMMANDS
+        '''
+        optional = entry.get('optional', {})
+        set_ = object.__setattr__
+        set_(self, 'name', name)
+        set_(self, 'mandatoryOrder', tuple(entry.get('mandatory')))
+        set_(self, 'mandatory', frozenset(self.mandatoryOrder))
+        set_(self, 'allowed', frozenset(UNIVERSAL_OPTIONS).union(
+            self.mandatory, optional))
+        set_(self, 'defaults', MappingProxyType(dict(optional)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('CommandSchema is immutable')
+
+# Compiled once, command name -> CommandSchema
+SCHEMA = MappingProxyType({name: CommandSchema(name, entry)
+                           for name, entry in COMMANDS.items()})
+
+class Step(Mapping):
+    '''
+    A verified config block. Options the block leaves out are read from
+    its command's shared defaults instead of being copied into it.
+    '''
+
+    __slots__ = ('block',)
+
+    def __init__(self,
+                 block: dict,
+                 ):
+        '''
+        Args:
+          block::dict
+            Verified config block, as loaded (it is not modified)
+        '''
+        self.block = block
+
+    def __getitem__(self, key):
+        try:
+            return self.block[key]
+        except KeyError:
+            return SCHEMA[self.block['command']].defaults[key]
+
+    def get(self, key, default=None):
+        value = self.block.get(key, self)
+        if value is self:
+            return SCHEMA[self.block['command']].defaults.get(key, default)
+        return value
+
+    def __contains__(self, key):
+        return (key in self.block
+                or key in SCHEMA[self.block['command']].defaults)
+
+    def __iter__(self):
+        yield from self.block
+        for key in SCHEMA[self.block['command']].defaults:
+            if key not in self.block:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __getstate__(self):
+        return self.block
+
+    def __setstate__(self, block):
+        self.block = block
+
 class OptionMenu:
     def get_all_option_names(self,
                              command: str,
@@ -37,6 +124,29 @@ class OptionMenu:
 
         return options
 
+    def get_schema(self,
+                   command: str,
+                   ) -> CommandSchema:
+        '''
+        Returns the compiled requirements of the inputted command.
+
+        Args:
+          command::str
+            Command name to retrieve the schema for
+
+        Returns::CommandSchema
+          Shared, immutable schema of the command
+
+        Raises:
+          CommandNotFoundException
+            If no command definition is found
+        '''
+        try:
+            return SCHEMA[command]
+        except (KeyError, TypeError):
+            err = 'Command not found: %s' % command
+            raise CommandNotFoundError(err)
+
     def get_mandatory_option_names(self,
                                    command: str,
                                    ) -> list:
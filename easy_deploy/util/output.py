@@ -0,0 +1,112 @@
+'''
+Module used to handle output of commands run by easy_deploy.
+'''
+
+from collections import deque
+
+from easy_deploy.util.constants import DEFAULT_OUTPUT_BUFFER_KB, MAX_LINE_BYTES
+
+
+class RingBuffer:
+    def __init__(self,
+                 maxBytes: int=DEFAULT_OUTPUT_BUFFER_KB * 1024,
+                 ):
+        '''
+        Keeps the last `maxBytes` of the data appended to it, so memory
+        stays flat however much is written.
+
+        Args:
+          maxBytes::int (Optional)
+            Number of most recent bytes to keep
+        '''
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.dropped = 0 # Bytes discarded from the front
+        self._chunks = deque()
+
+    def append(self,
+               data: bytes,
+               ):
+        '''
+        Append data, discarding the oldest data past maxBytes.
+
+        Args:
+          data::bytes
+            Data to append
+        '''
+        if len(data) > self.maxBytes:
+            self.dropped += len(data) - self.maxBytes
+            data = data[-self.maxBytes:]
+        self._chunks.append(data)
+        self.size += len(data)
+
+        while self.size > self.maxBytes:
+            excess = self.size - self.maxBytes
+            oldest = self._chunks[0]
+            if len(oldest) <= excess:
+                self._chunks.popleft()
+                self.size -= len(oldest)
+                self.dropped += len(oldest)
+            else:
+                self._chunks[0] = oldest[excess:]
+                self.size -= excess
+                self.dropped += excess
+
+    def getvalue(self,
+                 ) -> str:
+        '''
+        Returns::str
+          The kept data, decoded (undecodable bytes are replaced)
+        '''
+        return b''.join(self._chunks).decode('utf-8', 'replace')
+
+
+class LineSplitter:
+    def __init__(self,
+                 onLine,
+                 ):
+        '''
+        Splits a stream of chunks into lines.
+
+        A line longer than MAX_LINE_BYTES is passed on in pieces so a
+        single huge line cannot grow memory without bound.
+
+        Args:
+          onLine::callable
+            Called with each line (bytes, including its newline)
+        '''
+        self.onLine = onLine
+        self._partial = b''
+
+    def feed(self,
+             data: bytes,
+             ):
+        '''
+        Feed a chunk of the stream.
+
+        Args:
+          data::bytes
+            Next chunk of the stream
+        '''
+        data = self._partial + data
+        start = 0
+        while True:
+            end = data.find(b'\n', start)
+            if end == -1:
+                break
+            self.onLine(data[start:end + 1])
+            start = end + 1
+        self._partial = data[start:]
+
+        while len(self._partial) > MAX_LINE_BYTES:
+            self.onLine(self._partial[:MAX_LINE_BYTES])
+            self._partial = self._partial[MAX_LINE_BYTES:]
+
+    def close(self,
+              ):
+        '''
+        Flush an unterminated last line.
+        '''
+        if self._partial:
+            self.onLine(self._partial)
+            self._partial = b''
@@ -2,9 +2,21 @@
 Module used to parse/verify an easy_deploy config.
 '''
 
+import logging
+import os
 import yaml
 
-from easy_deploy.util.options_menu import OptionMenu, CommandNotFoundError
+from easy_deploy.util.options_menu import (CommandNotFoundError,
+                                           OptionMenu,
+                                           Step,
+                                           )
+from easy_deploy.util.runlist_cache import RunlistCache
+from easy_deploy.util.scheduler import find_cycle, get_after_ids
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError: # PyYAML built without libyaml
+    from yaml import SafeLoader
 
 class EasyDeployParserException(Exception):
     ''' General Parser Exception '''
@@ -18,8 +30,17 @@ class EasyDeployConfigError(EasyDeployParserException):
 class EasyDeployParser:
 
     def __init__(self,
+                 cacheDir: str=None,
                  ):
+        '''
+        Args:
+          cacheDir::str (Optional)
+            Directory to cache compiled runlists in. No caching if None.
+        '''
+        self.logger = logging.getLogger()
         self.optionMenu = OptionMenu()
+        self.cache = RunlistCache(cacheDir) if cacheDir else None
+        self.fragments = {} # Content hash -> entries of parsed files
 
     def build(self,
               filename: str,
@@ -27,6 +48,12 @@ class EasyDeployParser:
         '''
         Builds the command queue from a easy_deploy config file
 
+        A config may hold several YAML documents and pull in other config
+        files with `- include: path` blocks (paths relative to the file
+        including them). Every file is parsed and verified once and kept,
+        by content hash, in memory and in the runlist cache, so only
+        changed files are processed again.
+
         Args:
           filename::str
             Name of the config file to parse
@@ -34,57 +61,162 @@ class EasyDeployParser:
         Returns::list(dict)
           List of built commands in dict form
         '''
-        config = self._load(filename)
-        runlist = []
-        errors = self._parse(config)
+        errors = []
+        runlist = list(self.iter_steps(filename, errors))
 
         if not errors:
-            runlist += self._build_with_optionals(config)
+            errors = self._verify_dependencies(runlist)
 
+        if errors:
+            return [], errors
         return runlist, errors
 
+    def iter_steps(self,
+                   filename: str,
+                   errors: list,
+                   parents: tuple=(),
+                   ):
+        '''
+        Lazily yields the steps of a config file, expanding its includes.
+
+        Dependencies (`id`/`after`) across files are not verified here.
+
+        Args:
+          filename::str
+            Name of the config file to parse
+          errors::list
+            List that any errors found are appended to
+          parents::tuple (Optional)
+            Paths of the files including this one
+
+        Yields::Step
+          Verified steps in config order. Each is a Step of its own, even
+          if its file is included more than once (or parsed before), as
+          steps are told apart by identity (see journal.step_keys).
+        '''
+        path = os.path.abspath(filename)
+        if path in parents:
+            chain = parents[parents.index(path):] + (path,)
+            errors.append('Include loop: %s' % ' -> '.join(chain))
+            return
+
+        try:
+            entries = self._load_fragment(path, errors, bool(parents))
+        except OSError as e:
+            if not parents:
+                raise
+            errors.append('%s: Unable to read include: %s' % (parents[-1], e))
+            return
+
+        for entry in entries:
+            if isinstance(entry, Step):
+                yield Step(entry.block)
+                continue
+            includes = entry['include']
+            if type(includes) is not list:
+                includes = [includes]
+            for include in includes:
+                include = os.path.join(os.path.dirname(path), include)
+                yield from self.iter_steps(include, errors, parents + (path,))
+
+    def _load_fragment(self,
+                       path: str,
+                       errors: list,
+                       included: bool,
+                       ) -> list:
+        '''
+        Loads and verifies a single config file, without its includes
+
+        Args:
+          path::str
+            Absolute path of the config file
+          errors::list
+            List that any errors found are appended to
+          included::bool
+            True if the file was included, errors are then prefixed
+            with its path
+
+        Returns::list
+          Steps and (unexpanded) include blocks, empty list on errors
+        '''
+        with open(path, 'rb') as stream:
+            contents = stream.read()
+
+        key = RunlistCache.key(contents)
+        entries = self.fragments.get(key)
+        if entries is None and self.cache:
+            blocks = self.cache.get(key)
+            if blocks is not None:
+                self.logger.debug('Using cached runlist for %s' % path)
+                entries = self._build_with_optionals(blocks)
+
+        if entries is None:
+            try:
+                config = self._load(contents)
+            except EasyDeployConfigError as e:
+                fragmentErrors = ['Unable to load config: %s' % e]
+            else:
+                fragmentErrors = self._parse(config)
+            if fragmentErrors:
+                if included:
+                    fragmentErrors = ['%s: %s' % (path, err)
+                                      for err in fragmentErrors]
+                errors.extend(fragmentErrors)
+                return []
+            entries = self._build_with_optionals(config)
+            if self.cache:
+                self.cache.put(key, config)
+
+        self.fragments[key] = entries
+        return entries
+
     def _build_with_optionals(self,
                               config: list,
                               ) -> list:
         '''
-        Appends any missing optional config options to the config
+        Wraps each config block into a Step, which fills in any missing
+        optional options from its command's shared defaults. Include
+        blocks are passed through as they are.
 
         Args:
           config::list
             List of config blocks of easy_deploy config
 
-        Returns::list
-          List of dictionaries containing the filled in options
+        Returns::list(Step)
+          List of steps (read-only mappings) with the filled in options
         '''
-        runlist = []
-        for block in config:
-            command = block.get('command')
-            optional_dict = self.optionMenu.get_optional_options(command)
-            for k, v in optional_dict.items():
-                if k not in block:
-                    block[k] = v
-            runlist.append(block)
-        return runlist
+        return [block if 'include' in block else Step(block)
+                for block in config]
 
     def _load(self,
-             filename: str,
-             ):
+             contents: bytes,
+             ) -> list:
         '''
-        Load filename (expected YAML format)
+        Load a config (expected YAML format), with libyaml if available
+
+        Every YAML document in the stream must be a list of blocks (or
+        empty), their blocks are concatenated in order.
 
         Args:
-          filename::str
-            Name of YAML file to load
+          contents::bytes
+            Raw contents of the YAML file
 
-        Returns:
+        Returns::list
+          List of config blocks of all documents
         '''
-        with open(filename, 'r') as stream:
-            try:
-                contents = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                raise EasyDeployConfigError(exc)
+        config = []
+        try:
+            for document in yaml.load_all(contents, Loader=SafeLoader):
+                if document is None:
+                    continue
+                if not isinstance(document, list):
+                    err = 'YAML documents must be lists of blocks'
+                    raise EasyDeployConfigError(err)
+                config += document
+        except yaml.YAMLError as exc:
+            raise EasyDeployConfigError(exc)
 
-        return contents
+        return config
 
     def _parse(self,
               config: list,
@@ -101,12 +233,92 @@ class EasyDeployParser:
         '''
         errors = []
         for block in config:
-            err = self._verify_block(block)
+            if not isinstance(block, dict):
+                errors.append('Block: %s\n  - Not a mapping' % (block,))
+                continue
+            if 'include' in block:
+                err = self._verify_include(block)
+            else:
+                err = self._verify_block(block)
             if err:
                 errStr = "Block: %s\n  - %s" % (block, "\n  - ".join(err))
                 errors.append(errStr)
         return errors
 
+    def _verify_dependencies(self,
+                             config: list,
+                             ) -> list:
+        '''
+        Verifies the `id`/`after` options of an easy_deploy config.
+
+        Ids must be unique, every `after` must name an existing id and
+        the dependencies must not form a cycle.
+
+        Args:
+          config::list
+            List of (individually verified) config blocks
+
+        Returns::list
+          List of any errors found. Empty if none.
+        '''
+        errors = []
+        ids = set()
+        dependents = []
+        for block in config:
+            if 'after' in block:
+                dependents.append(block)
+            if 'id' not in block:
+                continue
+            stepId = block['id']
+            if type(stepId) not in (str, int):
+                errors.append('Block: %s\n  - Option "id" must be a string '
+                              'or integer' % block)
+            elif stepId in ids:
+                errors.append('Block: %s\n  - Duplicate id "%s"'
+                              % (block, stepId))
+            else:
+                ids.add(stepId)
+
+        # Only steps with an `after` can reference ids or form a cycle
+        for block in dependents:
+            for stepId in get_after_ids(block):
+                if type(stepId) not in (str, int) or stepId not in ids:
+                    errors.append('Block: %s\n  - Option "after" references '
+                                  'unknown id "%s"' % (block, stepId))
+
+        if dependents and not errors:
+            cycle = find_cycle(config)
+            if cycle:
+                errors.append('Dependency cycle: %s'
+                              % ' -> '.join(str(stepId) for stepId in cycle))
+
+        return errors
+
+    def _verify_include(self,
+                        block: dict,
+                        ) -> list:
+        '''
+        Verifies an include block of an easy_deploy config file.
+
+        Args:
+          block::dict
+            Block with an `include` option
+
+        Returns::list
+          List of any errors found. Empty if none.
+        '''
+        errors = []
+        includes = block['include']
+        if type(includes) is not list:
+            includes = [includes]
+        if not includes or any(type(path) is not str for path in includes):
+            errors.append('Option "include" must be a path or list of paths')
+
+        for key in block:
+            if key != 'include':
+                errors.append('Option: "%s" not allowed with include' % key)
+        return errors
+
     def _verify_block(self,
                       block: dict,
                       ) -> str:
@@ -124,27 +336,26 @@ class EasyDeployParser:
         command = block.get('command')
         if not command:
             errors.append('No command specified')
-        else:
-            try:
-                self.optionMenu.verify_command(command)
-            except CommandNotFoundError:
-                err = '%s is not a valid command' % command
-                errors.append(err)
-            else:
-                all_options = self.optionMenu.get_all_option_names(command)
-                mand = self.optionMenu.get_mandatory_option_names(command)
-                block_keys = block.keys()
-
-                # Verify all mandatory options are set
-                for option in mand:
-                    if option not in block_keys:
-                        errMsg = 'Mandatory option "%s" not set' % option
-                        errors.append(errMsg)
-
-                # Verify all options set are known options
-                for key in block.keys():
-                    if key not in all_options:
-                        err = 'Option: "%s" not recognized' % key
-                        errors.append(err)
-        return errors
+            return errors
+
+        try:
+            schema = self.optionMenu.get_schema(command)
+        except CommandNotFoundError:
+            err = '%s is not a valid command' % command
+            errors.append(err)
+            return errors
 
+        # Verify all mandatory options are set
+        if not schema.mandatory.issubset(block):
+            for option in schema.mandatoryOrder:
+                if option not in block:
+                    errMsg = 'Mandatory option "%s" not set' % option
+                    errors.append(errMsg)
+
+        # Verify all options set are known options
+        if not schema.allowed.issuperset(block):
+            for key in block:
+                if key not in schema.allowed:
+                    err = 'Option: "%s" not recognized' % key
+                    errors.append(err)
+        return errors
@@ -0,0 +1,320 @@
+'''
+The easy_deploy agent, run on remote hosts in agent mode (see agent.Agent).
+
+Its source is sent over the stdin of a single ssh session and run by the
+host's python3, so nothing needs to be installed on the host and this
+module must only use the standard library (of Python 3.5 and later).
+
+Requests and results are frames on stdin and stdout: a header of two
+big-endian uint32s (length of a JSON object, length of a payload), the
+JSON object and the payload bytes. Every request carries an id and is
+handled in its own thread, so requests run concurrently and results may
+come back in any order:
+
+  {"id": 1, "op": "exec", "argv": [...], "timeout": 30, "data": true}
+  {"id": 1, "op": "data"} + payload       stdin of request 1, empty = EOF
+  {"id": 1, "event": "credit"}            a data chunk of request 1 was taken
+  {"id": 1, "event": "output", "stream": "stdout"} + payload (a line)
+  {"id": 1, "event": "result", "returncode": 0}
+
+A request that fails answers with {"event": "result", "error": "..."}.
+A sender keeps at most MAX_QUEUED_CHUNKS data chunks of a request unanswered
+by credits, so data waiting for a slow request is queued without ever
+holding up the reading of frames for the others.
+The agent exits when its stdin is closed.
+'''
+
+import grp
+import json
+import os
+import platform
+import pwd
+import queue
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+FRAME_HEADER = struct.Struct('>II')
+READ_CHUNK_BYTES = 1 << 20
+MAX_LINE_BYTES = 64 * 1024
+MAX_QUEUED_CHUNKS = 16 # Data chunks a sender may have in flight per request
+
+# Put on a request's data queue when the sender gave up on the data
+ABORT = object()
+
+
+class RemoteAgent:
+    def __init__(self,
+                 stdin,
+                 stdout,
+                 ):
+        '''
+        Args:
+          stdin::io.BufferedReader
+            Stream requests are read from
+          stdout::io.BufferedWriter
+            Stream results are written to
+        '''
+        self.stdin = stdin
+        self.stdout = stdout
+        self._inputs = {} # request id -> queue of data chunks
+        self._lock = threading.Lock()
+        self._writeLock = threading.Lock()
+
+    def send(self,
+             message: dict,
+             payload: bytes=b'',
+             ):
+        data = json.dumps(message).encode('utf-8')
+        with self._writeLock:
+            self.stdout.write(FRAME_HEADER.pack(len(data), len(payload)))
+            self.stdout.write(data)
+            self.stdout.write(payload)
+            self.stdout.flush()
+
+    def _read_exactly(self,
+                      size: int,
+                      ) -> bytes:
+        '''
+        Returns the next `size` bytes of stdin, None at its end.
+        '''
+        data = b''
+        while len(data) < size:
+            chunk = self.stdin.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def serve(self,
+              ):
+        '''
+        Handles requests until stdin is closed.
+        '''
+        while True:
+            header = self._read_exactly(FRAME_HEADER.size)
+            if header is None:
+                return
+            size, payloadSize = FRAME_HEADER.unpack(header)
+            message = json.loads(self._read_exactly(size).decode('utf-8'))
+            payload = self._read_exactly(payloadSize) if payloadSize else b''
+
+            if message.get('op') == 'data':
+                with self._lock:
+                    inputs = self._inputs.get(message.get('id'))
+                if inputs is not None:
+                    inputs.put(ABORT if message.get('abort') else payload)
+                continue
+
+            if message.get('data'):
+                # Not bounded here: senders wait for credits instead
+                with self._lock:
+                    self._inputs[message.get('id')] = queue.Queue()
+            threading.Thread(target=self.handle,
+                             args=(message,),
+                             daemon=True).start()
+
+    def handle(self,
+               message: dict,
+               ):
+        '''
+        Runs a request and sends its result.
+        '''
+        requestId = message.get('id')
+        with self._lock:
+            inputs = self._inputs.get(requestId)
+        try:
+            handler = getattr(self, 'op_%s' % message.get('op'), None)
+            if handler is None:
+                raise ValueError('Unknown op: %s' % message.get('op'))
+            result = handler(message, inputs)
+        except Exception as e:
+            result = {'error': '%s: %s' % (type(e).__name__, e)}
+        finally:
+            with self._lock:
+                self._inputs.pop(requestId, None)
+            if inputs is not None:
+                _drain(inputs)
+
+        result.update(id=requestId, event='result')
+        self.send(result)
+
+    def op_ping(self,
+                message: dict,
+                inputs: queue.Queue,
+                ) -> dict:
+        return {'pid': os.getpid(),
+                'python': platform.python_version(),
+                }
+
+    def op_install(self,
+                   message: dict,
+                   inputs: queue.Queue,
+                   ) -> dict:
+        '''
+        Installs a file at message["path"] with its mode (octal string),
+        owner and group (names, empty to leave as is). The content is the
+        request's data, or a copy of the file at message["source"]. The
+        file is written beside its target and renamed into place.
+        '''
+        target = message['path']
+        uid = pwd.getpwnam(message['owner']).pw_uid \
+              if message.get('owner') else -1
+        gid = grp.getgrnam(message['group']).gr_gid \
+              if message.get('group') else -1
+
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(target) or '/',
+                                       prefix='.easy_deploy-')
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                if message.get('source'):
+                    with open(message['source'], 'rb') as source:
+                        for chunk in iter(lambda: source.read(READ_CHUNK_BYTES),
+                                          b''):
+                            stream.write(chunk)
+                else:
+                    while True:
+                        chunk = self._take(message['id'], inputs)
+                        if chunk is ABORT:
+                            raise IOError('Transfer aborted by sender')
+                        if not chunk:
+                            break
+                        stream.write(chunk)
+                if uid != -1 or gid != -1:
+                    os.fchown(stream.fileno(), uid, gid)
+                os.fchmod(stream.fileno(), int(message.get('mode', '0644'), 8))
+            os.replace(tmpPath, target)
+        except BaseException:
+            try:
+                os.unlink(tmpPath)
+            except OSError:
+                pass
+            raise
+        return {'ok': True}
+
+    def op_exec(self,
+                message: dict,
+                inputs: queue.Queue,
+                ) -> dict:
+        '''
+        Runs message["argv"] (no shell), streaming its output lines back,
+        with the request's data as stdin. It is killed, with anything it
+        started, after message["timeout"] seconds.
+
+        Returns {"returncode": int}, plus "timedOut": true if killed.
+        '''
+        process = subprocess.Popen(
+            message['argv'],
+            stdin=subprocess.PIPE if inputs is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd='/',
+            start_new_session=True)
+
+        threads = [threading.Thread(target=self._pump,
+                                    args=(message['id'], name, stream),
+                                    daemon=True)
+                   for name, stream in (('stdout', process.stdout),
+                                        ('stderr', process.stderr))]
+        if inputs is not None:
+            threads.append(threading.Thread(target=self._feed,
+                                            args=(message['id'],
+                                                  process,
+                                                  inputs),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+
+        result = {}
+        try:
+            result['returncode'] = process.wait(message.get('timeout'))
+        except subprocess.TimeoutExpired:
+            _kill(process)
+            result['returncode'] = process.wait()
+            result['timedOut'] = True
+        for thread in threads[:2]:
+            thread.join()
+        return result
+
+    def _pump(self,
+              requestId: int,
+              name: str,
+              stream,
+              ):
+        '''
+        Sends a process stream line by line as output events.
+        '''
+        for line in iter(lambda: stream.readline(MAX_LINE_BYTES), b''):
+            self.send({'id': requestId, 'event': 'output', 'stream': name},
+                      line)
+        stream.close()
+
+    def _take(self,
+              requestId: int,
+              inputs: queue.Queue,
+              ) -> bytes:
+        '''
+        Returns the next data chunk of a request (empty at its end, ABORT
+        if the sender gave up), granting the sender a credit for another.
+        '''
+        chunk = inputs.get()
+        if chunk and chunk is not ABORT:
+            self.send({'id': requestId, 'event': 'credit'})
+        return chunk
+
+    def _feed(self,
+              requestId: int,
+              process: subprocess.Popen,
+              inputs: queue.Queue,
+              ):
+        '''
+        Writes a request's data to the stdin of its process.
+        '''
+        try:
+            while True:
+                chunk = self._take(requestId, inputs)
+                if chunk is ABORT:
+                    _kill(process)
+                    break
+                if not chunk:
+                    break
+                process.stdin.write(chunk)
+                process.stdin.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+
+def _drain(inputs: queue.Queue,
+           ):
+    '''
+    Discards data still queued for a finished request.
+    '''
+    while True:
+        try:
+            inputs.get_nowait()
+        except queue.Empty:
+            return
+
+def _kill(process: subprocess.Popen,
+          ):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def main():
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    # Nothing but frames may be written to stdout
+    sys.stdout = sys.stderr
+    RemoteAgent(stdin, stdout).serve()
+
+if __name__ == '__main__':
+    main()
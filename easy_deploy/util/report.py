@@ -0,0 +1,201 @@
+'''
+Module used to time the phases of a deployment and write a
+machine-readable report of them.
+
+Work is timed in nested spans (run phase, host, step, transfer, restart).
+Connection records the time it spends connecting, transferring and
+executing remotely, and the bytes it sends, against the innermost span
+of the current context (see record_phase). The totals roll up into every
+enclosing span.
+'''
+
+import contextvars
+import json
+import threading
+
+from contextlib import contextmanager
+from time import perf_counter, time
+
+PHASES = ('connect', 'transfer', 'remoteExec')
+
+_currentSpan = contextvars.ContextVar('easy_deploy_span', default=None)
+_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self,
+                 kind: str,
+                 name: str,
+                 host: str=None,
+                 parent=None,
+                 **fields,
+                 ):
+        '''
+        Args:
+          kind::str
+            Kind of span (ie. run, host, step, transfer, restart)
+          name::str
+            Name of what is timed (ie. step command, service)
+          host::str (Optional)
+            Host the span is for
+          parent::Span (Optional)
+            Enclosing span, receives this span's phase totals
+          fields::dict
+            Extra fields to report
+        '''
+        self.kind = kind
+        self.name = name
+        self.host = host
+        self.parent = parent
+        self.fields = fields
+        self.start = time()
+        self.duration = None
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.bytes = 0
+
+    def to_dict(self,
+                ) -> dict:
+        '''
+        Returns::dict
+          JSON serializable representation of the span
+        '''
+        data = {'kind': self.kind,
+                'name': self.name,
+                'host': self.host,
+                'start': round(self.start, 6),
+                'duration': round(self.duration or 0.0, 6),
+                'bytes': self.bytes,
+                }
+        data.update({phase: round(seconds, 6)
+                     for phase, seconds in self.phases.items()})
+        data.update(self.fields)
+        return data
+
+
+def record_phase(phase: str,
+                 seconds: float,
+                 transferred: int=0,
+                 ):
+    '''
+    Adds time (and bytes sent) to the current span and its parents.
+    Nothing is recorded outside of a span.
+
+    Args:
+      phase::str
+        One of PHASES
+      seconds::float
+        Time spent
+      transferred::int (Optional)
+        Bytes sent to the remote host
+    '''
+    span = _currentSpan.get()
+    with _lock:
+        while span is not None:
+            span.phases[phase] += seconds
+            span.bytes += transferred
+            span = span.parent
+
+def current_context(
+                    ) -> (str, str):
+    '''
+    Returns::(str, str)
+      Host and step (command) the current span is for, None for either
+      outside of one
+    '''
+    span = _currentSpan.get()
+    host = span.host if span is not None else None
+    while span is not None and span.kind != 'step':
+        span = span.parent
+    return host, span.name if span is not None else None
+
+
+class RunReport:
+    def __init__(self,
+                 ):
+        '''
+        Collects the spans of a run.
+        '''
+        self.spans = []
+
+    @contextmanager
+    def span(self,
+             kind: str,
+             name: str,
+             host: str=None,
+             **fields,
+             ):
+        '''
+        Times the enclosed block as a span nested in the current one.
+
+        Args:
+          kind::str
+            Kind of span (ie. run, host, step, transfer, restart)
+          name::str
+            Name of what is timed
+          host::str (Optional)
+            Host the span is for (inherited from the enclosing span)
+          fields::dict
+            Extra fields to report. More may be set on the yielded span's
+            `fields` (ie. status).
+
+        Yields::Span
+          The span being timed
+        '''
+        parent = _currentSpan.get()
+        if host is None and parent is not None:
+            host = parent.host
+        span = Span(kind, name, host=host, parent=parent, **fields)
+        token = _currentSpan.set(span)
+        startTime = perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = perf_counter() - startTime
+            _currentSpan.reset(token)
+            with _lock:
+                self.spans.append(span)
+
+    def summary(self,
+                ) -> dict:
+        '''
+        Returns::dict
+          Spans grouped as {'run': [...], 'hosts': {host: {...}}}, where
+          each host entry holds its totals and its steps, transfers and
+          restarts in start order
+        '''
+        with _lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+
+        summary = {'run': [], 'hosts': {}}
+        for span in spans:
+            data = span.to_dict()
+            if span.host is None:
+                summary['run'].append(data)
+                continue
+            host = summary['hosts'].setdefault(span.host, {})
+            if span.kind == 'host':
+                host.update(data)
+            else:
+                host.setdefault('%ss' % span.kind, []).append(data)
+        return summary
+
+    def write(self,
+              filename: str,
+              ):
+        '''
+        Writes the report. A filename ending in .jsonl gets one JSON span
+        per line, anything else a single JSON document (see summary).
+
+        Args:
+          filename::str
+            Path to write the report to
+        '''
+        with open(filename, 'w') as stream:
+            if filename.endswith('.jsonl'):
+                with _lock:
+                    spans = sorted(self.spans, key=lambda span: span.start)
+                for span in spans:
+                    stream.write(json.dumps(span.to_dict()) + '\n')
+            else:
+                json.dump(self.summary(), stream, indent=2)
+                stream.write('\n')
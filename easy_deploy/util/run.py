@@ -3,63 +3,768 @@ Entrypoint for running the deployment. This contains instructions
 for successfully running through a deployment (run_deployment function).
 '''
 
+import contextvars
 import logging
-import sys
+import threading
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import groupby
+
+from easy_deploy.util.artifacts import collect_artifacts
 from easy_deploy.util.cmd_runner import Runner
-from easy_deploy.util.connection import Connection
-from easy_deploy.util.constants import DEFAULT_FILE_DIRNAME
-from easy_deploy.util.parser import EasyDeployParser
+from easy_deploy.util.connection import Connection, ssh_port
+from easy_deploy.util.constants import (DEFAULT_BANDWIDTH_LIMIT_KB,
+                                        DEFAULT_CONCURRENCY,
+                                        DEFAULT_DISTRIBUTION_FANOUT,
+                                        DEFAULT_DISTRIBUTION_SEEDS,
+                                        DEFAULT_FACT_CACHE_DIR,
+                                        DEFAULT_FACT_TTL,
+                                        DEFAULT_FILE_DIRNAME,
+                                        DEFAULT_JOURNAL_DIR,
+                                        DEFAULT_LARGE_FILE_MB,
+                                        DEFAULT_OUTPUT_BUFFER_KB,
+                                        DEFAULT_RUNLIST_CACHE_DIR,
+                                        DEFAULT_SSH_CONTROL_PERSIST,
+                                        DEFAULT_STEP_PARALLELISM)
+from easy_deploy.util.debfile import is_local_deb
+from easy_deploy.util.distribute import Distributor
+from easy_deploy.util.facts import FactCache, fact_cache_path
+from easy_deploy.util.inventory import resolve_count
+from easy_deploy.util.journal import Journal, journal_path, step_keys
+from easy_deploy.util.notify import RestartNotifier
+from easy_deploy.util.parser import EasyDeployConfigError, EasyDeployParser
+from easy_deploy.util.report import RunReport
+from easy_deploy.util.scheduler import has_dependencies, StepScheduler
 from easy_deploy.util.verify import Verifier
 
+# Package commands and the dpkg action they map to
+PACKAGE_ACTIONS = {
+    'installDebianPackage': 'install',
+    'removeDebianPackage': 'remove',
+}
 
-class Deployment:
+def package_batch_key(step: dict,
+                      ) -> str:
+    '''
+    Scheduler batch key: ready package steps are run together, and never
+    alongside another package batch, since dpkg holds a host-wide lock.
+    '''
+    return 'dpkg' if step.get('command') in PACKAGE_ACTIONS else None
+
+
+class HostDeployment:
     def __init__(self,
                  baseDir: str,
                  identityFile: str,
-                 instructionFile: str,
                  remoteHost: str,
                  username: str,
+                 batchFiles: bool=True,
+                 skipUnchanged: bool=True,
+                 stepParallelism: int=DEFAULT_STEP_PARALLELISM,
+                 outputBufferKb: int=DEFAULT_OUTPUT_BUFFER_KB,
+                 largeFileMb: int=DEFAULT_LARGE_FILE_MB,
+                 bandwidthLimitKb: int=DEFAULT_BANDWIDTH_LIMIT_KB,
+                 compress: str='auto',
+                 agent: bool=False,
+                 controlPersist: int=DEFAULT_SSH_CONTROL_PERSIST,
+                 journal: Journal=None,
+                 stepKeys: dict=None,
+                 facts: FactCache=None,
+                 report: RunReport=None,
                  ):
         '''
+        Runs an already built runlist against a single host.
+
         Args:
           baseDir::str
             Directory containing needed files (files to use in config)
           identityFile::str
             Filepath to use when authenticating with the remote host
-          instructionFile::str
-            Filepath to file specifying deployment steps
           remoteHost::str
             Identifier to use to connect to remote host
           username::str
             Username to authorize with remoteHost as
+          batchFiles::bool (Optional)
+            Ship all installFile steps in one bulk transfer (True) or
+            one transfer per file (False)
+          skipUnchanged::bool (Optional)
+            Skip installFile steps (and their restarts) whose remote file
+            already has the same content, mode, owner and group
+          stepParallelism::int (Optional)
+            Maximum number of independent steps run at once on the host
+          outputBufferKb::int (Optional)
+            KB of each command's most recent output kept for error reports
+          largeFileMb::int (Optional)
+            MB from which files are sent resumably, by delta
+          bandwidthLimitKb::int (Optional)
+            KB/s each transfer to the host is capped at, 0 for no cap
+          compress::str (Optional)
+            Compression of large files on the wire (auto, always, never)
+          agent::bool (Optional)
+            Run the host's remote work through an agent started over a
+            single ssh session (see agent.Agent)
+          controlPersist::int (Optional)
+            Seconds the host's ssh master session is kept open while idle
+          journal::Journal (Optional)
+            Journal to record completed steps in. Steps it holds from an
+            earlier run (see Journal resume) are skipped.
+          stepKeys::dict (Optional)
+            Journal keys of the runlist's steps (see step_keys), worked out
+            on prepare if not given
+          facts::FactCache (Optional)
+            Facts of the host known from earlier runs (see gather_facts),
+            saved again once the host is done with
+          report::RunReport (Optional)
+            Report to time the host's phases and steps in
         '''
         self.logger = logging.getLogger()
-        self.baseDir = baseDir
-        self.instructionFile = instructionFile
         self.remoteHost = remoteHost
-        self.parser = EasyDeployParser()
+        self.report = report or RunReport()
+        self.batchFiles = batchFiles
+        self.skipUnchanged = skipUnchanged
+        self.stepParallelism = stepParallelism
+        self.changedFiles = 0
+        self.unchangedFiles = 0
+        self.unchangedPackages = 0
+        self.resumedSteps = 0
+        self.journal = journal
+        self.stepKeys = stepKeys
+        self._lock = threading.Lock()
         self.connection = Connection(hostname=remoteHost,
                                      identityFile=identityFile,
                                      username=username,
+                                     outputBufferSize=outputBufferKb * 1024,
+                                     bandwidthLimitKb=bandwidthLimitKb,
+                                     agent=agent,
+                                     controlPersist=controlPersist,
                                      )
         self.runner = Runner(baseDir=baseDir,
                              hostname=remoteHost,
                              identity=identityFile,
                              username=username,
+                             connection=self.connection,
+                             largeFileBytes=largeFileMb * 1024 * 1024,
+                             compress=compress,
+                             facts=facts,
                              )
-        self.verifier = Verifier(baseDir)
+        self.notifier = RestartNotifier(self.runner,
+                                        remoteHost,
+                                        self.report,
+                                        journal,
+                                        )
+        self._stepIndexes = {}
 
     def run(self,
+            runlist: list,
             ) -> bool:
         '''
-        Run a deployment job.
+        Run every step of the runlist on the host (prepare, then activate).
+
+        Args:
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True/False based on success of run.
+        '''
+        return self.prepare(runlist) and self.activate(runlist)
+
+    def prepare(self,
+                runlist: list,
+                ) -> bool:
+        '''
+        Get the host ready to run the runlist without changing anything it
+        runs: check the connection, gather facts about its files and
+        packages and ship what the runlist will install. Steps completed
+        by an earlier run (see journal) are left out. Whatever prepare
+        leaves behind is removed by activate, or by abandon if the host
+        is not activated.
+
+        Args:
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True if the host is reachable
+        '''
+        self._stepIndexes = {id(step): index
+                             for index, step in enumerate(runlist)}
+        if self.journal is not None and self.stepKeys is None:
+            self.stepKeys = step_keys(runlist, self.runner.fileDir)
+
+        with self.report.span('phase', 'connection check'):
+            connected = self.connection.verify_connection()
+
+        if not connected:
+            err = 'Unable to establish connection with '\
+                  '%s. Exiting..' % (self.remoteHost)
+            self.logger.error(err)
+            return False
+        else:
+            msg = 'Successfully connected to %s' % self.remoteHost
+            self.logger.info(msg)
+
+        pending = [step for step in runlist if not self._is_completed(step)]
+        if len(pending) < len(runlist):
+            msg = '%s: Resuming, %d of %d steps already completed' % (
+                self.remoteHost, len(runlist) - len(pending), len(runlist))
+            self.logger.info(msg)
+
+        with self.report.span('phase', 'gather facts'):
+            self.runner.gather_facts(pending, files=self.skipUnchanged)
+            self.runner.facts.save()
+
+        if self.batchFiles:
+            with self.report.span('transfer', 'bulk transfer'):
+                self.runner.stage_files(pending)
+
+        packages = [step for step in pending if is_local_deb(step)
+                    and not (self.skipUnchanged and
+                             self.runner.is_package_current(step))]
+        if packages:
+            with self.report.span('transfer', 'push packages'):
+                self.runner.push_packages(packages)
+        return True
+
+    def activate(self,
+                 runlist: list,
+                 ) -> bool:
+        '''
+        Run the steps of a prepared runlist: install, remove and restart.
+
+        The journal is removed once every step succeeded, and kept for a
+        resumed run otherwise.
+
+        Args:
+          runlist::list(dict)
+            Runlist the host was prepared for
 
         Returns::bool
           True/False based on success of run.
         '''
-        runlist = self._build_runlist()
-        missing_files = self.verifier.verify_files(runlist)
+        success = False
+        try:
+            if self.journal is not None and self.journal.pendingRestarts:
+                self.notifier.notify(list(self.journal.pendingRestarts))
+            success = self._run_steps(runlist)
+            return success
+        finally:
+            self.abandon()
+            if self.journal is not None:
+                if success:
+                    self.journal.remove()
+                else:
+                    self.journal.close()
+                    msg = '%s: Completed steps journaled in %s, run again '\
+                          'with --resume to carry on' % (self.remoteHost,
+                                                         self.journal.path)
+                    self.logger.info(msg)
+            if self.resumedSteps:
+                msg = '%s: %d steps completed by an earlier run' % (
+                    self.remoteHost, self.resumedSteps)
+                self.logger.info(msg)
+            if self.changedFiles or self.unchangedFiles:
+                msg = '%s: %d files changed, %d unchanged' % (
+                    self.remoteHost, self.changedFiles, self.unchangedFiles)
+                self.logger.info(msg)
+            if self.unchangedPackages:
+                msg = '%s: %d packages already installed' % (
+                    self.remoteHost, self.unchangedPackages)
+                self.logger.info(msg)
+
+    def abandon(self,
+                ):
+        '''
+        Removes what prepare staged on the host and saves its facts.
+        Artifacts in the remote artifact dir are kept for later runs.
+        '''
+        try:
+            self.runner.cleanup_staged_files()
+        finally:
+            self.runner.facts.save()
+
+    def preflight(self,
+                  runlist: list,
+                  ) -> bool:
+        '''
+        Check the host can run the runlist before anything is changed on
+        it (see Runner.preflight). Problems found are logged. The facts
+        prepare needs are gathered along with the checks.
+
+        Args:
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True if the host is reachable and passed every check
+        '''
+        if not self.connection.verify_connection():
+            err = 'Unable to establish connection with %s' % self.remoteHost
+            self.logger.error(err)
+            return False
+
+        problems = self.runner.preflight(runlist,
+                                         staging=self.batchFiles,
+                                         files=self.skipUnchanged)
+        self.runner.facts.save()
+        for problem in problems:
+            self.logger.error('%s: Preflight: %s' % (self.remoteHost, problem))
+        return not problems
+
+    def _run_steps(self,
+                   runlist: list,
+                   ) -> bool:
+        '''
+        Run the steps of the runlist, stopping at the first failure.
+
+        Steps run in order unless the runlist declares dependencies
+        (`id`/`after`), in which case independent steps run concurrently.
+
+        Restarts requested by steps are queued and run once per service
+        at flushRestarts steps and at the end of the run. They are also
+        run if a step fails, so a change that was made is never left
+        without its restart.
+
+        Args:
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True/False based on success of run.
+        '''
+        if has_dependencies(runlist):
+            scheduler = StepScheduler(runlist,
+                                      self._execute,
+                                      self.stepParallelism,
+                                      batchKey=self._batch_key,
+                                      )
+            success = scheduler.run()
+        else:
+            success = self._run_in_order(runlist)
+
+        # Restart anything still queued
+        with self.report.span('phase', 'restarts'):
+            restarted = self.notifier.flush()
+        return success and restarted
+
+    def _run_in_order(self,
+                      runlist: list,
+                      ) -> bool:
+        '''
+        Run the steps of the runlist one after another. Adjacent steps of
+        the same package command are run as one dpkg transaction, and
+        adjacent staged files are put in place by one remote command.
+
+        Args:
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True/False based on success of run.
+        '''
+        index = 0
+        while index < len(runlist):
+            batch = [runlist[index]]
+            key = self._batch_key(batch[0])
+            if key is not None:
+                while index + len(batch) < len(runlist) and \
+                      self._batch_key(runlist[index + len(batch)]) == key:
+                    batch.append(runlist[index + len(batch)])
+            index += len(batch)
+
+            if not all(self._execute(batch)):
+                return False
+        return True
+
+    def _batch_key(self,
+                   step: dict,
+                   ) -> str:
+        '''
+        Batch key of a step (see StepScheduler): package steps are batched
+        as by package_batch_key, pending staged files (see
+        Runner.stage_files) are put in place together.
+        '''
+        if step.get('command') == 'installFile':
+            if self.runner.is_staged(step) and not self._is_completed(step):
+                return 'staged'
+            return None
+        return package_batch_key(step)
+
+    def _execute(self,
+                 steps: list,
+                 ) -> list:
+        '''
+        Run a single step, a batch of package steps or a batch of staged
+        files, queue the restarts of the steps that made a change and
+        journal the steps that succeeded.
+
+        Args:
+          steps::list(dict)
+            One step, several package steps or several staged
+            installFile steps
+
+        Returns::list(bool)
+          True/False status of success for each step, in order
+        '''
+        if len(steps) > 1 and steps[0].get('command') == 'installFile':
+            return self._execute_staged(steps)
+        if steps[0].get('command') not in PACKAGE_ACTIONS:
+            return [self._execute_step(step) for step in steps]
+
+        results = []
+        changed = []
+        for command, group in groupby(steps, lambda s: s.get('command')):
+            group = list(group)
+            completed = [self._is_completed(step) for step in group]
+            current = [done or (self.skipUnchanged and
+                                self.runner.is_package_current(step))
+                       for step, done in zip(group, completed)]
+            pending = [step for step, skip in zip(group, current) if not skip]
+            for step, skip, done in zip(group, current, completed):
+                if skip and not done:
+                    msg = '%s: Already installed, skipping: %s' % (
+                        self.remoteHost, step.get('source'))
+                    self.logger.debug(msg)
+            with self._lock:
+                self.resumedSteps += sum(completed)
+                self.unchangedPackages += len(group) - len(pending) \
+                                          - sum(completed)
+
+            indexes = [self._stepIndexes.get(id(step)) for step in group]
+            with self.report.span('step', command,
+                                  indexes=indexes,
+                                  targets=[step.get('source')
+                                           for step in group],
+                                  ) as span:
+                pendingResults = iter(self.runner.debianPackages(
+                    pending,
+                    PACKAGE_ACTIONS[command]) if pending else [])
+                groupResults = [True if skip else next(pendingResults)
+                                for skip in current]
+                if not pending:
+                    span.fields['status'] = 'unchanged'
+                else:
+                    span.fields['status'] = 'ok' if all(groupResults) \
+                                            else 'failed'
+            results += groupResults
+            changed += [not skip for skip in current]
+            # Steps after a failure are not run, as if run one at a time
+            if not all(groupResults):
+                break
+        results += [False] * (len(steps) - len(results))
+        for step, success, madeChange in zip(steps, results, changed):
+            if success and madeChange and 'restarts' in step:
+                self.notifier.notify(step.get('restarts'))
+        for step, success in zip(steps, results):
+            if success:
+                self._record(step)
+        return results
+
+    def _execute_staged(self,
+                        steps: list,
+                        ) -> list:
+        '''
+        Put the staged files of several pending installFile steps in
+        place with one remote command (see Runner.install_staged_files),
+        timed in the report as one step.
+
+        Returns::list(bool)
+          True/False status of success for each step, in order
+        '''
+        indexes = [self._stepIndexes.get(id(step)) for step in steps]
+        with self.report.span('step', 'installFile',
+                              indexes=indexes,
+                              targets=[step.get('remoteSource')
+                                       for step in steps],
+                              ) as span:
+            results = self.runner.install_staged_files(steps)
+            span.fields['status'] = 'changed' if all(results) else 'failed'
+        with self._lock:
+            self.changedFiles += sum(results)
+
+        for step, success in zip(steps, results):
+            if success and 'restarts' in step:
+                self.notifier.notify(step.get('restarts'))
+            if success:
+                self._record(step)
+
+        self.logger.debug('%s: %d staged files installed in %.3fs'
+                          % (self.remoteHost, sum(results), span.duration))
+        return results
+
+    def _execute_step(self,
+                      instruction: dict,
+                      ) -> bool:
+        '''
+        Run a single non-package step, timed in the report, and journal
+        it if it succeeded. A step completed by an earlier run is skipped.
+
+        Args:
+          instruction::dict
+            Step to run
+
+        Returns::bool
+          True/False status of success
+        '''
+        command = instruction.get('command')
+        with self.report.span('step', command,
+                              index=self._stepIndexes.get(id(instruction)),
+                              target=instruction.get('remoteSource'),
+                              ) as span:
+            if self._is_completed(instruction):
+                status = 'resumed'
+                with self._lock:
+                    self.resumedSteps += 1
+            else:
+                status = self._run_step(instruction)
+                if status != 'failed':
+                    self._record(instruction)
+            span.fields['status'] = status
+
+        self.logger.debug('%s: Step %s %s in %.3fs' % (self.remoteHost,
+                                                       command,
+                                                       status,
+                                                       span.duration))
+        return status != 'failed'
+
+    def _run_step(self,
+                  instruction: dict,
+                  ) -> str:
+        '''
+        Run a single non-package step and queue its restarts.
+
+        Args:
+          instruction::dict
+            Step to run
+
+        Returns::str
+          Status of the step: changed, unchanged, ok or failed
+        '''
+        command = instruction.get('command')
+        status = 'ok'
+        if command == 'installFile':
+            if self.runner.is_unchanged(instruction):
+                msg = '%s: Unchanged, skipping: %s' % (
+                    self.remoteHost, instruction.get('remoteSource'))
+                self.logger.debug(msg)
+                with self._lock:
+                    self.unchangedFiles += 1
+                return 'unchanged'
+            success = self.runner.installFile(instruction)
+            status = 'changed'
+            with self._lock:
+                self.changedFiles += success
+        elif command == 'flushRestarts':
+            success = self.notifier.flush()
+        else:
+            err = 'Unrecognized command: %s' % command
+            self.logger.error(err)
+            success = False
+
+        if not success:
+            return 'failed'
+
+        # Queue service restart after configuration if specified
+        if 'restarts' in instruction:
+            self.notifier.notify(instruction.get('restarts'))
+        return status
+
+    def _is_completed(self,
+                      step: dict,
+                      ) -> bool:
+        '''
+        Checks if the journal holds a step as completed by an earlier run.
+        '''
+        return self.journal is not None and \
+               self.journal.is_completed(self.stepKeys.get(id(step)))
+
+    def _record(self,
+                step: dict,
+                ):
+        '''
+        Journals a step as completed, after its restarts were queued.
+        '''
+        if self.journal is not None and not self._is_completed(step):
+            self.journal.record_step(self.stepKeys.get(id(step)),
+                                     step,
+                                     self._stepIndexes.get(id(step)))
+
+
+class Deployment:
+    def __init__(self,
+                 baseDir: str,
+                 identityFile: str,
+                 instructionFile: str,
+                 remoteHosts: list,
+                 username: str,
+                 concurrency: int=DEFAULT_CONCURRENCY,
+                 batchFiles: bool=True,
+                 skipUnchanged: bool=True,
+                 stepParallelism: int=DEFAULT_STEP_PARALLELISM,
+                 outputBufferKb: int=DEFAULT_OUTPUT_BUFFER_KB,
+                 largeFileMb: int=DEFAULT_LARGE_FILE_MB,
+                 bandwidthLimitKb: int=DEFAULT_BANDWIDTH_LIMIT_KB,
+                 compress: str='auto',
+                 agent: bool=False,
+                 reportFile: str=None,
+                 runlistCacheDir: str=DEFAULT_RUNLIST_CACHE_DIR,
+                 preflight: bool=True,
+                 distribution: str='direct',
+                 seeds: int=DEFAULT_DISTRIBUTION_SEEDS,
+                 fanout: int=DEFAULT_DISTRIBUTION_FANOUT,
+                 forwardAgent: bool=False,
+                 waveSize: str=None,
+                 maxInFlight: str=None,
+                 abortThreshold: str=None,
+                 journalDir: str=DEFAULT_JOURNAL_DIR,
+                 resume: bool=False,
+                 factCacheDir: str=DEFAULT_FACT_CACHE_DIR,
+                 factTtl: float=DEFAULT_FACT_TTL,
+                 controlPersist: int=DEFAULT_SSH_CONTROL_PERSIST,
+                 parser: EasyDeployParser=None,
+                 ):
+        '''
+        Args:
+          baseDir::str
+            Directory containing needed files (files to use in config)
+          identityFile::str
+            Filepath to use when authenticating with the remote host
+          instructionFile::str
+            Filepath to file specifying deployment steps
+          remoteHosts::list
+            Identifiers to use to connect to the remote hosts
+          username::str
+            Username to authorize with remoteHosts as
+          concurrency::int (Optional)
+            Maximum number of hosts to deploy to at once
+          batchFiles::bool (Optional)
+            Ship all installFile steps in one bulk transfer per host
+          skipUnchanged::bool (Optional)
+            Skip installFile steps whose remote file is already current
+          stepParallelism::int (Optional)
+            Maximum number of independent steps run at once per host
+          outputBufferKb::int (Optional)
+            KB of each command's most recent output kept for error reports
+          largeFileMb::int (Optional)
+            MB from which files are sent resumably, by delta
+          bandwidthLimitKb::int (Optional)
+            KB/s each transfer to a host is capped at, 0 for no cap
+          compress::str (Optional)
+            Compression of large files on the wire (auto, always, never)
+          agent::bool (Optional)
+            Run each host's remote work through an agent started over a
+            single ssh session (see agent.Agent)
+          reportFile::str (Optional)
+            Path to write a JSON (or .jsonl) timing report of the run to
+          runlistCacheDir::str (Optional)
+            Directory compiled runlists are cached in, None to always parse
+          preflight::bool (Optional)
+            Probe every host before deploying and skip hosts that fail
+          distribution::str (Optional)
+            How artifacts reach the hosts. Available: (direct, tree).
+            direct sends them to every host from here, tree only to
+            `seeds` hosts, which relay them on (see Distributor).
+          seeds::int (Optional)
+            Number of hosts sent artifacts from here in tree distribution
+          fanout::int (Optional)
+            Number of hosts each host relays to in tree distribution
+          forwardAgent::bool (Optional)
+            Forward the local ssh agent to relaying hosts in tree
+            distribution, instead of them using keys of their own. Root
+            on a relaying host can use the agent while it relays.
+          waveSize::str (Optional)
+            Roll out in waves of this many hosts ("5") or percent of hosts
+            ("20%"), see _roll. All hosts at once if not given.
+          maxInFlight::str (Optional)
+            Most hosts (count or percentage) being changed at once when
+            rolling out, defaults to waveSize
+          abortThreshold::str (Optional)
+            Stop rolling out once more than this many hosts (count or
+            percentage) failed. Never stops if not given.
+          journalDir::str (Optional)
+            Directory each host's journal of completed steps is kept in,
+            None to keep no journal
+          resume::bool (Optional)
+            Skip the steps the journal of a host holds as completed by an
+            earlier run with identical inputs, continuing where it failed
+          factCacheDir::str (Optional)
+            Directory the facts gathered about each host are cached in,
+            None to keep them for this run only
+          factTtl::float (Optional)
+            Seconds facts cached by an earlier run are trusted for, 0 to
+            always gather them again
+          controlPersist::int (Optional)
+            Seconds each host's ssh master session is kept open while idle
+          parser::EasyDeployParser (Optional)
+            Parser to build the runlist with, so a long running process
+            (see daemon.DeployDaemon) keeps configs it parsed before.
+            One caching in runlistCacheDir is made if not given.
+        '''
+        self.logger = logging.getLogger()
+        self.baseDir = baseDir
+        self.identityFile = identityFile
+        self.instructionFile = instructionFile
+        self.remoteHosts = list(remoteHosts)
+        self.username = username
+        self.concurrency = max(1, concurrency)
+        self.batchFiles = batchFiles
+        self.skipUnchanged = skipUnchanged
+        self.stepParallelism = stepParallelism
+        self.outputBufferKb = outputBufferKb
+        self.largeFileMb = largeFileMb
+        self.bandwidthLimitKb = bandwidthLimitKb
+        self.compress = compress
+        self.agent = agent
+        self.reportFile = reportFile
+        self.preflight = preflight
+        self.distribution = distribution
+        self.seeds = seeds
+        self.fanout = fanout
+        self.forwardAgent = forwardAgent
+        self.waveSize = waveSize
+        self.maxInFlight = maxInFlight
+        self.abortThreshold = abortThreshold
+        self.journalDir = journalDir
+        self.resume = resume
+        self.factCacheDir = factCacheDir
+        self.factTtl = factTtl
+        self.controlPersist = controlPersist
+        self.stepKeys = None
+        self.hostDeployments = {}
+        self.report = RunReport()
+        self.parser = parser or EasyDeployParser(runlistCacheDir)
+        self.verifier = Verifier(baseDir)
+
+    def run(self,
+            ) -> dict:
+        '''
+        Run a deployment job against every host.
+
+        The runlist is parsed and verified once. Every host is then
+        probed (see HostDeployment.preflight), in parallel, artifacts are
+        spread to the hosts that passed if distribution is tree, and they
+        are deployed to, up to `concurrency` at a time.
+
+        Returns::dict
+          Mapping of hostname to True/False based on success of its run.
+        '''
+        try:
+            return self._run()
+        finally:
+            self._write_report()
+
+    def _run(self,
+             ) -> dict:
+        '''
+        Run a deployment job against every host. See run.
+        '''
+        with self.report.span('phase', 'parse'):
+            runlist = self._build_runlist()
+
+        with self.report.span('phase', 'verify'):
+            missing_files = self.verifier.verify_files(runlist)
+            problems = [] if missing_files \
+                       else self.verifier.verify_packages(runlist)
 
         if missing_files:
             for filename in missing_files:
@@ -67,68 +772,411 @@ class Deployment:
                                                   DEFAULT_FILE_DIRNAME,
                                                   filename)
                 self.logger.error(err)
-            return
+            return {host: False for host in self.remoteHosts}
 
-   
-        if not self.connection.verify_connection():
-            err = 'Unable to establish connection with '\
-                  '%s. Exiting..' % (self.remoteHost)
-            self.logger.error(err)
+        if problems:
+            for problem in problems:
+                self.logger.error('Unreadable package: %s' % problem)
+            return {host: False for host in self.remoteHosts}
+
+        if self.journalDir:
+            self.stepKeys = step_keys(runlist,
+                                      '%s/%s' % (self.baseDir,
+                                                 DEFAULT_FILE_DIRNAME))
+
+        hosts = self.remoteHosts
+        results = {}
+        if self.preflight:
+            with self.report.span('phase', 'preflight'):
+                passed = self._map_hosts(self._preflight_host, hosts, runlist)
+            results = {host: False for host in hosts if not passed[host]}
+            hosts = [host for host in hosts if passed[host]]
+
+        if self.distribution == 'tree' and hosts:
+            with self.report.span('phase', 'distribute'):
+                self._distribute(hosts, runlist)
+
+        with self.report.span('phase', 'deploy'):
+            if self.waveSize:
+                results.update(self._roll(hosts, runlist))
+            else:
+                results.update(self._map_hosts(self._run_host, hosts,
+                                               runlist))
+
+        return {host: results[host] for host in self.remoteHosts}
+
+    def _distribute(self,
+                    hosts: list,
+                    runlist: list,
+                    ):
+        '''
+        Spreads the runlist's artifacts to the hosts in a tree and tells
+        each host's Runner which artifacts it holds, so they are installed
+        from there. Hosts that did not get them fall back to the direct
+        path when deployed to.
+        '''
+        artifacts = collect_artifacts(runlist,
+                                      '%s/%s' % (self.baseDir,
+                                                 DEFAULT_FILE_DIRNAME))
+        connections = {host: self._host_deployment(host).connection
+                       for host in hosts}
+        stored = Distributor(connections,
+                             artifacts,
+                             seeds=self.seeds,
+                             fanout=self.fanout,
+                             concurrency=self.concurrency,
+                             forwardAgent=self.forwardAgent,
+                             ).run()
+        for host, digests in stored.items():
+            self._host_deployment(host).runner.record_artifacts(digests)
+
+    def _roll(self,
+              hosts: list,
+              runlist: list,
+              ) -> dict:
+        '''
+        Deploy to the hosts in rolling waves.
+
+        Hosts are changed (activated) in order, never more than
+        `maxInFlight` at once. A finished host frees its slot for the next
+        one straight away, so a slow host only holds up its own slot, not
+        the next wave. Each wave is prepared (connection checked, files
+        and packages shipped, see HostDeployment.prepare) while the wave
+        before it is being activated, so its transfers are done by the
+        time it gets its turn.
+
+        Once more than `abortThreshold` hosts failed no further host is
+        activated. Hosts in flight finish, the rest are left untouched
+        and reported as failed.
+
+        Returns::dict
+          Mapping of hostname to True/False based on success of its run.
+        '''
+        waveSize = max(1, resolve_count(self.waveSize, len(hosts)))
+        maxInFlight = max(1, resolve_count(self.maxInFlight or self.waveSize,
+                                           len(hosts)))
+        threshold = None if self.abortThreshold is None \
+                    else resolve_count(self.abortThreshold, len(hosts))
+        waves = [hosts[index:index + waveSize]
+                 for index in range(0, len(hosts), waveSize)]
+        waveOf = {host: number for number, wave in enumerate(waves)
+                  for host in wave}
+
+        results = {}
+        prepared = {}
+        activating = {}
+        failures = 0
+        nextHost = 0
+        aborted = False
+        preparers = ThreadPoolExecutor(max_workers=max(1, self.concurrency))
+        activators = ThreadPoolExecutor(max_workers=maxInFlight)
+
+        def prepare_wave(number: int):
+            if number < len(waves) and waves[number][0] not in prepared:
+                for host in waves[number]:
+                    prepared[host] = preparers.submit(
+                        contextvars.copy_context().run,
+                        self._prepare_host, host, runlist)
+
+        try:
+            prepare_wave(0)
+            while nextHost < len(hosts) or activating:
+                while not aborted and nextHost < len(hosts) and \
+                      len(activating) < maxInFlight and \
+                      prepared[hosts[nextHost]].done():
+                    host = hosts[nextHost]
+                    nextHost += 1
+                    number = waveOf[host]
+                    if host == waves[number][0]:
+                        msg = 'Starting wave %d/%d (%d hosts)' % (
+                            number + 1, len(waves), len(waves[number]))
+                        self.logger.info(msg)
+                        prepare_wave(number + 1)
+                    if prepared[host].result():
+                        activating[activators.submit(
+                            contextvars.copy_context().run,
+                            self._activate_host, host, runlist)] = host
+                    else:
+                        results[host] = False
+                        failures += 1
+                        aborted = threshold is not None and \
+                                  failures > threshold
+
+                # Wait for a slot, or for the next host to be prepared
+                waitFor = list(activating)
+                if not aborted and nextHost < len(hosts) and \
+                   len(activating) < maxInFlight:
+                    waitFor.append(prepared[hosts[nextHost]])
+                if not waitFor:
+                    break
+                done, _ = wait(waitFor, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host = activating.pop(future, None)
+                    if host is not None:
+                        results[host] = future.result()
+                        failures += not results[host]
+
+                if threshold is not None and failures > threshold:
+                    aborted = True
+
+            skipped = hosts[nextHost:]
+            if skipped:
+                err = 'Aborting rollout after %d failed hosts, not '\
+                      'deploying to %d: %s' % (failures,
+                                               len(skipped),
+                                               ', '.join(skipped))
+                self.logger.error(err)
+        finally:
+            preparers.shutdown(wait=True)
+            activators.shutdown(wait=True)
+
+        for host in hosts[nextHost:]:
+            results[host] = False
+            if host in prepared and prepared[host].result():
+                self._abandon_host(host)
+        return results
+
+    def _map_hosts(self,
+                   function,
+                   hosts: list,
+                   runlist: list,
+                   ) -> dict:
+        '''
+        Calls function(host, runlist) for every host, on up to
+        `concurrency` hosts at a time.
+
+        Returns::dict
+          Mapping of hostname to the function's result
+        '''
+        if not hosts:
+            return {}
+        workers = min(self.concurrency, len(hosts))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Run in a copy of our context so report spans nest properly,
+            # and records are logged for the job the hosts belong to
+            futures = {host: executor.submit(contextvars.copy_context().run,
+                                             function, host, runlist)
+                       for host in hosts}
+            return {host: future.result() for host, future in futures.items()}
+
+    def _write_report(self,
+                      ):
+        '''
+        Writes the timing report, if one was requested.
+        '''
+        if not self.reportFile:
             return
+        try:
+            self.report.write(self.reportFile)
+        except OSError as e:
+            err = 'Unable to write report %s: %s' % (self.reportFile, e)
+            self.logger.error(err)
         else:
-            msg = 'Successfully connected to %s' % self.remoteHost
+            self.logger.info('Report written to %s' % self.reportFile)
+
+    def _run_host(self,
+                  remoteHost: str,
+                  runlist: list,
+                  ) -> bool:
+        '''
+        Run the runlist on a single host, trapping any failure so one
+        host can never take down the rest of the run.
+
+        Args:
+          remoteHost::str
+            Identifier of the host to deploy to
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True/False based on success of the host's run.
+        '''
+        with self.report.span('host', remoteHost, host=remoteHost) as span:
+            success = self._deploy_host(remoteHost, runlist)
+            span.fields['success'] = success
+
+        msg = '%s: Deployment %s in %.2fs' % (
+            remoteHost, 'Succeeded' if success else 'Failed', span.duration)
+        self.logger.info(msg)
+        return success
+
+    def _preflight_host(self,
+                        remoteHost: str,
+                        runlist: list,
+                        ) -> bool:
+        '''
+        Run the preflight checks of a single host, trapping any failure.
+
+        Args:
+          remoteHost::str
+            Identifier of the host to check
+          runlist::list(dict)
+            Built and verified runlist
+
+        Returns::bool
+          True if the host passed its checks
+        '''
+        with self.report.span('preflight', remoteHost,
+                              host=remoteHost) as span:
+            try:
+                success = self._host_deployment(remoteHost).preflight(runlist)
+            except Exception as e:
+                err = '%s: Preflight aborted: %s' % (remoteHost, e)
+                self.logger.error(err)
+                success = False
+            span.fields['success'] = success
+
+        if not success:
+            msg = '%s: Preflight Failed in %.2fs, skipping host' % (
+                remoteHost, span.duration)
+            self.logger.error(msg)
+            self.hostDeployments.pop(remoteHost, None)
+        return success
+
+    def _deploy_host(self,
+                     remoteHost: str,
+                     runlist: list,
+                     ) -> bool:
+        '''
+        Run the runlist on a single host. See _run_host.
+        '''
+        try:
+            return self._host_deployment(remoteHost).run(runlist)
+        except Exception as e:
+            err = '%s: Deployment aborted: %s' % (remoteHost, e)
+            self.logger.error(err)
+            return False
+        finally:
+            self.hostDeployments.pop(remoteHost, None)
+
+    def _prepare_host(self,
+                      remoteHost: str,
+                      runlist: list,
+                      ) -> bool:
+        '''
+        Prepare a single host (see HostDeployment.prepare), trapping any
+        failure.
+
+        Returns::bool
+          True if the host is ready to be activated
+        '''
+        with self.report.span('prepare', remoteHost,
+                              host=remoteHost) as span:
+            try:
+                success = self._host_deployment(remoteHost).prepare(runlist)
+            except Exception as e:
+                err = '%s: Prepare aborted: %s' % (remoteHost, e)
+                self.logger.error(err)
+                success = False
+            span.fields['success'] = success
+
+        if not success:
+            msg = '%s: Deployment Failed in %.2fs, unable to prepare host' \
+                  % (remoteHost, span.duration)
             self.logger.info(msg)
+            self._abandon_host(remoteHost)
+        return success
 
-        # TODO
-        #      Loop through and run instructions
-        #
-        for instruction in runlist:
-            # Run through command body first
-            command = instruction.get('command')
-            if command == 'installFile':
-                success = self.runner.installFile(instruction)
-            elif command == 'installDebianPackage':
-                success = self.runner.debianPackage(instruction, 'install')
-            elif command == 'removeDebianPackage':
-                success = self.runner.debianPackage(instruction, 'remove')
-            else:
-                err = 'Unrecognized command: %s' % command
+    def _activate_host(self,
+                       remoteHost: str,
+                       runlist: list,
+                       ) -> bool:
+        '''
+        Activate a single prepared host (see HostDeployment.activate),
+        trapping any failure.
+
+        Returns::bool
+          True/False based on success of the host's run.
+        '''
+        with self.report.span('host', remoteHost, host=remoteHost) as span:
+            try:
+                success = self._host_deployment(remoteHost).activate(runlist)
+            except Exception as e:
+                err = '%s: Deployment aborted: %s' % (remoteHost, e)
                 self.logger.error(err)
                 success = False
-            
-            if not success:
-                return False
+            finally:
+                self.hostDeployments.pop(remoteHost, None)
+            span.fields['success'] = success
 
+        msg = '%s: Deployment %s in %.2fs' % (
+            remoteHost, 'Succeeded' if success else 'Failed', span.duration)
+        self.logger.info(msg)
+        return success
 
-            # Run service restart after configuration if specified
-            if 'restarts' in instruction:
-                service = instruction.get('restarts')
-                success = self.runner.restart_service(service)
-                if not success:
-                    err = 'Unable to restart service "%s"' % service
-                    self.logger.error(err)
-                    return False
-        # If all instructions are executed and we are here, it is a success
-        return True
+    def _abandon_host(self,
+                      remoteHost: str,
+                      ):
+        '''
+        Drop a host that will not be activated, removing anything staged
+        on it.
+        '''
+        hostDeployment = self.hostDeployments.pop(remoteHost, None)
+        if hostDeployment is None:
+            return
+        try:
+            hostDeployment.abandon()
+        except Exception as e:
+            err = '%s: Unable to clean up: %s' % (remoteHost, e)
+            self.logger.warning(err)
+
+    def _host_deployment(self,
+                         remoteHost: str,
+                         ) -> HostDeployment:
+        '''
+        Returns the HostDeployment of a host, created on first use so the
+        preflight and the deploy of a host share it (and its connection).
+        '''
+        if remoteHost not in self.hostDeployments:
+            journal = None
+            if self.journalDir:
+                journal = Journal(journal_path(self.journalDir, remoteHost),
+                                  resume=self.resume)
+            factPath = None
+            if self.factCacheDir:
+                factPath = fact_cache_path(self.factCacheDir,
+                                           remoteHost,
+                                           self.username,
+                                           ssh_port(remoteHost, self.username))
+            facts = FactCache(factPath, ttl=self.factTtl)
+            self.hostDeployments[remoteHost] = HostDeployment(
+                baseDir=self.baseDir,
+                identityFile=self.identityFile,
+                remoteHost=remoteHost,
+                username=self.username,
+                batchFiles=self.batchFiles,
+                skipUnchanged=self.skipUnchanged,
+                stepParallelism=self.stepParallelism,
+                outputBufferKb=self.outputBufferKb,
+                largeFileMb=self.largeFileMb,
+                bandwidthLimitKb=self.bandwidthLimitKb,
+                compress=self.compress,
+                agent=self.agent,
+                controlPersist=self.controlPersist,
+                journal=journal,
+                stepKeys=self.stepKeys,
+                facts=facts,
+                report=self.report,
+                )
+        return self.hostDeployments[remoteHost]
 
-        
     def _build_runlist(self,
                        ) -> list:
         '''
         Build the runlist for the job.
 
-        Program exits on failed build.
-
         Returns::list
           Build runlist for the job
+
+        Raises:
+          EasyDeployConfigError
+            If the config could not be built, with every error found
         '''
         self.logger.debug('Parsing config')
         runlist, errors = self.parser.build(self.instructionFile)
     
         if errors:
-            errMsg = '\n' + '\n\n'.join(errors)
-            self.logger.error(errMsg)
-            sys.exit(-1)
+            raise EasyDeployConfigError('\n\n'.join(errors))
 
         self.logger.debug('Config verified. Runlist built.')
         return runlist
@@ -0,0 +1,139 @@
+'''
+Module used to keep compiled (parsed and verified) config files on disk, so
+an unchanged config file does not have to be parsed again.
+
+Entries are the verified config blocks stored as JSON. As the cache dir
+may be shared (ie. named by a client of the daemon), what is read back is
+checked to be blocks of known commands, never trusted to run code.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from easy_deploy.util.config_requirements_def import (COMMANDS,
+                                                      SCHEMA_VERSION,
+                                                      UNIVERSAL_OPTIONS,
+                                                      )
+
+# Changes whenever the command definitions do, so stale runlists are missed
+SCHEMA_KEY = hashlib.sha256(json.dumps([SCHEMA_VERSION,
+                                        COMMANDS,
+                                        UNIVERSAL_OPTIONS,
+                                        ],
+                                       sort_keys=True,
+                                       ).encode('utf-8')).hexdigest()
+
+class RunlistCache:
+    def __init__(self,
+                 cacheDir: str,
+                 ):
+        '''
+        Args:
+          cacheDir::str
+            Directory the compiled runlists are kept in
+        '''
+        self.logger = logging.getLogger()
+        self.cacheDir = os.path.expanduser(cacheDir)
+
+    @staticmethod
+    def key(contents: bytes,
+            ) -> str:
+        '''
+        Args:
+          contents::bytes
+            Raw contents of the config file
+
+        Returns::str
+          Cache key of the config under the current command schema
+        '''
+        digest = hashlib.sha256(SCHEMA_KEY.encode('utf-8'))
+        digest.update(contents)
+        return digest.hexdigest()
+
+    def _path(self,
+              key: str,
+              ) -> str:
+        return '%s/%s.json' % (self.cacheDir, key)
+
+    def get(self,
+            key: str,
+            ) -> list:
+        '''
+        Args:
+          key::str
+            Cache key (see key)
+
+        Returns::list(dict)
+          The cached config blocks, None if there are none (or they are
+          unreadable)
+        '''
+        try:
+            with open(self._path(key), 'r') as stream:
+                blocks = json.load(stream)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.debug('Ignoring unreadable runlist cache %s: %s'
+                              % (self._path(key), e))
+            return None
+
+        if not _valid_blocks(blocks):
+            self.logger.debug('Ignoring malformed runlist cache %s'
+                              % self._path(key))
+            return None
+        return blocks
+
+    def put(self,
+            key: str,
+            runlist: list,
+            ):
+        '''
+        Stores the config blocks of a runlist. The file is replaced
+        atomically, so concurrent runs never read a partial entry.
+        Failures are only logged.
+
+        Args:
+          key::str
+            Cache key (see key)
+          runlist::list(dict)
+            Verified config blocks to store
+        '''
+        try:
+            data = json.dumps(runlist)
+        except (TypeError, ValueError) as e:
+            # ie. YAML dates, which JSON has no type for
+            self.logger.debug('Not caching runlist: %s' % e)
+            return
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir,
+                                           suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as stream:
+                    stream.write(data)
+                os.replace(tmpPath, self._path(key))
+            except BaseException:
+                os.unlink(tmpPath)
+                raise
+        except OSError as e:
+            self.logger.warning('Unable to cache runlist in %s: %s'
+                                % (self.cacheDir, e))
+
+def _valid_blocks(blocks,
+                  ) -> bool:
+    '''
+    Returns::bool
+      True if blocks is a list of include blocks and blocks of known
+      commands
+    '''
+    if not isinstance(blocks, list):
+        return False
+    for block in blocks:
+        if not isinstance(block, dict):
+            return False
+        if 'include' not in block and block.get('command') not in COMMANDS:
+            return False
+    return True
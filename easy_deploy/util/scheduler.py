@@ -0,0 +1,251 @@
+'''
+Module used to order and run runlist steps by their declared dependencies.
+
+Steps may carry an `id` and an `after` (id or list of ids). A step is
+ready once every step it is `after` has succeeded. A step without an
+`after` runs after the step before it, as it would without any
+dependencies, so only steps that declare an `after` can run alongside
+others. Ready steps are run concurrently up to a parallelism cap.
+'''
+
+import contextvars
+import logging
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def has_dependencies(runlist: list,
+                     ) -> bool:
+    '''
+    Checks if any step of the runlist declares dependencies.
+
+    Args:
+      runlist::list(dict)
+        Runlist to check
+
+    Returns::bool
+      True if any step has an `after` option
+    '''
+    return any('after' in step for step in runlist)
+
+def get_after_ids(step: dict,
+                  ) -> list:
+    '''
+    Returns the ids a step is declared to run after.
+
+    Args:
+      step::dict
+        Runlist step
+
+    Returns::list
+      List of ids (empty if none)
+    '''
+    after = step.get('after', [])
+    if type(after) is not list:
+        after = [after]
+    return after
+
+def build_graph(runlist: list,
+                batchKey=None,
+                ) -> list:
+    '''
+    Builds the dependency graph of a runlist.
+
+    Steps with an `after` depend on the steps it names. Other steps
+    depend on the step before them, unless they would be batched with it
+    (see StepScheduler batchKey): they then share its dependencies, so
+    both are ready at once and run as one batch, as they would in order.
+
+    Args:
+      runlist::list(dict)
+        Runlist with validated `id`/`after` options
+      batchKey::callable (Optional)
+        Batch key of a step, see StepScheduler
+
+    Returns::list(set)
+      For each step index, the set of step indexes it depends on (one
+      shared empty frozenset for steps without dependencies)
+    '''
+    indexById = {step['id']: index for index, step in enumerate(runlist)
+                 if 'id' in step}
+    noDependencies = frozenset()
+    graph = []
+    previousKey = None
+    for index, step in enumerate(runlist):
+        key = batchKey(step) if batchKey else None
+        if 'after' in step:
+            graph.append({indexById[stepId] for stepId in get_after_ids(step)})
+        elif not index:
+            graph.append(noDependencies)
+        elif key is not None and key == previousKey:
+            graph.append(graph[-1])
+        else:
+            graph.append({index - 1})
+        previousKey = key
+    return graph
+
+def find_cycle(runlist: list,
+               ) -> list:
+    '''
+    Finds a dependency cycle in a runlist.
+
+    Args:
+      runlist::list(dict)
+        Runlist whose `after` options all reference existing ids
+
+    Returns::list
+      Ids (or step indexes for steps without one) forming a cycle,
+      empty list if there is none
+    '''
+    graph = build_graph(runlist)
+    unvisited, visiting, visited = 0, 1, 2
+    state = [unvisited] * len(graph)
+
+    def name(index: int):
+        return runlist[index].get('id', 'step %d' % (index + 1))
+
+    for start in range(len(graph)):
+        if state[start] != unvisited:
+            continue
+        if not graph[start]:
+            state[start] = visited
+            continue
+        # Iterative DFS, keeping the current path for reporting
+        path = [start]
+        stack = [iter(sorted(graph[start]))]
+        state[start] = visiting
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                state[path.pop()] = visited
+                stack.pop()
+            elif state[node] == visiting:
+                cycle = path[path.index(node):] + [node]
+                return [name(index) for index in cycle]
+            elif state[node] == unvisited:
+                state[node] = visiting
+                path.append(node)
+                stack.append(iter(sorted(graph[node])))
+    return []
+
+
+class StepScheduler:
+    def __init__(self,
+                 runlist: list,
+                 execute,
+                 parallelism: int,
+                 batchKey=None,
+                 ):
+        '''
+        Args:
+          runlist::list(dict)
+            Runlist with validated `id`/`after` options
+          execute::callable
+            Called with a list of steps to run together, returns a list
+            of True/False results for those steps
+          parallelism::int
+            Maximum number of executes in flight at once
+          batchKey::callable (Optional)
+            Called with a step, returns a key or None. Ready steps that
+            share a key are executed together as one batch and only one
+            batch per key is in flight at a time.
+        '''
+        self.runlist = runlist
+        self.execute = execute
+        self.parallelism = max(1, parallelism)
+        self.batchKey = batchKey or (lambda step: None)
+        self.logger = logging.getLogger()
+
+    def run(self,
+            ) -> bool:
+        '''
+        Run every step once its dependencies have succeeded.
+
+        No new steps are started after a failure; steps already running
+        are waited for.
+
+        Returns::bool
+          True if every step ran and succeeded
+        '''
+        graph = build_graph(self.runlist, self.batchKey)
+        waitingOn = [len(deps) for deps in graph]
+        dependents = [[] for _ in graph]
+        for index, deps in enumerate(graph):
+            for dep in deps:
+                dependents[dep].append(index)
+
+        ready = [index for index, count in enumerate(waitingOn) if not count]
+        inflight = {}
+        busyKeys = set()
+        completed = 0
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            while ready or inflight:
+                if not failed:
+                    ready = self._launch(executor, ready, inflight, busyKeys)
+
+                if not inflight:
+                    break
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    indexes, key = inflight.pop(future)
+                    busyKeys.discard(key)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        self.logger.error('Step failed: %s' % e)
+                        results = [False] * len(indexes)
+
+                    for index, success in zip(indexes, results):
+                        if not success:
+                            failed = True
+                            continue
+                        completed += 1
+                        for dependent in dependents[index]:
+                            waitingOn[dependent] -= 1
+                            if not waitingOn[dependent]:
+                                ready.append(dependent)
+                ready.sort()
+
+        return not failed and completed == len(self.runlist)
+
+    def _launch(self,
+                executor: ThreadPoolExecutor,
+                ready: list,
+                inflight: dict,
+                busyKeys: set,
+                ) -> list:
+        '''
+        Submit ready steps until the parallelism cap is reached.
+
+        Returns::list
+          Step indexes still waiting to be launched
+        '''
+        waiting = []
+        launched = set()
+        for index in ready:
+            if index in launched:
+                continue
+            key = self.batchKey(self.runlist[index])
+            if len(inflight) >= self.parallelism or \
+               (key is not None and key in busyKeys):
+                waiting.append(index)
+                continue
+
+            if key is None:
+                batch = [index]
+            else:
+                batch = [other for other in ready
+                         if other not in launched and
+                         self.batchKey(self.runlist[other]) == key]
+                busyKeys.add(key)
+            launched.update(batch)
+
+            # Run in a copy of our context so report spans nest properly
+            future = executor.submit(contextvars.copy_context().run,
+                                     self.execute,
+                                     [self.runlist[i] for i in batch])
+            inflight[future] = (batch, key)
+        return [index for index in waiting if index not in launched]
@@ -0,0 +1,69 @@
+'''
+Module used to stream local files as a tar archive without building the
+archive (or copies of the files) on disk.
+'''
+
+import os
+import tarfile
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+READ_CHUNK_BYTES = 1 << 20
+
+class TarStreamError(Exception):
+    ''' Raised if a file changes size while it is being streamed '''
+
+def iter_tar(members: list,
+             ):
+    '''
+    Yields a tar archive of local files chunk by chunk.
+
+    Each member carries the name, mode, owner and group it is extracted
+    with, so `tar -x -p --same-owner` applies them on the receiving side
+    (owner and group are resolved by name there).
+
+    Args:
+      members::list(tuple)
+        (localPath, name, mode, owner, group) of each file, mode an int
+
+    Yields::bytes
+      Consecutive chunks of the archive
+
+    Raises:
+      TarStreamError
+        If a file does not have the size it had when its header was sent
+    '''
+    for localPath, name, mode, owner, group in members:
+        with open(localPath, 'rb') as stream:
+            stat = os.fstat(stream.fileno())
+            info = tarfile.TarInfo(name)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = mode
+            info.uname = owner
+            info.gname = group
+            yield info.tobuf(format=tarfile.GNU_FORMAT)
+
+            sent = 0
+            for chunk in iter(lambda: stream.read(READ_CHUNK_BYTES), b''):
+                sent += len(chunk)
+                if sent > info.size:
+                    break
+                yield chunk
+            if sent != info.size:
+                err = '%s changed size while being sent' % localPath
+                raise TarStreamError(err)
+
+        padding = -info.size % BLOCK_SIZE
+        if padding:
+            yield tarfile.NUL * padding
+
+    # End of archive marker
+    yield tarfile.NUL * (2 * BLOCK_SIZE)
+
+def iter_file(localPath: str,
+              ):
+    '''
+    Yields a local file chunk by chunk.
+    '''
+    with open(localPath, 'rb') as stream:
+        yield from iter(lambda: stream.read(READ_CHUNK_BYTES), b'')
@@ -6,6 +6,7 @@ the easy_deploy program.
 import os
 
 from easy_deploy.util.constants import DEFAULT_FILE_DIRNAME
+from easy_deploy.util.debfile import deb_info, DebFileError, is_local_deb
 
 class Verifier:
     def __init__(self,
@@ -41,4 +42,40 @@ class Verifier:
                                          filename)
                 if not os.path.isfile(filepath):
                     missing_files.append(filename)
+            elif is_local_deb(step_definition):
+                filename = step_definition.get('source', '')
+                if not os.path.isfile(self._file_path(filename)):
+                    missing_files.append(filename)
         return missing_files
+
+    def verify_packages(self,
+                        runlist: list,
+                        ) -> list:
+        '''
+        Verifies that the local .debs in the runlist can be read (name and
+        version). Assumes verify_files found nothing missing.
+
+        Args:
+          runlist::list(dict)
+            List of dictionaries specifiying the content used.
+
+        Returns::list
+          List of problems found, empty list if none
+        '''
+        problems = []
+        checked = set()
+        for step_definition in runlist:
+            filename = step_definition.get('source', '')
+            if not is_local_deb(step_definition) or filename in checked:
+                continue
+            checked.add(filename)
+            try:
+                deb_info(self._file_path(filename))
+            except (DebFileError, OSError) as e:
+                problems.append(str(e))
+        return problems
+
+    def _file_path(self,
+                   filename: str,
+                   ) -> str:
+        return '%s/%s/%s' % (self.baseDir, DEFAULT_FILE_DIRNAME, filename)
@@ -6,11 +6,11 @@ setuptools.setup(
      name='easy_deploy',
      version='0.1',
      install_requires=['pyyaml'],
-     scripts=['scripts/easy_deploy'] ,
+     scripts=['scripts/easy_deploy', 'scripts/easy_deploy_daemon'],
      author="Matt Strozyk",
      author_email="mstrozyk25@gmail.com",
      description="Deploy configuration to remote hosts",
-     packages=setuptools.find_packages(),
+     packages=setuptools.find_packages(exclude=['tests']),
      classifiers=[
          "Programming Language :: Python :: 3",
          "Operating System :: OS Independent",
@@ -0,0 +1,60 @@
+'''
+Tests of the shared event loop helpers (easy_deploy.util.aio).
+'''
+
+import threading
+import unittest
+
+from easy_deploy.util.aio import aiter_chunks, run_process, run_sync
+
+
+async def collect(data) -> list:
+    return [chunk async for chunk in aiter_chunks(data)]
+
+
+class AiterChunksTest(unittest.TestCase):
+    def test_bytes_and_lists(self):
+        self.assertEqual(run_sync(collect(b'abc')), [b'abc'])
+        self.assertEqual(run_sync(collect([b'a', b'b'])), [b'a', b'b'])
+
+    def test_async_iterables(self):
+        async def chunks():
+            yield b'a'
+            yield b'b'
+
+        self.assertEqual(run_sync(collect(chunks())), [b'a', b'b'])
+
+    def test_sync_iterators_are_read_off_the_loop(self):
+        threads = []
+
+        def chunks():
+            for chunk in (b'a', b'b'):
+                threads.append(threading.current_thread())
+                yield chunk
+
+        async def loop_thread():
+            return threading.current_thread()
+
+        self.assertEqual(run_sync(collect(chunks())), [b'a', b'b'])
+        self.assertNotIn(run_sync(loop_thread()), threads)
+
+    def test_errors_reach_the_reader(self):
+        def chunks():
+            yield b'a'
+            raise ValueError('unreadable')
+
+        with self.assertRaises(ValueError):
+            run_sync(collect(chunks()))
+
+    def test_fed_to_a_process(self):
+        chunks = (bytes([65 + index]) * 1024 for index in range(4))
+        stdout, _, returncode = run_sync(run_process(['cat'],
+                                                     stdinData=chunks,
+                                                     captureStdout=True))
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, b''.join(bytes([65 + index]) * 1024
+                                          for index in range(4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
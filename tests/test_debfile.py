@@ -0,0 +1,141 @@
+'''
+Tests of reading local .deb files (easy_deploy.util.debfile).
+'''
+
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from collections import OrderedDict
+from unittest import mock
+
+from easy_deploy.util import debfile
+from easy_deploy.util.debfile import deb_info, DebFileError, read_control
+
+CONTROL = (b'Package: hello\n'
+           b'Version: 1.2-3\n'
+           b'Architecture: all\n'
+           b'Description: says hello\n'
+           b' A longer description: over\n'
+           b' two lines.\n')
+
+
+def tarball(name: str,
+            data: bytes,
+            mode: str='w:gz',
+            ) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def ar_archive(members: list,
+               ) -> bytes:
+    data = b'!<arch>\n'
+    for name, contents in members:
+        data += ('%-16s%-12d%-6d%-6d%-8s%-10d`\n'
+                 % (name, 0, 0, 0, '100644', len(contents))).encode('ascii')
+        data += contents + (b'\n' if len(contents) % 2 else b'')
+    return data
+
+
+class ReadControlTest(unittest.TestCase):
+    def setUp(self):
+        self.debDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.debDir)
+
+    def write(self,
+              data: bytes,
+              ) -> str:
+        path = os.path.join(self.debDir, 'package.deb')
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        return path
+
+    def deb(self,
+            control: bytes=CONTROL,
+            mode: str='w:gz',
+            suffix: str='.gz',
+            ) -> str:
+        return self.write(ar_archive([
+            ('debian-binary', b'2.0\n'),
+            ('control.tar%s' % suffix, tarball('./control', control, mode)),
+            ('data.tar.gz', tarball('./payload', b'payload')),
+            ]))
+
+    def test_fields(self):
+        fields = read_control(self.deb())
+        self.assertEqual(fields['Package'], 'hello')
+        self.assertEqual(fields['Version'], '1.2-3')
+        self.assertEqual(fields['Description'], 'says hello')
+
+    def test_continuation_lines_are_skipped(self):
+        fields = read_control(self.deb())
+        self.assertEqual(sorted(fields),
+                         ['Architecture', 'Description', 'Package', 'Version'])
+
+    def test_compressions(self):
+        for mode, suffix in (('w:xz', '.xz'), ('w:bz2', '.bz2'), ('w', '')):
+            with self.subTest(suffix=suffix):
+                fields = read_control(self.deb(mode=mode, suffix=suffix))
+                self.assertEqual(fields['Package'], 'hello')
+
+    def test_odd_sized_members_are_padded(self):
+        path = self.write(ar_archive([
+            ('debian-binary', b'2.0\n'),
+            ('_gpgbuilder', b'odd'),
+            ('control.tar.gz', tarball('control', CONTROL)),
+            ]))
+        self.assertEqual(read_control(path)['Version'], '1.2-3')
+
+    def test_not_a_deb(self):
+        with self.assertRaises(DebFileError):
+            read_control(self.write(b'PK\x03\x04 not an ar archive'))
+
+    def test_no_control_member(self):
+        path = self.write(ar_archive([('debian-binary', b'2.0\n')]))
+        with self.assertRaises(DebFileError):
+            read_control(path)
+
+    def test_corrupt_header(self):
+        path = self.write(b'!<arch>\n' + b'debian-binary   ' + b'x' * 44)
+        with self.assertRaises(DebFileError):
+            read_control(path)
+
+    def test_deb_info(self):
+        path = self.deb()
+        with open(path, 'rb') as stream:
+            data = stream.read()
+        info = deb_info(path)
+        self.assertEqual(info.package, 'hello')
+        self.assertEqual(info.version, '1.2-3')
+        self.assertEqual(info.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(info.size, len(data))
+
+    def test_deb_info_keeps_the_last_used(self):
+        paths = []
+        for name in ('a', 'b', 'c'):
+            paths.append(os.path.join(self.debDir, '%s.deb' % name))
+            shutil.copy(self.deb(), paths[-1])
+
+        with mock.patch.object(debfile, '_infoCache', OrderedDict()), \
+             mock.patch.object(debfile, 'MAX_CACHED_INFOS', 2):
+            for path in (paths[0], paths[1], paths[0], paths[2]):
+                deb_info(path)
+            self.assertEqual(sorted(key[0] for key in debfile._infoCache),
+                             [paths[0], paths[2]])
+
+    def test_deb_info_needs_a_version(self):
+        path = self.deb(control=b'Package: hello\n')
+        with self.assertRaises(DebFileError):
+            deb_info(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+'''
+Tests of the step journal used to resume runs (easy_deploy.util.journal).
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from easy_deploy.util.journal import Journal, step_keys
+
+
+def install_file(name: str,
+                 ) -> dict:
+    return {'command': 'installFile',
+            'localSource': name,
+            'remoteSource': '/etc/%s' % name,
+            }
+
+
+class StepKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.fileDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fileDir)
+
+    def write(self,
+              name: str,
+              contents: bytes,
+              ):
+        with open(os.path.join(self.fileDir, name), 'wb') as stream:
+            stream.write(contents)
+
+    def test_identical_steps_get_distinct_keys(self):
+        runlist = [{'command': 'flushRestarts'}, {'command': 'flushRestarts'}]
+        keys = step_keys(runlist, self.fileDir)
+        self.assertNotEqual(keys[id(runlist[0])], keys[id(runlist[1])])
+
+    def test_keys_are_stable_across_runs(self):
+        self.write('a.conf', b'a')
+        first = [install_file('a.conf'), {'command': 'flushRestarts'}]
+        second = [install_file('a.conf'), {'command': 'flushRestarts'}]
+        firstKeys = step_keys(first, self.fileDir)
+        secondKeys = step_keys(second, self.fileDir)
+        self.assertEqual([firstKeys[id(step)] for step in first],
+                         [secondKeys[id(step)] for step in second])
+
+    def test_changed_local_file_changes_key(self):
+        step = install_file('a.conf')
+        self.write('a.conf', b'a')
+        before = step_keys([step], self.fileDir)[id(step)]
+        self.write('a.conf', b'b')
+        after = step_keys([step], self.fileDir)[id(step)]
+        self.assertNotEqual(before, after)
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        journalDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journalDir)
+        self.path = os.path.join(journalDir, 'host.jsonl')
+
+    def test_resume_skips_completed_steps(self):
+        journal = Journal(self.path)
+        journal.record_step('key-1', install_file('a.conf'), index=0)
+        journal.close()
+
+        resumed = Journal(self.path, resume=True)
+        self.assertTrue(resumed.is_completed('key-1'))
+        self.assertFalse(resumed.is_completed('key-2'))
+
+    def test_new_run_starts_a_new_journal(self):
+        journal = Journal(self.path)
+        journal.record_step('key-1', install_file('a.conf'))
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertFalse(journal.is_completed('key-1'))
+        journal.record_step('key-2', install_file('b.conf'))
+        journal.close()
+
+        resumed = Journal(self.path, resume=True)
+        self.assertEqual(resumed.completed, {'key-2'})
+
+    def test_resumed_run_appends(self):
+        journal = Journal(self.path)
+        journal.record_step('key-1', install_file('a.conf'))
+        journal.close()
+
+        resumed = Journal(self.path, resume=True)
+        resumed.record_step('key-2', install_file('b.conf'))
+        resumed.close()
+
+        self.assertEqual(Journal(self.path, resume=True).completed,
+                         {'key-1', 'key-2'})
+
+    def test_line_cut_short_is_ignored(self):
+        journal = Journal(self.path)
+        journal.record_step('key-1', install_file('a.conf'))
+        journal.close()
+        with open(self.path, 'a') as stream:
+            stream.write('{"key": "key-2", "ind')
+
+        self.assertEqual(Journal(self.path, resume=True).completed, {'key-1'})
+
+    def test_pending_restarts_survive(self):
+        journal = Journal(self.path)
+        journal.record_restarts(['nginx', 'cron'])
+        journal.record_restarted(['cron'])
+        journal.close()
+
+        resumed = Journal(self.path, resume=True)
+        self.assertEqual(resumed.pendingRestarts, ['nginx'])
+
+    def test_missing_journal_resumes_nothing(self):
+        resumed = Journal(self.path, resume=True)
+        self.assertEqual(resumed.completed, set())
+        self.assertEqual(resumed.pendingRestarts, [])
+
+    def test_remove(self):
+        journal = Journal(self.path)
+        journal.record_step('key-1', install_file('a.conf'))
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+Tests of command output handling (easy_deploy.util.output).
+'''
+
+import unittest
+
+from easy_deploy.util.constants import MAX_LINE_BYTES
+from easy_deploy.util.output import LineSplitter, RingBuffer
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_keeps_everything_under_the_limit(self):
+        buffer = RingBuffer(maxBytes=10)
+        buffer.append(b'abc')
+        buffer.append(b'def')
+        self.assertEqual(buffer.getvalue(), 'abcdef')
+        self.assertEqual(buffer.size, 6)
+        self.assertEqual(buffer.dropped, 0)
+
+    def test_keeps_the_last_bytes(self):
+        buffer = RingBuffer(maxBytes=5)
+        for chunk in (b'abc', b'def', b'gh'):
+            buffer.append(chunk)
+        self.assertEqual(buffer.getvalue(), 'defgh')
+        self.assertEqual(buffer.size, 5)
+        self.assertEqual(buffer.dropped, 3)
+
+    def test_trims_inside_a_chunk(self):
+        buffer = RingBuffer(maxBytes=4)
+        buffer.append(b'abc')
+        buffer.append(b'de')
+        self.assertEqual(buffer.getvalue(), 'bcde')
+        self.assertEqual(buffer.dropped, 1)
+
+    def test_chunk_larger_than_the_buffer(self):
+        buffer = RingBuffer(maxBytes=4)
+        buffer.append(b'ab')
+        buffer.append(b'0123456789')
+        self.assertEqual(buffer.getvalue(), '6789')
+        self.assertEqual(buffer.size, 4)
+        self.assertEqual(buffer.dropped, 8)
+
+    def test_undecodable_bytes_are_replaced(self):
+        buffer = RingBuffer(maxBytes=4)
+        buffer.append('é'.encode('utf-8') + b'abc')
+        self.assertEqual(buffer.getvalue(), '\ufffdabc')
+
+
+class LineSplitterTest(unittest.TestCase):
+    def split(self,
+              chunks: list,
+              ) -> list:
+        lines = []
+        splitter = LineSplitter(lines.append)
+        for chunk in chunks:
+            splitter.feed(chunk)
+        splitter.close()
+        return lines
+
+    def test_lines_within_a_chunk(self):
+        self.assertEqual(self.split([b'a\nb\nc\n']), [b'a\n', b'b\n', b'c\n'])
+
+    def test_lines_across_chunks(self):
+        self.assertEqual(self.split([b'ab', b'c\nd', b'', b'e\n']),
+                         [b'abc\n', b'de\n'])
+
+    def test_unterminated_last_line_is_flushed(self):
+        self.assertEqual(self.split([b'a\nb']), [b'a\n', b'b'])
+
+    def test_empty_lines(self):
+        self.assertEqual(self.split([b'\n\n']), [b'\n', b'\n'])
+
+    def test_nothing_flushed_without_data(self):
+        self.assertEqual(self.split([]), [])
+
+    def test_long_line_is_passed_on_in_pieces(self):
+        line = b'x' * (MAX_LINE_BYTES * 2 + 10)
+        lines = []
+        splitter = LineSplitter(lines.append)
+        splitter.feed(line)
+        self.assertEqual(lines, [b'x' * MAX_LINE_BYTES] * 2)
+        splitter.feed(b'\n')
+        splitter.close()
+        self.assertEqual(lines[-1], b'x' * 10 + b'\n')
+        self.assertEqual(b''.join(lines), line + b'\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+'''
+Tests of config includes and step ids (easy_deploy.util.parser).
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from easy_deploy.util.parser import EasyDeployParser
+
+FLUSH = '- command: flushRestarts\n'
+
+
+class IncludeTest(unittest.TestCase):
+    def setUp(self):
+        self.configDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.configDir)
+
+    def write(self,
+              name: str,
+              contents: str,
+              ) -> str:
+        path = os.path.join(self.configDir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as stream:
+            stream.write(contents)
+        return path
+
+    def test_includes_are_expanded_in_order(self):
+        self.write('a.yml', '- command: flushRestarts\n  id: a\n')
+        self.write('sub/b.yml', '- command: flushRestarts\n  id: b\n')
+        main = self.write('main.yml', '- include: a.yml\n'
+                                      '- command: flushRestarts\n'
+                                      '  id: main\n'
+                                      '- include: [sub/b.yml]\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(errors, [])
+        self.assertEqual([step['id'] for step in runlist], ['a', 'main', 'b'])
+
+    def test_repeated_include_gets_distinct_steps(self):
+        self.write('a.yml', FLUSH)
+        main = self.write('main.yml', '- include: a.yml\n- include: a.yml\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(runlist), 2)
+        self.assertIsNot(runlist[0], runlist[1])
+
+    def test_self_include_is_a_loop(self):
+        main = self.write('main.yml', FLUSH + '- include: main.yml\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(runlist, [])
+        self.assertEqual(errors, ['Include loop: %s -> %s' % (main, main)])
+
+    def test_include_loop_lists_the_chain(self):
+        main = self.write('main.yml', '- include: a.yml\n')
+        a = self.write('a.yml', '- include: sub/b.yml\n')
+        b = self.write('sub/b.yml', FLUSH + '- include: ../a.yml\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(runlist, [])
+        self.assertEqual(errors, ['Include loop: %s -> %s -> %s' % (a, b, a)])
+
+    def test_diamond_include_is_not_a_loop(self):
+        self.write('common.yml', FLUSH)
+        self.write('a.yml', '- include: common.yml\n')
+        self.write('b.yml', '- include: common.yml\n')
+        main = self.write('main.yml', '- include: [a.yml, b.yml]\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(runlist), 2)
+
+    def test_missing_include_is_reported(self):
+        main = self.write('main.yml', '- include: missing.yml\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(runlist, [])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('%s: Unable to read include'
+                                             % main))
+
+    def test_invalid_yaml_in_include_names_the_file(self):
+        bad = self.write('bad.yml', '- command: [unclosed\n')
+        main = self.write('main.yml', '- include: bad.yml\n')
+        runlist, errors = EasyDeployParser().build(main)
+        self.assertEqual(runlist, [])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('%s: Unable to load config'
+                                             % bad))
+
+
+class DependencyTest(unittest.TestCase):
+    def verify(self,
+               runlist: list,
+               ) -> list:
+        return EasyDeployParser()._verify_dependencies(runlist)
+
+    def test_integer_ids(self):
+        runlist = [{'command': 'flushRestarts', 'id': 1},
+                   {'command': 'flushRestarts', 'id': 'b', 'after': 1},
+                   ]
+        self.assertEqual(self.verify(runlist), [])
+
+    def test_other_ids_are_refused(self):
+        errors = self.verify([{'command': 'flushRestarts', 'id': 1.5}])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].endswith(
+            'Option "id" must be a string or integer'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+'''
+Tests of the agent's request protocol (easy_deploy.util.remote_agent).
+'''
+
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from easy_deploy.util.remote_agent import (
+    FRAME_HEADER,
+    MAX_QUEUED_CHUNKS,
+    RemoteAgent,
+    )
+
+
+class RemoteAgentTest(unittest.TestCase):
+    def setUp(self):
+        '''
+        Runs an agent over a pair of pipes, its frames are collected by a
+        thread so tests can wait for them with a timeout.
+        '''
+        requestsRead, requestsWrite = os.pipe()
+        resultsRead, resultsWrite = os.pipe()
+        self.requests = os.fdopen(requestsWrite, 'wb')
+        self.results = os.fdopen(resultsRead, 'rb')
+        agent = RemoteAgent(os.fdopen(requestsRead, 'rb'),
+                            os.fdopen(resultsWrite, 'wb'))
+        self.server = threading.Thread(target=agent.serve, daemon=True)
+        self.server.start()
+        self.messages = queue.Queue()
+        threading.Thread(target=self.collect, daemon=True).start()
+        self.addCleanup(self.results.close)
+        self.addCleanup(self.server.join, 5)
+        self.addCleanup(self.requests.close)
+
+    def collect(self):
+        while True:
+            header = self.results.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            size, payloadSize = FRAME_HEADER.unpack(header)
+            message = json.loads(self.results.read(size).decode('utf-8'))
+            self.messages.put((message, self.results.read(payloadSize)))
+
+    def request(self,
+                message: dict,
+                payload: bytes=b'',
+                ):
+        data = json.dumps(message).encode('utf-8')
+        self.requests.write(FRAME_HEADER.pack(len(data), len(payload)))
+        self.requests.write(data + payload)
+        self.requests.flush()
+
+    def wait_result(self,
+                    requestId: int,
+                    timeout: float=10,
+                    ) -> (dict, list):
+        '''
+        Returns the result of a request and its other events.
+        '''
+        events = []
+        while True:
+            message, payload = self.messages.get(timeout=timeout)
+            if message['id'] != requestId:
+                self.messages.put((message, payload))
+                continue
+            if message['event'] == 'result':
+                return message, events
+            events.append((message, payload))
+
+    def test_stalled_request_does_not_hold_up_others(self):
+        # The process never reads its stdin, so its data piles up
+        started = time.monotonic()
+        self.request({'id': 1, 'op': 'exec', 'argv': ['sleep', '10'],
+                      'timeout': 2, 'data': True})
+        for _ in range(MAX_QUEUED_CHUNKS * 2):
+            self.request({'id': 1, 'op': 'data'}, b'x' * (256 * 1024))
+        self.request({'id': 2, 'op': 'ping'})
+
+        # Answered while the stalled request still runs
+        ping, _ = self.wait_result(2)
+        self.assertEqual(ping['pid'], os.getpid())
+        self.assertLess(time.monotonic() - started, 1)
+        result, events = self.wait_result(1)
+        self.assertTrue(result['timedOut'])
+        self.assertLess(len(events), MAX_QUEUED_CHUNKS)
+
+    def test_credit_for_every_chunk_taken(self):
+        self.request({'id': 1, 'op': 'exec', 'argv': ['cat'], 'data': True})
+        for chunk in (b'a\n', b'b\n', b''):
+            self.request({'id': 1, 'op': 'data'}, chunk)
+
+        result, events = self.wait_result(1)
+        self.assertEqual(result['returncode'], 0)
+        self.assertEqual(sorted(message['event'] for message, _ in events),
+                         ['credit', 'credit', 'output', 'output'])
+        self.assertEqual([payload for message, payload in events
+                          if message['event'] == 'output'], [b'a\n', b'b\n'])
+
+    def test_concurrent_installs(self):
+        installDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, installDir)
+        paths = [os.path.join(installDir, name) for name in ('a', 'b')]
+        for requestId, path in enumerate(paths, 1):
+            self.request({'id': requestId, 'op': 'install', 'path': path,
+                          'mode': '0600', 'data': True})
+        # Chunks of both transfers interleave, b finishes first
+        for requestId, chunk in ((1, b'a1'), (2, b'b1'), (2, b''),
+                                 (1, b'a2'), (1, b'')):
+            self.request({'id': requestId, 'op': 'data'}, chunk)
+
+        for requestId, path in enumerate(paths, 1):
+            result, _ = self.wait_result(requestId)
+            self.assertTrue(result['ok'])
+        with open(paths[0], 'rb') as stream:
+            self.assertEqual(stream.read(), b'a1a2')
+        with open(paths[1], 'rb') as stream:
+            self.assertEqual(stream.read(), b'b1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+Tests of running steps on a host (easy_deploy.util.run).
+'''
+
+import unittest
+
+from easy_deploy.util.run import HostDeployment
+
+
+def install_package(source: str,
+                    ) -> dict:
+    return {'command': 'installDebianPackage', 'source': source}
+
+def remove_package(source: str,
+                   ) -> dict:
+    return {'command': 'removeDebianPackage', 'source': source}
+
+
+class PackageBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.host = HostDeployment('.', None, 'test-host', 'root',
+                                   skipUnchanged=False)
+        self.calls = []
+        self.failing = set()
+        self.host.runner.debianPackages = self.debian_packages
+
+    def debian_packages(self,
+                        configs: list,
+                        action: str,
+                        ) -> list:
+        self.calls.append((action, [config['source'] for config in configs]))
+        return [config['source'] not in self.failing for config in configs]
+
+    def test_groups_run_in_order(self):
+        steps = [install_package('/a.deb'), remove_package('b')]
+        self.assertEqual(self.host._execute(steps), [True, True])
+        self.assertEqual(self.calls, [('install', ['/a.deb']),
+                                      ('remove', ['b'])])
+
+    def test_failed_install_leaves_the_remove_unrun(self):
+        self.failing.add('/a.deb')
+        steps = [install_package('/a.deb'),
+                 install_package('/b.deb'),
+                 remove_package('c'),
+                 ]
+        self.assertEqual(self.host._execute(steps), [False, True, False])
+        self.assertEqual(self.calls, [('install', ['/a.deb', '/b.deb'])])
+
+    def test_failed_batch_stops_the_host(self):
+        self.failing.add('/a.deb')
+        runlist = [install_package('/a.deb'),
+                   remove_package('b'),
+                   {'command': 'flushRestarts'},
+                   ]
+        self.assertFalse(self.host._run_in_order(runlist))
+        self.assertEqual(self.calls, [('install', ['/a.deb'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+'''
+Tests of step dependency ordering (easy_deploy.util.scheduler).
+'''
+
+import threading
+import time
+import unittest
+
+from easy_deploy.util.scheduler import build_graph, find_cycle, StepScheduler
+
+
+def step(stepId: str=None,
+         after=None,
+         ) -> dict:
+    block = {'command': 'flushRestarts'}
+    if stepId is not None:
+        block['id'] = stepId
+    if after is not None:
+        block['after'] = after
+    return block
+
+
+class BuildGraphTest(unittest.TestCase):
+    def test_steps_without_after_follow_the_step_before(self):
+        runlist = [step('a'), step('b'), step('c', after='a'), step('d')]
+        self.assertEqual(build_graph(runlist), [set(), {0}, {0}, {2}])
+
+    def test_batched_steps_share_dependencies(self):
+        runlist = [step('a'),
+                   {'command': 'installDebianPackage', 'id': 'b'},
+                   {'command': 'installDebianPackage', 'id': 'c'},
+                   step('d'),
+                   ]
+        graph = build_graph(runlist,
+                            lambda step: 'dpkg' if 'Package' in
+                                         step['command'] else None)
+        self.assertEqual(graph, [set(), {0}, {0}, {2}])
+
+
+class FindCycleTest(unittest.TestCase):
+    def test_no_dependencies(self):
+        self.assertEqual(find_cycle([step('a'), step('b'), step()]), [])
+
+    def test_chain_is_not_a_cycle(self):
+        runlist = [step('a'), step('b', after='a'), step('c', after=['a', 'b'])]
+        self.assertEqual(find_cycle(runlist), [])
+
+    def test_diamond_is_not_a_cycle(self):
+        runlist = [step('a'),
+                   step('b', after='a'),
+                   step('c', after='a'),
+                   step('d', after=['b', 'c']),
+                   ]
+        self.assertEqual(find_cycle(runlist), [])
+
+    def test_implicit_order_can_form_a_cycle(self):
+        runlist = [step('a', after='b'), step('b')]
+        self.assertEqual(find_cycle(runlist), ['a', 'b', 'a'])
+
+    def test_self_dependency(self):
+        self.assertEqual(find_cycle([step('a', after='a')]), ['a', 'a'])
+
+    def test_cycle_is_reported_in_order(self):
+        runlist = [step('a', after='c'),
+                   step('b', after='a'),
+                   step('c', after='b'),
+                   ]
+        self.assertEqual(find_cycle(runlist), ['a', 'c', 'b', 'a'])
+
+    def test_cycle_behind_acyclic_steps(self):
+        runlist = [step('a'),
+                   step('b', after='a'),
+                   step('c', after=['b', 'd']),
+                   step('d', after='c'),
+                   ]
+        self.assertEqual(find_cycle(runlist), ['c', 'd', 'c'])
+
+
+class StepSchedulerTest(unittest.TestCase):
+    def run_steps(self,
+                  runlist: list,
+                  failing: set=frozenset(),
+                  parallelism: int=4,
+                  ) -> (bool, list):
+        ran = []
+        lock = threading.Lock()
+
+        def execute(steps):
+            with lock:
+                ran.extend(step['id'] for step in steps)
+            return [step['id'] not in failing for step in steps]
+
+        success = StepScheduler(runlist, execute, parallelism).run()
+        return success, ran
+
+    def test_dependencies_run_first(self):
+        runlist = [step('a'),
+                   step('c', after=['a', 'b']),
+                   step('b', after='a'),
+                   ]
+        success, ran = self.run_steps(runlist)
+        self.assertTrue(success)
+        self.assertEqual(ran, ['a', 'b', 'c'])
+
+    def test_undeclared_steps_keep_their_order(self):
+        runlist = [step('a'), step('b', after='a'), step('c'), step('d')]
+        started = {}
+
+        def execute(steps):
+            started[steps[0]['id']] = time.monotonic()
+            time.sleep(0.05)
+            return [True]
+
+        self.assertTrue(StepScheduler(runlist, execute, 4).run())
+        self.assertLess(started['b'] + 0.04, started['c'])
+        self.assertLess(started['c'] + 0.04, started['d'])
+
+    def test_declared_step_runs_alongside(self):
+        runlist = [step('a'), step('b'), step('c', after='a')]
+        cStarted = threading.Event()
+
+        def execute(steps):
+            if steps[0]['id'] == 'c':
+                cStarted.set()
+            elif steps[0]['id'] == 'b':
+                # Only returns in time if c runs while b does
+                return [cStarted.wait(5)]
+            return [True]
+
+        self.assertTrue(StepScheduler(runlist, execute, 4).run())
+
+    def test_failure_stops_dependents(self):
+        runlist = [step('a'), step('b', after='a'), step('c', after='b')]
+        success, ran = self.run_steps(runlist, failing={'a'})
+        self.assertFalse(success)
+        self.assertEqual(ran, ['a'])
+
+    def test_batches_share_a_key(self):
+        runlist = [step('a'), step('b'), step('c', after=['a', 'b'])]
+        batches = []
+
+        def execute(steps):
+            batches.append([step['id'] for step in steps])
+            return [True] * len(steps)
+
+        scheduler = StepScheduler(runlist,
+                                  execute,
+                                  parallelism=4,
+                                  batchKey=lambda step: step['command'])
+        self.assertTrue(scheduler.run())
+        self.assertEqual(batches, [['a', 'b'], ['c']])
+
+
+if __name__ == '__main__':
+    unittest.main()